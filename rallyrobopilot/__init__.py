@@ -1,8 +1,37 @@
-from .car import Car
-from .particles import Particles
-from .remote_controller import RemoteController
-from .track import Track
-from .sun import SunLight
-from .raycast_sensor import MultiRaySensor
+import importlib
+
+from .car_dynamics import CarState, CarParameters
+from .batch_dynamics import BatchCarSimulator
 from .sensing_message import NetworkDataCmdInterface
-from .game_launcher import prepare_game_app
+from .async_client import AsyncSimulatorClient
+from .simulation import HeadlessSimulation, GameSimulation
+from .vector_env import VectorRallyEnv
+
+#   Names from modules importing Ursina, which needs a display. They are only imported when used, so that the headless
+#   simulation, the clients and the scripts run without it. They are left out of __all__, so that star imports do not
+#   pull Ursina in.
+URSINA_IMPORTS = {
+    "Car": ".car",
+    "Particles": ".particles",
+    "RemoteController": ".remote_controller",
+    "Track": ".track",
+    "SunLight": ".sun",
+    "MultiRaySensor": ".raycast_sensor",
+    "CameraSensor": ".camera_sensor",
+    "prepare_game_app": ".game_launcher",
+}
+
+__all__ = ["CarState", "CarParameters", "BatchCarSimulator", "NetworkDataCmdInterface", "AsyncSimulatorClient",
+           "HeadlessSimulation", "GameSimulation", "VectorRallyEnv"]
+
+
+def __getattr__(name):
+    if name not in URSINA_IMPORTS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(URSINA_IMPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(URSINA_IMPORTS))
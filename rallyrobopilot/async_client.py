@@ -0,0 +1,144 @@
+"""
+    asyncio client of the simulator protocol, the counterpart of NetworkDataCmdInterface for event loops: snapshots are
+    unpacked as they are received, without threads nor polling, so a single loop can drive many simulator connections.
+
+        client = await AsyncSimulatorClient(latest_only = True).connect("127.0.0.1", 7654)
+        await client.send_cmd("set sensing rays 60;")
+        async for snapshot in client.snapshots():
+            await client.send_frame(policy(snapshot))
+"""
+import asyncio
+import os
+
+from .remote_commands import pack_command_frame
+from .sensing_message import SensingSnapshotManager, RECEIVE_MIN_SIZE
+from .shared_ring import SHARED_SLOTS, SHARED_SLOT_SIZE
+
+
+class AsyncSimulatorClient(asyncio.BufferedProtocol):
+    def __init__(self, latest_only = False):
+        """
+        With latest_only, snapshots not consumed yet are dropped for the newest one, so a slow consumer always gets the
+        current state
+        """
+        self.latest_only = latest_only
+        self.nbr_dropped_snapshots = 0
+
+        #   Received bytes go straight into the receive buffer of the manager, with the same framing as the sync client
+        self.msg_mngr = SensingSnapshotManager(self.queue_snapshot, latest_only)
+        #   Received snapshots, None once the connection is lost
+        self.received_snapshots = asyncio.Queue()
+
+        self.transport = None
+        self.closed = None
+        #   Cleared while the transport write buffer is full
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+        #   Sequence number of the last sent binary command frame
+        self.frame_sequence = 0
+
+    async def connect(self, address = "127.0.0.1", port = 7654):
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        await loop.create_connection(lambda: self, address, port)
+        return self
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            await self.closed
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    #   asyncio.BufferedProtocol callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.msg_mngr.reserve(max(sizehint, RECEIVE_MIN_SIZE))
+
+    def buffer_updated(self, nbytes):
+        self.msg_mngr.received(nbytes)
+
+    def connection_lost(self, exc):
+        self.received_snapshots.put_nowait(None)
+        self.writable.set()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def queue_snapshot(self, snapshot):
+        if self.latest_only:
+            while not self.received_snapshots.empty():
+                self.received_snapshots.get_nowait()
+                self.nbr_dropped_snapshots += 1
+        self.received_snapshots.put_nowait(snapshot)
+
+    async def receive(self):
+        """
+        Returns the next received snapshot, None once the connection is closed
+        """
+        if self.closed.done() and self.received_snapshots.empty():
+            return None
+        return await self.received_snapshots.get()
+
+    async def snapshots(self):
+        while True:
+            snapshot = await self.receive()
+            if snapshot is None:
+                return
+            yield snapshot
+
+    async def send(self, data):
+        """
+        Waits while the transport write buffer is full, so that commands are not queued without bound
+        """
+        await self.writable.wait()
+        if self.transport.is_closing():
+            raise ConnectionError("Simulator connection closed")
+        self.transport.write(data)
+
+    async def send_cmd(self, cmd):
+        await self.send(bytes(cmd, "utf-8"))
+
+    async def enable_binary_commands(self):
+        """
+        Negotiates the binary command frames, the snapshots then echo the sequence of the last applied frame
+        """
+        await self.send_cmd("set protocol binary;")
+
+    async def send_frame(self, controls, reset_pose = None, ticks = 0):
+        """
+        Sends the (forward, back, left, right) controls in a binary command frame and returns its sequence number, see
+        remote_commands.pack_command_frame
+        """
+        self.frame_sequence += 1
+        await self.send(pack_command_frame(self.frame_sequence, controls, reset_pose, ticks))
+        return self.frame_sequence
+
+    async def set_image_encoding(self, encoding, quality = None):
+        """
+        Asks for raw, jpeg, png or delta encoded images, see image_encoding
+        """
+        if quality is not None:
+            await self.send_cmd("set image quality %d;" % quality)
+        await self.send_cmd("set image encoding %s;" % encoding)
+
+    async def enable_shared_memory(self, name = None, nbr_slots = SHARED_SLOTS, slot_size = SHARED_SLOT_SIZE):
+        """
+        Asks for the snapshots to be written into a shared memory ring, see NetworkDataCmdInterface.enable_shared_memory
+        """
+        if name is None:
+            name = "rrp_%d_%x" % (os.getpid(), id(self))
+        self.msg_mngr.use_shared_memory(name, nbr_slots, slot_size)
+        await self.send_cmd("set transport shared %s %d %d;" % (name, nbr_slots, slot_size))
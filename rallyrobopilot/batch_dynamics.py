@@ -0,0 +1,117 @@
+"""
+    Vectorized car dynamics.
+
+    BatchCarSimulator holds the state of N cars in contiguous NumPy arrays and advances all of them with a single
+    vectorized call applying the same driving model as car_dynamics.step.
+"""
+import numpy as np
+
+from .car_dynamics import CarState, DEFAULT_PARAMETERS, FIXED_TIMESTEP, OBSTACLE_DISPLACEMENT_MARGIN
+
+
+class BatchCarSimulator:
+    def __init__(self, nbr_cars, parameters = DEFAULT_PARAMETERS):
+        self.nbr_cars = nbr_cars
+        self.parameters = parameters
+
+        self.positions = np.zeros((nbr_cars, 3))
+        self.rotation_y = np.zeros(nbr_cars)
+        self.speed = np.zeros(nbr_cars)
+        self.rotation_speed = np.zeros(nbr_cars)
+        self.velocity_y = np.zeros(nbr_cars)
+
+    def __len__(self):
+        return self.nbr_cars
+
+    def reset(self, position = (0, 0, 0), rotation_y = 0, indices = slice(None)):
+        """
+        Places the selected cars (all by default) at standstill on the given pose
+        """
+        self.positions[indices] = position
+        self.rotation_y[indices] = rotation_y
+        self.speed[indices] = 0
+        self.rotation_speed[indices] = 0
+        self.velocity_y[indices] = 0
+
+    def get_state(self, index):
+        return CarState(tuple(self.positions[index]), self.rotation_y[index], self.speed[index],
+                        self.rotation_speed[index], self.velocity_y[index])
+
+    def set_state(self, index, state):
+        self.positions[index] = state.position
+        self.rotation_y[index] = state.rotation_y
+        self.speed[index] = state.speed
+        self.rotation_speed[index] = state.rotation_speed
+        self.velocity_y[index] = state.velocity_y
+
+    def forward(self):
+        """
+        Returns the (N, 3) forward vectors of the cars
+        """
+        angles = np.radians(self.rotation_y)
+        forward = np.zeros((self.nbr_cars, 3))
+        forward[:, 0] = np.sin(angles)
+        forward[:, 2] = np.cos(angles)
+        return forward
+
+    def step(self, controls, dt = FIXED_TIMESTEP, cast_obstacles = None):
+        """
+        Advances every car by dt seconds.
+
+        Args:
+            controls (np.ndarray): (N, 4) array of (forward, back, left, right) controls.
+            dt (float): Duration of the step in seconds.
+            cast_obstacles (callable): Batched counterpart of the car_dynamics.step callback.
+                cast_obstacles(origins, directions, distances) returns the (N,) hit distances (inf when nothing is hit)
+                and the (N, 3) world normals of the obstacles. Obstacles are ignored when not provided.
+        """
+        params = self.parameters
+        controls = np.asarray(controls, dtype = bool)
+        forward, back, left, right = controls[:, 0], controls[:, 1], controls[:, 2], controls[:, 3]
+        speed = self.speed
+
+        #   Acceleration or friction
+        speed += np.where(forward, params.acceleration * dt,
+                          np.where(speed > 1, -params.friction * 5 * dt,
+                                   np.where(speed < -1, params.friction * 5 * dt, 0)))
+
+        #   Braking
+        speed -= np.where(back, np.where(speed > 0, params.braking_strength * dt, params.acceleration * dt), 0)
+
+        #   Check physical constrains
+        np.clip(speed, params.minspeed, params.topspeed, out = speed)
+
+        #   Turning, the rotation radius is function of speed
+        turning = left | right
+        radius = np.power(np.abs(speed / params.topspeed), 1.5) * (params.biggest_radius - params.smallest_radius) + params.smallest_radius
+        travelled_circle_center_angle = np.abs(speed * dt) / radius
+        da = np.arctan2(1 - np.cos(travelled_circle_center_angle), np.sin(travelled_circle_center_angle)) / 3.14159 * 180
+        self.rotation_y += np.where(turning, np.where(right, da, -da), 0)
+
+        #   Integrate speed into movement
+        distance_to_travel = speed * dt
+        forward_vectors = self.forward()
+
+        if cast_obstacles is not None:
+            direction = np.where(speed > 0, 1., -1.)
+            reach = params.half_length + distance_to_travel
+            hit_distances, normals = cast_obstacles(self.positions, forward_vectors * direction[:, None], reach)
+
+            hit = hit_distances < reach
+            if np.any(hit):
+                normals = np.asarray(normals)[hit]
+                hit_forward = forward_vectors[hit]
+                alignment = np.einsum("ij,ij->i", hit_forward, normals)
+
+                #   Cancel speed going directly into the obstacle
+                next_forward = hit_forward - alignment[:, None] * normals
+                speed[hit] *= 0.5 + 0.5 * alignment
+                self.rotation_y[hit] = np.arctan2(next_forward[:, 0], next_forward[:, 2]) / 3.14159 * 180
+
+                #   Move cars away from obstacles and not along their forward axis
+                self.positions[hit, 0] += normals[:, 0] * OBSTACLE_DISPLACEMENT_MARGIN
+                self.positions[hit, 2] += normals[:, 2] * OBSTACLE_DISPLACEMENT_MARGIN
+                distance_to_travel[hit] = 0
+
+        self.positions[:, 0] += forward_vectors[:, 0] * distance_to_travel
+        self.positions[:, 2] += forward_vectors[:, 2] * distance_to_travel
@@ -0,0 +1,385 @@
+from panda3d.core import GraphicsOutput, NodePath, PerspectiveLens, Texture as PandaTexture
+from ursina import Entity, Mesh
+import numpy as np
+import threading
+import time
+
+from .track_geometry import load_track_meshes, resolve_model_path
+
+#   Default sensing image, sized for the policies rather than for the window
+DEFAULT_IMAGE_SIZE = (128, 96)
+DEFAULT_FOV = 90
+
+#   Mount point relative to the car: above the car center, looking slightly down the road
+DEFAULT_MOUNT_POSITION = (0, 3, 0)
+DEFAULT_MOUNT_ROTATION = (10, 0, 0)
+
+#   Clip planes of the sensing camera, as the Ursina camera
+CLIP_NEAR = 0.1
+CLIP_FAR = 10000
+
+#   Depth planes hold the distance along the view axis in centimeters, farther points are DEPTH_MAX
+DEPTH_UNIT = 0.01
+DEPTH_MAX = 65535
+
+#   Label planes values
+LABEL_BACKGROUND = 0
+LABEL_TRACK = 1
+LABEL_OFF_ROAD = 2
+LABEL_OBSTACLE = 3
+LABEL_CAR = 4
+
+#   Above the priority of the attributes set by Ursina, so that the label scene renders flat labels
+LABEL_STATE_PRIORITY = 1000
+
+#   Normalization of the RAM depth values, by texture component type
+DEPTH_COMPONENT_TYPES = {
+    PandaTexture.T_float: (np.float32, 1.),
+    PandaTexture.T_unsigned_int: (np.uint32, 2**32 - 1),
+    PandaTexture.T_unsigned_int_24_8: (np.uint32, 2**32 - 1),
+    PandaTexture.T_unsigned_short: (np.uint16, 2**16 - 1),
+}
+
+
+class RamImageReader:
+    """
+    Converts the bottom-up BGR(A) RAM images of textures into top-down RGB images written into preallocated buffers.
+
+    The last read image stays valid until the next read. Users keeping an image longer, such as the SnapshotSender
+    workers, hold it and call the returned release function once done: held buffers are not rewritten, and the pool
+    grows when all of them are held.
+    """
+    def __init__(self, nbr_buffers = 3):
+        self.nbr_buffers = nbr_buffers
+        self.buffers = []
+        #   Holds of each buffer, the last read one is held by the reader. Released from the sender threads.
+        self.holds = []
+        self.last_read = None
+        self.lock = threading.Lock()
+
+    def hold(self, image):
+        """
+        Keeps image, returned by read, from being rewritten until the returned function is called
+        """
+        with self.lock:
+            self.add_hold(image, 1)
+        released = []
+
+        def release():
+            #   Released once, whatever the number of calls
+            if len(released) == 0:
+                released.append(True)
+                with self.lock:
+                    self.add_hold(image, -1)
+        return release
+
+    def add_hold(self, image, count):
+        for index, buffer in enumerate(self.buffers):
+            if buffer is image:
+                self.holds[index] += count
+                return
+        if count > 0:
+            raise ValueError("Image not read by this reader")
+        #   Buffers dropped on a size change are no longer tracked
+
+    def acquire_buffer(self, shape):
+        with self.lock:
+            if len(self.buffers) == 0 or self.buffers[0].shape != shape:
+                self.buffers = [np.empty(shape, np.uint8) for i in range(self.nbr_buffers)]
+                self.holds = [0] * self.nbr_buffers
+                self.last_read = None
+
+            if self.last_read is not None:
+                self.add_hold(self.last_read, -1)
+            if 0 not in self.holds:
+                self.buffers.append(np.empty(shape, np.uint8))
+                self.holds.append(0)
+
+            index = self.holds.index(0)
+            self.holds[index] = 1
+            self.last_read = self.buffers[index]
+            return self.last_read
+
+    def read(self, texture):
+        shape = (texture.getYSize(), texture.getXSize(), 3)
+        image = self.acquire_buffer(shape)
+
+        #   Flip and BGR -> RGB conversion in a single copy out of the texture memory
+        ram_image = np.frombuffer(texture.getRamImage(), np.uint8).reshape(shape[0], shape[1], texture.getNumComponents())
+        np.copyto(image, ram_image[::-1, :, 2::-1])
+        return image
+
+
+def read_depth(texture, near, far):
+    """
+    Returns the top-down (height, width) uint16 depth plane of a depth texture rendered with the near and far clip planes
+    """
+    dtype, scale = DEPTH_COMPONENT_TYPES[texture.getComponentType()]
+    ram_depth = np.frombuffer(texture.getRamImage(), dtype).reshape(texture.getYSize(), texture.getXSize())[::-1]
+    if texture.getComponentType() == PandaTexture.T_unsigned_int_24_8:
+        ram_depth = ram_depth >> 8
+        scale = 2**24 - 1
+
+    #   OpenGL window depth --> distance along the view axis
+    z_ndc = ram_depth * np.float32(2 / scale) - 1
+    distance = (2 * near * far) / ((far + near) - z_ndc * (far - near))
+    return np.minimum(np.rint(distance * (1 / DEPTH_UNIT)), DEPTH_MAX).astype(np.uint16)
+
+
+def read_labels(texture):
+    """
+    Returns the top-down (height, width) uint8 label plane, labels are rendered in the red channel
+    """
+    ram_image = np.frombuffer(texture.getRamImage(), np.uint8).reshape(texture.getYSize(), texture.getXSize(),
+                                                                         texture.getNumComponents())
+    return np.ascontiguousarray(ram_image[::-1, :, 2])
+
+
+class CameraSensor(Entity):
+    """
+    Dedicated camera rendering into its own offscreen buffer, independent of the window size and of the HUD.
+
+    Pixels are read back asynchronously: request_image asks for a copy of the next rendered frame, which grab_image
+    publishes on a later frame, so the game loop never waits for the GPU when a snapshot is built.
+
+    Depth and label passes are optional and read back with the same frames: the depth buffer of the sensing buffer, and
+    a label buffer rendering the track, scenery, walls and car with flat labels. Disabled passes are neither rendered
+    nor read back.
+    """
+    def __init__(self, car, size = DEFAULT_IMAGE_SIZE, fov = DEFAULT_FOV, position = DEFAULT_MOUNT_POSITION,
+                 rotation = DEFAULT_MOUNT_ROTATION, depth = False, labels = False):
+        super().__init__(
+            parent = car,
+            position = position,
+            rotation = rotation,
+        )
+        self.car = car
+
+        self.lens = PerspectiveLens()
+        self.lens.setNearFar(CLIP_NEAR, CLIP_FAR)
+        self.fov = fov
+        self.size = None
+        self.buffer = None
+        self.camera_np = None
+
+        self.depth_enabled = depth
+        self.labels_enabled = labels
+        self.label_buffer = None
+        self.label_camera_np = None
+        self.label_scene = None
+        #   World space ground triangles of the track labelled LABEL_TRACK, loaded once per track
+        self.ground_triangles = None
+        self.ground_triangles_track = None
+
+        #   Pending copy request and last published frame
+        self.requested_frame = None
+        self.requested_time = 0
+        self.reader = RamImageReader()
+        self.image = None
+        self.depth_image = None
+        self.label_image = None
+        self.image_time = 0
+
+        self.configure(size = size)
+
+    def create_buffer(self, size):
+        self.remove_buffers()
+
+        #   The textures are only copied back to RAM at the end of the frames rendered after a request_image call
+        self.sensing_texture = PandaTexture("sensing_camera")
+        self.buffer = base.win.makeTextureBuffer("sensing_camera", size[0], size[1], self.sensing_texture, False)
+        self.buffer.clearRenderTextures()
+        self.buffer.addRenderTexture(self.sensing_texture, GraphicsOutput.RTMTriggeredCopyRam)
+        if self.depth_enabled:
+            self.depth_texture = PandaTexture("sensing_depth")
+            self.buffer.addRenderTexture(self.depth_texture, GraphicsOutput.RTMTriggeredCopyRam, GraphicsOutput.RTPDepth)
+        self.buffer.setSort(-10)
+        self.camera_np = base.makeCamera(self.buffer, lens = self.lens)
+        self.camera_np.reparentTo(self)
+
+        if self.labels_enabled:
+            self.label_texture = PandaTexture("sensing_labels")
+            self.label_buffer = base.win.makeTextureBuffer("sensing_labels", size[0], size[1], self.label_texture, False)
+            self.label_buffer.clearRenderTextures()
+            self.label_buffer.addRenderTexture(self.label_texture, GraphicsOutput.RTMTriggeredCopyRam)
+            self.label_buffer.setSort(-10)
+            #   Only rendered on the frames following request_image
+            self.label_buffer.setOneShot(True)
+
+            self.label_scene = self.create_label_scene()
+            self.label_camera_np = base.makeCamera(self.label_buffer, lens = self.lens, scene = self.label_scene,
+                                                   clearColor = (LABEL_BACKGROUND / 255, 0, 0, 1))
+            self.label_camera_np.reparentTo(self)
+
+        self.size = tuple(size)
+
+        self.requested_frame = None
+        self.image = None
+        self.depth_image = None
+        self.label_image = None
+
+    def remove_buffers(self):
+        if self.buffer is not None:
+            self.camera_np.removeNode()
+            base.graphicsEngine.removeWindow(self.buffer)
+            self.buffer = None
+
+        if self.label_buffer is not None:
+            self.label_camera_np.removeNode()
+            base.graphicsEngine.removeWindow(self.label_buffer)
+            self.label_scene.removeNode()
+            self.label_buffer = None
+
+    def create_label_scene(self):
+        """
+        Separate scene graph instancing the car and track models, flat colored with their label in the red channel
+        """
+        scene = NodePath("sensing_labels")
+        scene.setTextureOff(LABEL_STATE_PRIORITY)
+        scene.setLightOff(LABEL_STATE_PRIORITY)
+        scene.setShaderOff(LABEL_STATE_PRIORITY)
+        scene.setMaterialOff(LABEL_STATE_PRIORITY)
+        scene.setFogOff(LABEL_STATE_PRIORITY)
+        scene.setColorScaleOff(LABEL_STATE_PRIORITY)
+
+        track = self.car.track
+        if track is not None:
+            self.add_track_label_models(scene, track)
+            #   Instancing the models also shows the invisible wall meshes
+            self.add_label_models(scene, track.obstacles, LABEL_OBSTACLE)
+
+        #   The car moves, its placement is updated on requests
+        self.label_car = scene.attachNewNode("car")
+        self.label_car.setColor(LABEL_CAR / 255, 0, 0, 1, LABEL_STATE_PRIORITY)
+        self.label_car_model = None
+        return scene
+
+    def add_track_label_models(self, scene, track):
+        """
+        Labels the ground meshes listed in the track metadata as track and the rest of the scenery as off-road. The
+        track model is the track when the metadata lists no ground.
+        """
+        scenery = [(track, track.data["track_model"])]
+        scenery += [(detail, data["model"]) for detail, data in zip(track.details, track.data["details"]) if detail.enabled]
+        ground = track.data.get("ground", [])
+        if len(ground) == 0:
+            self.add_label_models(scene, [track], LABEL_TRACK)
+            self.add_label_models(scene, [entity for entity, model in scenery[1:]], LABEL_OFF_ROAD)
+            return
+
+        #   Models only made of ground are left out of the off-road ones, ground restricted to some objects of a model
+        #   is drawn over the coplanar faces of this model
+        ground_paths = {resolve_model_path(track.track_name, mesh["model"]) for mesh in ground if "objects" not in mesh}
+        self.add_label_models(scene, [entity for entity, model in scenery
+                                      if resolve_model_path(track.track_name, model) not in ground_paths], LABEL_OFF_ROAD)
+
+        if self.ground_triangles_track is not track:
+            self.ground_triangles = load_track_meshes(track.track_name, track.data, ground)
+            self.ground_triangles_track = track
+        group = scene.attachNewNode("label_%d" % LABEL_TRACK)
+        group.setColor(LABEL_TRACK / 255, 0, 0, 1, LABEL_STATE_PRIORITY)
+        group.setTwoSided(True)
+        group.setDepthOffset(1)
+        if len(self.ground_triangles) > 0:
+            Mesh(vertices = self.ground_triangles.reshape(-1, 3).tolist()).instanceTo(group)
+
+    def add_label_models(self, scene, entities, label):
+        group = scene.attachNewNode("label_%d" % label)
+        group.setColor(label / 255, 0, 0, 1, LABEL_STATE_PRIORITY)
+        for entity in entities:
+            if entity.model is not None:
+                placement = group.attachNewNode(entity.name)
+                placement.setMat(entity.getMat(render))
+                entity.model.instanceTo(placement)
+
+    def update_label_car(self):
+        if self.label_car_model is not self.car.model:
+            self.label_car.node().removeAllChildren()
+            if self.car.model is not None:
+                self.car.model.instanceTo(self.label_car)
+            self.label_car_model = self.car.model
+        self.label_car.setMat(self.car.getMat(render))
+
+    def configure(self, size = None, fov = None, position = None, rotation = None, depth = None, labels = None):
+        """
+        Changes the image size (width, height), the horizontal field of view (degrees), the mount point relative to
+        the car and the enabled depth and label passes. Parameters left to None are kept.
+        """
+        if size is not None and (size[0] < 1 or size[1] < 1):
+            raise ValueError("Invalid sensing image size %s" % str(size))
+
+        passes_changed = ((depth is not None and depth != self.depth_enabled) or
+                          (labels is not None and labels != self.labels_enabled))
+        if depth is not None:
+            self.depth_enabled = depth
+        if labels is not None:
+            self.labels_enabled = labels
+
+        if size is not None and tuple(size) != self.size:
+            self.create_buffer(size)
+        elif passes_changed:
+            self.create_buffer(self.size)
+        if fov is not None:
+            self.fov = fov
+        if position is not None:
+            self.position = position
+        if rotation is not None:
+            self.rotation = rotation
+
+        self.lens.setAspectRatio(self.size[0] / self.size[1])
+        self.lens.setFov(self.fov)
+
+    def request_image(self):
+        """
+        Asks for a RAM copy of the frame about to be rendered, superseding a pending request
+        """
+        self.buffer.triggerCopy()
+        if self.label_buffer is not None:
+            self.update_label_car()
+            self.label_buffer.setActive(True)
+            self.label_buffer.setOneShot(True)
+            self.label_buffer.triggerCopy()
+
+        self.requested_frame = globalClock.getFrameCount()
+        self.requested_time = time.time()
+
+    def publish(self):
+        #   Publish the frames of a completed copy request
+        if (self.requested_frame is None or globalClock.getFrameCount() <= self.requested_frame or
+                not self.sensing_texture.hasRamImage()):
+            return
+
+        self.image = self.reader.read(self.sensing_texture)
+        if self.depth_enabled and self.depth_texture.hasRamImage():
+            self.depth_image = read_depth(self.depth_texture, self.lens.getNear(), self.lens.getFar())
+        if self.label_buffer is not None and self.label_texture.hasRamImage():
+            self.label_image = read_labels(self.label_texture)
+        self.image_time = self.requested_time
+        self.requested_frame = None
+
+    def grab_image(self):
+        """
+        Publishes the last copied frame if a requested copy completed, and returns the published (height, width, 3)
+        uint8 image with its age in seconds. (None, 0) before the first copy.
+        """
+        self.publish()
+        if self.image is None:
+            return None, 0
+        return self.image, time.time() - self.image_time
+
+    def grab_depth(self):
+        """
+        Returns the (height, width) uint16 depth plane of the published frame in DEPTH_UNIT, None if disabled
+        """
+        self.publish()
+        return self.depth_image if self.depth_enabled else None
+
+    def grab_labels(self):
+        """
+        Returns the (height, width) uint8 LABEL_* plane of the published frame, None if disabled
+        """
+        self.publish()
+        return self.label_image if self.labels_enabled else None
+
+    def on_destroy(self):
+        self.remove_buffers()
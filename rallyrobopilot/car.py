@@ -4,13 +4,41 @@ import setuptools
 from ursina import *
 from ursina import curve
 from .particles import Particles, TrailRenderer
+from .car_dynamics import CarState, CarParameters, FIXED_TIMESTEP, step
 from math import pow, atan2
 import json
+import struct
+
+import numpy as np
 
 sign = lambda x: -1 if x < 0 else (1 if x > 0 else 0)
 Text.default_resolution = 1080 * Text.size
 
+#   Upper bound on physics ticks run in a single frame, prevents spiraling when frames get slow
+MAX_TICKS_PER_FRAME = 8
+
+#   Saved state layout following the packed CarState: controls, reset position, angle & speed, time left to the next
+#   physics tick, rays visibility and count
+CAR_STATE_STRUCT = struct.Struct(">4B6d?H")
+
+def delegated(holder, name):
+    """
+    Exposes attribute name of the object stored in attribute holder as an attribute of the owner class
+    """
+    return property(lambda self: getattr(getattr(self, holder), name),
+                    lambda self, value: setattr(getattr(self, holder), name, value))
+
 class Car(Entity):
+    #   Kinematics and engine characteristics live in the render-free car_dynamics core
+    speed = delegated("dynamics", "speed")
+    velocity_y = delegated("dynamics", "velocity_y")
+    rotation_speed = delegated("dynamics", "rotation_speed")
+    topspeed = delegated("parameters", "topspeed")
+    minspeed = delegated("parameters", "minspeed")
+    acceleration = delegated("parameters", "acceleration")
+    braking_strenth = delegated("parameters", "braking_strength")
+    friction = delegated("parameters", "friction")
+
     def __init__(self, position = (0, 0, 4), rotation = (0, 0, 0), topspeed = 30, acceleration = 0.35, braking_strength = 30, friction = 1.5, camera_speed = 8):
         super().__init__(
             model = "assets/cars/sports-car.obj",
@@ -20,6 +48,20 @@ class Car(Entity):
             rotation = rotation,
         )
 
+        # Physics core
+        self.parameters = CarParameters()
+        self.dynamics = CarState(position, rotation[1])
+        self.dynamics_time = 0
+
+        #   Incremented whenever the car pose changes, sensors memoize their values for the current tick
+        self.sim_tick = 0
+
+        #   In lockstep mode the physics only advances through explicit tick calls, not with the frame time
+        self.lockstep = False
+
+        #   Lost cars are put back on the reset pose, unless their owner handles them (see GameSimulation)
+        self.respawn_when_lost = True
+
         # Controls
         self.controls = "wasd"
 
@@ -39,6 +81,8 @@ class Car(Entity):
 
         self.reset_position = (0, 0, 0)
         self.reset_rotation = (0, 0, 0)
+        self.reset_orientation = (0, 0, 0)
+        self.reset_speed = 0
 
         # Camera Follow
         self.camera_angle = "top"
@@ -78,6 +122,8 @@ class Car(Entity):
         # Collision
         self.copy_normals = False
         self.hitting_wall = False
+        self.use_wall_index = True   # Use the track compiled walls instead of boxcasting the mesh colliders
+        self.use_height_map = True   # Follow the track ground height map, if the track has one
 
 
         self.track = None
@@ -132,6 +178,7 @@ class Car(Entity):
         invoke(self.update_model_path, delay = 1)
 
         self.multiray_sensor = None
+        self.camera_sensor = None
 
     def set_track(self, track):
         self.track = track
@@ -139,6 +186,7 @@ class Car(Entity):
         self.reset_orientation = track.car_default_reset_orientation
         self.position = self.reset_position
         self.rotation_y = self.reset_orientation[1]
+        self.sync_dynamics()
 
     def sports_car(self):
         self.car_type = "sports"
@@ -174,6 +222,9 @@ class Car(Entity):
         if held_keys["v"]:
             self.multiray_sensor.set_enabled_rays(not self.multiray_sensor.enabled)
 
+        if not self.respawn_when_lost:
+            return
+
         # Reset the car's position if y value is less than -100
         if self.y <= -100:
             self.reset_car()
@@ -280,110 +331,80 @@ class Car(Entity):
                 self.velocity_y -= 50 * time.dt
 
 
-    def update(self):
-        # Exit if esc pressed.
-        if held_keys["escape"]:
-            quit()
-
-        self.check_respawn()
-
-        #   Process inputs & update speed
-        if held_keys[self.controls[0]] or held_keys["up arrow"]:
-            self.speed += self.acceleration * time.dt
-            self.driving = True
-
-            self.display_particles()
-        else:
-            self.driving = False
-            if self.speed > 1:
-                self.speed -= self.friction * 5 * time.dt
-            elif self.speed < -1:
-                self.speed += self.friction * 5 * time.dt
-
-        # Braking
-        if held_keys[self.controls[2] or held_keys["down arrow"]]:
-            if self.speed > 0:
-                self.speed -= self.braking_strenth * time.dt
-            else:
-                self.speed -= self.acceleration * time.dt
-            self.braking = True
-        else:
-            self.braking = False
-
-        #   Check physical constrains
-        if self.speed > self.topspeed:
-            self.speed = self.topspeed
-        elif self.speed < self.minspeed:
-            self.speed = self.minspeed
-
-        if held_keys[self.controls[1]] or held_keys["left arrow"] or held_keys[self.controls[3]] or held_keys["right arrow"]:
-            turn_right = held_keys[self.controls[3]] or held_keys["right arrow"]
-            rotation_sign = (1 if turn_right else -1)
-
-            #   Max angular speed
-            normalized_speed = abs(self.speed / self.topspeed)
-            #   function to map unit speed (between 0 and max speed) to a rotation coefficient space.
-            #   Rotation radius is function of speed
-            def rotation_radius(normalized_speed):
-                smallest_radius = 1.5
-                biggest_radius = 25
-                return pow(normalized_speed, 1.5) * (biggest_radius-smallest_radius) + smallest_radius
-
-            #   Get rotation radius
-            radius = rotation_radius(normalized_speed)
-
-            #   Get travelled distance
-            travelled_dist = abs(self.speed * time.dt)
-            #   Project on circle radius & compute angle variation seen from the center of the circle
-            travelled_circle_center_angle = travelled_dist / radius
-            #   Compute variation in Y & X
-            dx = 1 - cos(travelled_circle_center_angle)
-            dy = sin(travelled_circle_center_angle)
-
-            da = atan2(dx, dy) / 3.14159 * 180
-
-            self.rotation_y += da * rotation_sign
+    def read_controls(self):
+        """
+        Returns the (forward, back, left, right) controls currently held
+        """
+        return (held_keys[self.controls[0]] or held_keys["up arrow"],
+                held_keys[self.controls[2]] or held_keys["down arrow"],
+                held_keys[self.controls[1]] or held_keys["left arrow"],
+                held_keys[self.controls[3]] or held_keys["right arrow"])
 
-        #   Integrate speed into movement
-        total_dist_to_move = self.speed * time.dt
+    def cast_obstacles(self, origin, direction, distance):
+        if self.use_wall_index and self.track is not None and self.track.wall_index is not None:
+            return self.track.wall_index.cast(origin, direction, distance)
 
-        #   Check collision via recast
+        front_collision = boxcast(origin = Vec3(*origin), direction = Vec3(*direction), thickness = (0.1, 0.1), distance = distance, ignore = [self, ])
+        if not front_collision.hit:
+            return None
+        return front_collision.distance, front_collision.world_normal
 
+    def ground_sampler(self):
+        """
+        Returns the ground sampling function of the track height map, None if the car should keep its height
+        """
+        if self.use_height_map and self.track is not None and self.track.height_map is not None:
+            return self.track.height_map.sample
+        return None
 
-        #   Return residual distance to travel and residual speed.
-        def move_car(distance_to_travel, direction):
-            front_collision = boxcast(origin = self.world_position, direction = self.forward * direction, thickness = (0.1, 0.1), distance = self.scale_x + distance_to_travel, ignore = [self, ])
+    def sync_dynamics(self):
+        """
+        Copies the entity pose into the physics core, to be called whenever the car is moved from outside the core
+        """
+        self.dynamics.position = tuple(self.position)
+        self.dynamics.rotation_y = self.rotation_y
+        self.sim_tick += 1
 
-            #   Detect collision
-            if front_collision.distance < self.scale_x + distance_to_travel:
-                free_dist = front_collision.distance - self.scale_x + distance_to_travel
+    def tick(self, controls, dt = FIXED_TIMESTEP):
+        """
+        Advances the physics core by one fixed tick and moves the entity accordingly
+        """
+        step(self.dynamics, controls, dt, self.parameters, self.cast_obstacles, self.ground_sampler())
 
-                #   cancel speed going directly into the obstacle
-                next_forward = self.forward - (self.forward.dot(front_collision.world_normal)) * front_collision.world_normal
-                self.speed = self.speed * (0.5 + 0.5 * (self.forward.dot(front_collision.world_normal))) # Loose half speed on collision and some depending on the angle
+        self.position = self.dynamics.position
+        self.rotation_y = self.dynamics.rotation_y
+        self.hitting_wall = self.dynamics.hitting_wall
+        self.sim_tick += 1
 
-                self.rotation_y = atan2(next_forward[0], next_forward[2]) / 3.14159 * 180
-                dist_left_to_travel = distance_to_travel - free_dist
+    def update(self):
+        # Exit if esc pressed.
+        if held_keys["escape"]:
+            quit()
 
-                #   Move car away from obstacle to prevent overlap due to *¦@+!? physics system
-                OBSTACLE_DISPLACEMENT_MARGIN = 1
-                self.x += (front_collision.world_normal * OBSTACLE_DISPLACEMENT_MARGIN).x
-                self.z += (front_collision.world_normal * OBSTACLE_DISPLACEMENT_MARGIN).z
+        self.check_respawn()
 
-                return 0
+        controls = self.read_controls()
+        self.driving = bool(controls[0])
+        self.braking = bool(controls[1])
+        if self.driving:
+            self.display_particles()
 
+        if not self.lockstep:
+            #   Run as many fixed ticks as the elapsed time allows, so the driving does not depend on the frame rate
+            self.dynamics_time += time.dt
+            nbr_ticks = int(self.dynamics_time / FIXED_TIMESTEP)
+            if nbr_ticks > MAX_TICKS_PER_FRAME:
+                nbr_ticks = MAX_TICKS_PER_FRAME
+                self.dynamics_time = 0
             else:
-                self.x += self.forward[0] * distance_to_travel
-                self.z += self.forward[2] * distance_to_travel
-
-                return 0
+                self.dynamics_time -= nbr_ticks * FIXED_TIMESTEP
 
-        for i in range(2):
-            total_dist_to_move = move_car(total_dist_to_move, 1 if self.speed > 0 else -1)
+            for i in range(nbr_ticks):
+                self.tick(controls)
 
-            if total_dist_to_move <= 0:
-                break
+        self.follow_camera()
 
+    def follow_camera(self):
         self.c_pivot.position = self.position
         self.c_pivot.rotation_y = self.rotation_y
         self.update_camera()
@@ -396,15 +417,15 @@ class Car(Entity):
         """
         #   Project car directly on ground when resetting
         self.position = self.reset_position
-        #y_ray = raycast(origin = self.reset_position, direction = (0,-1,0), ignore = [self,])
-        #self.y = y_ray.world_point.y + 1.4
-        print(self.reset_orientation)
+        sample_ground = self.ground_sampler()
+        ground = sample_ground(self.x, self.z) if sample_ground is not None else None
+        if ground is not None:
+            self.y = ground[0] + self.parameters.ground_clearance
         self.rotation_y = self.reset_orientation[1]
 
-        print("reseting at", str(self.position), " --> ", self.rotation_y)
-
         camera.world_rotation_y = self.rotation_y
-        self.speed = 0
+        self.sync_dynamics()
+        self.speed = self.reset_speed
         self.velocity_y = 0
         self.timer_running = False
         for trail in self.trails:
@@ -412,6 +433,57 @@ class Car(Entity):
                 trail.end_trail()
         self.start_trail = True
 
+    def save_state(self):
+        """
+        Packs the complete car state (kinematics, controls, reset pose and speed, tick timing and ray sensing) into a
+        compact binary blob
+        """
+        ray_distances = self.multiray_sensor.collect_sensor_values() if self.multiray_sensor is not None else []
+        rays_visible = self.multiray_sensor is not None and self.multiray_sensor.enabled
+
+        return (self.dynamics.pack() +
+                CAR_STATE_STRUCT.pack(*(bool(c) for c in self.read_controls()), *self.reset_position,
+                                      self.reset_orientation[1], self.reset_speed, self.dynamics_time, rays_visible,
+                                      len(ray_distances)) +
+                np.asarray(ray_distances, dtype = ">f4").tobytes())
+
+    def load_state(self, data):
+        """
+        Restores a state produced by save_state
+        """
+        header_size = CarState.STRUCT.size + CAR_STATE_STRUCT.size
+        if len(data) < header_size:
+            raise ValueError("Invalid car state of %d bytes, at least %d expected" % (len(data), header_size))
+        nbr_rays = CAR_STATE_STRUCT.unpack_from(data, CarState.STRUCT.size)[-1]
+        if len(data) != header_size + 4 * nbr_rays:
+            raise ValueError("Invalid car state of %d bytes, %d expected for %d rays" %
+                             (len(data), header_size + 4 * nbr_rays, nbr_rays))
+
+        offset = self.dynamics.unpack(data)
+        (forward, back, left, right, x, y, z, reset_angle, reset_speed, dynamics_time,
+         rays_visible, nbr_rays) = CAR_STATE_STRUCT.unpack_from(data, offset)
+        offset += CAR_STATE_STRUCT.size
+        ray_distances = np.frombuffer(data, ">f4", nbr_rays, offset)
+
+        held_keys[self.controls[0]] = forward
+        held_keys[self.controls[1]] = left
+        held_keys[self.controls[2]] = back
+        held_keys[self.controls[3]] = right
+
+        self.reset_position = (x, y, z)
+        self.reset_orientation = (0, reset_angle, 0)
+        self.reset_speed = reset_speed
+
+        self.position = self.dynamics.position
+        self.rotation_y = self.dynamics.rotation_y
+        self.sim_tick += 1
+
+        if self.multiray_sensor is not None:
+            self.multiray_sensor.set_enabled_rays(rays_visible)
+            self.multiray_sensor.restore_sensor_values(ray_distances)
+        self.dynamics_time = dynamics_time
+        self.follow_camera()
+
     def simple_intersects(self, entity):
         """
         A faster AABB intersects for detecting collision with
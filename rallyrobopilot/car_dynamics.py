@@ -0,0 +1,212 @@
+"""
+    Render-free car dynamics.
+
+    This is the driving model of Car.update without any Ursina dependency: a plain CarState holding the kinematic
+    values of a car and a step function advancing it by a fixed amount of time for a given set of controls.
+    Car is a view over these objects, so headless runs and the GUI share the exact same physics.
+"""
+from math import sin, cos, atan2, radians, pow
+import struct
+
+#   Time advanced by one physics tick (seconds)
+FIXED_TIMESTEP = 1 / 60
+
+#   Controls are (forward, back, left, right) tuples, the same ordering as SensingSnapshot.current_controls
+CONTROL_FORWARD = 0
+CONTROL_BACK = 1
+CONTROL_LEFT = 2
+CONTROL_RIGHT = 3
+
+#   Distance the car is pushed away from an obstacle after a collision
+OBSTACLE_DISPLACEMENT_MARGIN = 1
+
+
+class CarParameters:
+    def __init__(self, topspeed = 50, minspeed = -15, acceleration = 25, braking_strength = 50, friction = 1.5,
+                 smallest_radius = 1.5, biggest_radius = 25, half_length = 1, ground_clearance = 1.4, ground_reach = 1.7,
+                 gravity = 50):
+        self.topspeed = topspeed
+        self.minspeed = minspeed
+        self.acceleration = acceleration
+        self.braking_strength = braking_strength
+        self.friction = friction
+
+        #   Turning radius at null and top speed
+        self.smallest_radius = smallest_radius
+        self.biggest_radius = biggest_radius
+
+        #   Distance between the car center and its bumper, used for collision checks
+        self.half_length = half_length
+
+        #   Height of the car center above the ground, distance below which the car touches the ground and fall speed gain
+        self.ground_clearance = ground_clearance
+        self.ground_reach = ground_reach
+        self.gravity = gravity
+
+    def rotation_radius(self, normalized_speed):
+        """
+        Maps unit speed (between 0 and top speed) to the turning radius
+        """
+        return pow(normalized_speed, 1.5) * (self.biggest_radius - self.smallest_radius) + self.smallest_radius
+
+
+class CarState:
+    #   Binary layout of pack/unpack: position, rotation_y, speed, rotation_speed, velocity_y
+    STRUCT = struct.Struct(">7d")
+
+    def __init__(self, position = (0, 0, 0), rotation_y = 0, speed = 0, rotation_speed = 0, velocity_y = 0):
+        self.x, self.y, self.z = position
+        self.rotation_y = rotation_y
+        self.speed = speed
+        self.rotation_speed = rotation_speed
+        self.velocity_y = velocity_y
+
+        #   Whether the last step ended against a wall or steep slope of the ground, not packed as steps recompute it
+        self.hitting_wall = False
+
+    @property
+    def position(self):
+        return (self.x, self.y, self.z)
+
+    @position.setter
+    def position(self, value):
+        self.x, self.y, self.z = value
+
+    def forward(self):
+        angle = radians(self.rotation_y)
+        return (sin(angle), 0, cos(angle))
+
+    def pack(self):
+        return CarState.STRUCT.pack(self.x, self.y, self.z, self.rotation_y, self.speed, self.rotation_speed, self.velocity_y)
+
+    def unpack(self, data, offset = 0):
+        """
+        Reads the state packed at offset in data and returns the offset following it
+        """
+        (self.x, self.y, self.z, self.rotation_y, self.speed,
+         self.rotation_speed, self.velocity_y) = CarState.STRUCT.unpack_from(data, offset)
+        return offset + CarState.STRUCT.size
+
+    def copy(self):
+        state = CarState(self.position, self.rotation_y, self.speed, self.rotation_speed, self.velocity_y)
+        state.hitting_wall = self.hitting_wall
+        return state
+
+    def __repr__(self):
+        return "CarState(position=%s, rotation_y=%s, speed=%s)" % (self.position, self.rotation_y, self.speed)
+
+
+DEFAULT_PARAMETERS = CarParameters()
+
+
+def step(state, controls, dt = FIXED_TIMESTEP, parameters = DEFAULT_PARAMETERS, cast_obstacles = None, sample_ground = None):
+    """
+    Advances state in place by dt seconds and returns it.
+
+    Args:
+        state (CarState): The car to move.
+        controls (tuple): (forward, back, left, right) booleans.
+        dt (float): Duration of the step in seconds.
+        parameters (CarParameters): Engine and steering characteristics of the car.
+        cast_obstacles (callable): cast_obstacles(origin, direction, distance) returns (hit_distance, world_normal) of
+            the first obstacle found along the ray, or None. Obstacles are ignored when not provided.
+        sample_ground (callable): sample_ground(x, z) returns (height, normal) of the ground below the car, or None
+            where there is no ground, the car then falls. The car keeps its height when not provided.
+    """
+    forward, back, left, right = controls[:4]
+
+    #   Process inputs & update speed
+    if forward:
+        state.speed += parameters.acceleration * dt
+    else:
+        if state.speed > 1:
+            state.speed -= parameters.friction * 5 * dt
+        elif state.speed < -1:
+            state.speed += parameters.friction * 5 * dt
+
+    #   Braking
+    if back:
+        if state.speed > 0:
+            state.speed -= parameters.braking_strength * dt
+        else:
+            state.speed -= parameters.acceleration * dt
+
+    #   Check physical constrains
+    if state.speed > parameters.topspeed:
+        state.speed = parameters.topspeed
+    elif state.speed < parameters.minspeed:
+        state.speed = parameters.minspeed
+
+    if left or right:
+        rotation_sign = (1 if right else -1)
+
+        #   Rotation radius is function of speed
+        radius = parameters.rotation_radius(abs(state.speed / parameters.topspeed))
+
+        #   Project travelled distance on circle radius & compute angle variation seen from the center of the circle
+        travelled_circle_center_angle = abs(state.speed * dt) / radius
+        dx = 1 - cos(travelled_circle_center_angle)
+        dy = sin(travelled_circle_center_angle)
+
+        state.rotation_y += atan2(dx, dy) / 3.14159 * 180 * rotation_sign
+
+    #   Integrate speed into movement
+    move(state, state.speed * dt, 1 if state.speed > 0 else -1, parameters, cast_obstacles)
+
+    if sample_ground is not None:
+        state.hitting_wall = settle(state, sample_ground(state.x, state.z), dt, parameters)
+
+    return state
+
+
+def settle(state, ground, dt = FIXED_TIMESTEP, parameters = DEFAULT_PARAMETERS):
+    """
+    Keeps the car on the ground below it, or lets it fall, off the track when there is no ground (None). Returns whether
+    the car is hitting a wall or steep slope.
+    """
+    if ground is not None:
+        height, normal = ground
+
+        #   Check if car is hitting the ground
+        if state.y - height <= parameters.ground_reach + abs(state.velocity_y * dt):
+            state.velocity_y = 0
+            if normal[1] > 0.7 and height - state.y < 0.5:
+                state.y = height + parameters.ground_clearance
+                return False
+            return True
+
+    state.y += state.velocity_y * dt
+    state.velocity_y -= parameters.gravity * dt
+    return False
+
+
+def move(state, distance_to_travel, direction, parameters = DEFAULT_PARAMETERS, cast_obstacles = None):
+    """
+    Moves the car along its forward axis, sliding along the first obstacle hit if any
+    """
+    forward_x, _, forward_z = state.forward()
+
+    if cast_obstacles is not None:
+        reach = parameters.half_length + distance_to_travel
+        hit = cast_obstacles(state.position, (forward_x * direction, 0, forward_z * direction), reach)
+
+        #   Detect collision
+        if hit is not None and hit[0] < reach:
+            normal_x, _, normal_z = hit[1]
+            alignment = forward_x * normal_x + forward_z * normal_z
+
+            #   Cancel speed going directly into the obstacle
+            next_forward_x = forward_x - alignment * normal_x
+            next_forward_z = forward_z - alignment * normal_z
+            state.speed = state.speed * (0.5 + 0.5 * alignment) # Loose half speed on collision and some depending on the angle
+
+            state.rotation_y = atan2(next_forward_x, next_forward_z) / 3.14159 * 180
+
+            #   Move car away from obstacle to prevent overlap
+            state.x += normal_x * OBSTACLE_DISPLACEMENT_MARGIN
+            state.z += normal_z * OBSTACLE_DISPLACEMENT_MARGIN
+            return state
+
+    state.x += forward_x * distance_to_travel
+    state.z += forward_z * distance_to_travel
+    return state
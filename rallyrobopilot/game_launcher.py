@@ -1,12 +1,32 @@
-from rallyrobopilot import Car, Track, SunLight, MultiRaySensor
+from .car import Car
+from .track import Track
+from .sun import SunLight
+from .raycast_sensor import MultiRaySensor
+from .camera_sensor import CameraSensor, RamImageReader
 from ursina import *
+from panda3d.core import loadPrcFileData
 
+#   Window captures are converted into reused buffers
+screen_reader = RamImageReader()
 
-def prepare_game_app():
+
+def grab_screen_image():
+    """
+    Returns the last rendered frame of the main window as a (height, width, 3) uint8 array
+    """
+    tex = base.win.getDisplayRegion(0).getScreenshot()
+    return screen_reader.read(tex)
+
+
+def prepare_game_app(track_name = "VisualTrack", offscreen = False):
     from ursina import window, Ursina
+
+    if offscreen:
+        #   Render into an offscreen buffer instead of opening a window
+        loadPrcFileData("", "window-type offscreen")
     
     # Create Window
-    window.vsync = True # Set to false to uncap FPS limit of 60
+    window.vsync = not offscreen # Set to false to uncap FPS limit of 60
     app = Ursina(size=(1280,1024))
     print("Asset folder")
     print(application.asset_folder)
@@ -30,7 +50,6 @@ def prepare_game_app():
     global_texs = [ "assets/cars/garage/sports-car/sports-red.png", "sports-blue.png", "sports-green.png", "sports-orange.png", "sports-white.png", "particle_forest_track.png", "red.png"]
     
     # load assets
-    track_name = "VisualTrack"
     track = Track(track_name)
     print("loading assets after track creation")
     track.load_assets(global_models, global_texs)
@@ -42,8 +61,11 @@ def prepare_game_app():
     car.set_track(track)
     
     
-    car.multiray_sensor = MultiRaySensor(car, 15, 90)
+    car.multiray_sensor = MultiRaySensor(car)
     car.multiray_sensor.enable()
+
+    #   Low resolution camera rendering the sensing images offscreen
+    car.camera_sensor = CameraSensor(car)
     
     # Lighting + shadows
     sun = SunLight(direction = (-0.7, -0.9, 0.5), resolution = 3072, car = car)
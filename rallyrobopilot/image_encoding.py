@@ -0,0 +1,127 @@
+"""
+    Snapshot image encodings, chosen per connection with 'set image encoding raw|jpeg|png|delta;'
+
+    raw     pixels as rendered
+    jpeg    lossy JPEG, quality set with 'set image quality q;'
+    png     lossless PNG
+    delta   XOR against the previous frame of the connection, zlib compressed. Keyframes (first frame, size change or
+            encoding change) are the zlib compressed frame itself. Delta frames must be decoded in order.
+
+    Images are (height, width, channels) arrays of uint8 or float16 pixels (see image_preprocessing). JPEG and PNG only
+    apply to uint8 images, float images are sent raw instead.
+"""
+import zlib
+
+import imageio.v3 as iio
+import numpy as np
+
+IMAGE_RAW = 0
+IMAGE_JPEG = 1
+IMAGE_PNG = 2
+IMAGE_DELTA = 3
+IMAGE_DELTA_KEYFRAME = 4
+
+IMAGE_ENCODINGS = {
+    b'raw': IMAGE_RAW,
+    b'jpeg': IMAGE_JPEG,
+    b'png': IMAGE_PNG,
+    b'delta': IMAGE_DELTA,
+}
+
+#   Pixel type codes of the snapshots, float images are sent as little endian float16
+FLOAT_PIXEL_TYPE = np.dtype("<f2")
+PIXEL_TYPES = [np.dtype(np.uint8), FLOAT_PIXEL_TYPE]
+
+DEFAULT_JPEG_QUALITY = 90
+
+#   Fast compression levels, encoding runs once per snapshot
+PNG_COMPRESSION_LEVEL = 1
+DELTA_COMPRESSION_LEVEL = 1
+
+
+def check_quality(quality):
+    if not 1 <= quality <= 100:
+        raise ValueError("JPEG quality must be within [1, 100], got %d" % quality)
+
+
+def squeeze_channels(image):
+    #   Single channel images are written as grayscale
+    return image[:, :, 0] if image.shape[2] == 1 else image
+
+
+class ImageEncoder:
+    def __init__(self, encoding = IMAGE_RAW, quality = DEFAULT_JPEG_QUALITY):
+        self.encoding = encoding
+        self.quality = quality
+
+        #   Bytes of the last frame sent with the delta encoding, its shape and pixel type, and reused XOR buffer
+        self.previous = None
+        self.previous_format = None
+        self.delta = None
+
+    def set_encoding(self, encoding = None, quality = None):
+        if encoding is not None:
+            self.encoding = encoding
+            self.previous = None
+        if quality is not None:
+            check_quality(quality)
+            self.quality = quality
+
+    def encode(self, image):
+        """
+        Returns the encoding of the (height, width, channels) image and its encoded bytes
+        """
+        image = np.ascontiguousarray(image)
+        compressed_image = self.encoding in (IMAGE_JPEG, IMAGE_PNG) and image.dtype == np.uint8
+        if self.encoding == IMAGE_RAW or (self.encoding != IMAGE_DELTA and not compressed_image):
+            return IMAGE_RAW, memoryview(image).cast("B")
+
+        elif self.encoding == IMAGE_JPEG:
+            return IMAGE_JPEG, iio.imwrite("<bytes>", squeeze_channels(image), extension = ".jpg", quality = self.quality)
+
+        elif self.encoding == IMAGE_PNG:
+            return IMAGE_PNG, iio.imwrite("<bytes>", squeeze_channels(image), extension = ".png",
+                                          compress_level = PNG_COMPRESSION_LEVEL)
+
+        #   XOR on the pixel bytes, whatever the pixel type
+        frame = image.view(np.uint8)
+        if self.previous is None or self.previous_format != (image.shape, image.dtype):
+            self.previous = frame.copy()
+            self.previous_format = (image.shape, image.dtype)
+            self.delta = np.empty_like(self.previous)
+            return IMAGE_DELTA_KEYFRAME, zlib.compress(self.previous, DELTA_COMPRESSION_LEVEL)
+
+        np.bitwise_xor(frame, self.previous, out = self.delta)
+        np.copyto(self.previous, frame)
+        return IMAGE_DELTA, zlib.compress(self.delta, DELTA_COMPRESSION_LEVEL)
+
+
+class ImageDecoder:
+    def __init__(self):
+        #   Bytes of the last decoded frame, reference of the next delta frame
+        self.previous = None
+
+    def decode(self, encoding, height, width, data, channels = 3, pixel_type = np.uint8):
+        """
+        Returns the (height, width, channels) image of pixel_type encoded in data
+        """
+        pixel_type = np.dtype(pixel_type)
+        shape = (height, width, channels)
+        if encoding == IMAGE_RAW:
+            return np.frombuffer(data, pixel_type, height * width * channels).reshape(shape)
+
+        elif encoding == IMAGE_JPEG or encoding == IMAGE_PNG:
+            return iio.imread(bytes(data), extension = ".jpg" if encoding == IMAGE_JPEG else ".png").reshape(shape)
+
+        elif encoding == IMAGE_DELTA_KEYFRAME:
+            self.previous = np.frombuffer(zlib.decompress(data), np.uint8)
+            return self.previous.view(pixel_type).reshape(shape)
+
+        elif encoding == IMAGE_DELTA:
+            delta = np.frombuffer(zlib.decompress(data), np.uint8)
+            if self.previous is None or self.previous.shape != delta.shape:
+                raise ValueError("Delta image received without its keyframe")
+            self.previous = np.bitwise_xor(delta, self.previous)
+            return self.previous.view(pixel_type).reshape(shape)
+
+        raise ValueError("Unknown image encoding %d" % encoding)
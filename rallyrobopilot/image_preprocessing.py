@@ -0,0 +1,78 @@
+"""
+    Snapshot image preprocessing, configured per connection with 'set image crop|downscale|color|format ...;'
+
+    Applied in order: region of interest crop, area averaged downscale by an integer factor, grayscale conversion and
+    uint8 -> float16 conversion to [0, 1]. Images stay (height, width, channels) arrays, with 1 channel once grayscale.
+"""
+import numpy as np
+
+from .image_encoding import FLOAT_PIXEL_TYPE
+
+#   ITU-R BT.601 luma weights
+GRAYSCALE_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype = np.float32)
+
+
+class ImagePreprocessor:
+    def __init__(self):
+        #   (x, y, width, height) in pixels from the top left corner, None for the whole image
+        self.crop = None
+        self.downscale = 1
+        self.grayscale = False
+        self.normalize = False
+
+    def configure(self, crop = None, downscale = None, grayscale = None, normalize = None):
+        """
+        Parameters left to None are kept, crop is reset to the whole image with an empty tuple
+        """
+        if crop is not None:
+            if len(crop) > 0 and (min(crop) < 0 or crop[2] < 1 or crop[3] < 1):
+                raise ValueError("Invalid crop region %s" % str(crop))
+            self.crop = tuple(crop) if len(crop) > 0 else None
+        if downscale is not None:
+            if downscale < 1:
+                raise ValueError("Downscale factor must be at least 1, got %d" % downscale)
+            self.downscale = downscale
+        if grayscale is not None:
+            self.grayscale = grayscale
+        if normalize is not None:
+            self.normalize = normalize
+
+    def is_identity(self):
+        return self.crop is None and self.downscale == 1 and not self.grayscale and not self.normalize
+
+    def process(self, image):
+        """
+        Returns the preprocessed version of the (height, width, 3) uint8 image, the image itself when there is nothing
+        to do
+        """
+        if self.is_identity():
+            return image
+
+        if self.crop is not None:
+            x, y, w, h = self.crop
+            cropped = image[y:y + h, x:x + w]
+            if cropped.size == 0:
+                raise ValueError("Crop region %s out of the %dx%d image" % (str(self.crop), image.shape[1], image.shape[0]))
+            image = cropped
+
+        #   Downscaling drops the right and bottom pixels that do not fill a whole block
+        k = self.downscale
+        if k > 1:
+            h, w = image.shape[0] // k, image.shape[1] // k
+            if h == 0 or w == 0:
+                raise ValueError("Image of size %dx%d too small to be downscaled by %d" % (image.shape[1], image.shape[0], k))
+            #   k x k strided sums, several times faster than averaging a (h, k, w, k, c) reshape
+            blocks = np.zeros((h, w, image.shape[2]), np.float32)
+            for i in range(k):
+                for j in range(k):
+                    blocks += image[i:h * k:k, j:w * k:k]
+            image = blocks * np.float32(1 / (k * k))
+
+        if self.grayscale:
+            image = np.matmul(image, GRAYSCALE_WEIGHTS, dtype = np.float32)[:, :, np.newaxis]
+
+        if self.normalize:
+            return (image * np.float32(1 / 255)).astype(FLOAT_PIXEL_TYPE)
+        if image.dtype != np.uint8:
+            return np.rint(image).astype(np.uint8)
+        return np.ascontiguousarray(image)
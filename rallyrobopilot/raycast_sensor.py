@@ -1,8 +1,12 @@
 
 
 from ursina import *
+import numpy as np
 
-MAX_RAYCAST_DIST = 100
+from .track_geometry import fan_angles, fan_directions, DEFAULT_NBR_RAYS, DEFAULT_HALF_ANGLE, MAX_RAYCAST_DIST, RAY_HEIGHT
+
+#   Visible rays are refreshed at the remote sensing rate at most, drawing them does not trigger casts every frame
+RAY_DISPLAY_PERIOD = 0.1
 
 class SingleRaySensor(Entity):
     def __init__(self, car, angle):
@@ -20,36 +24,108 @@ class SingleRaySensor(Entity):
 
     def cast_ray(self):
         #self.world_position = self.car.world_position
-        cast = raycast(origin = self.world_position + (0,1,0), direction = self.forward, distance = MAX_RAYCAST_DIST, ignore = [self.car,])
-
-        return cast.distance if cast.hit else MAX_RAYCAST_DIST
+        cast = raycast(origin = self.world_position + (0,self.car.ray_height,0), direction = self.forward, distance = self.car.max_distance, ignore = [self.car,])
 
+        return cast.distance if cast.hit else self.car.max_distance
 
-    def update(self):
-        if self.visible:
-            self.sensing_dist = self.cast_ray()
-            self.scale_z = self.sensing_dist
+    def set_sensing_dist(self, distance):
+        self.sensing_dist = distance
+        self.scale_z = distance
 
 
 class MultiRaySensor(Entity):
-    def __init__(self, car, nbr_ray, half_angle):
+    def __init__(self, car, nbr_ray = DEFAULT_NBR_RAYS, half_angle = DEFAULT_HALF_ANGLE, max_distance = MAX_RAYCAST_DIST, ray_height = RAY_HEIGHT):
         super().__init__(
             parent = car,
         )
         self.car = car
         self.half_angle = half_angle
+        self.max_distance = max_distance
+        self.ray_height = ray_height
 
         self.rays = []
-        for i in range(nbr_ray):
-            ray = SingleRaySensor(self, -half_angle + 2 * half_angle / (nbr_ray-1) * i)
+        self.create_rays(nbr_ray)
+
+        #   Ray distances memoized for the car tick they were cast at
+        self.cached_distances = None
+        self.cached_tick = None
+        self.cast_time = 0
+        self.displayed_tick = None
+
+    def create_rays(self, nbr_ray):
+        for ray in self.rays:
+            destroy(ray)
+
+        self.rays = []
+        for angle in fan_angles(nbr_ray, self.half_angle).tolist():
+            ray = SingleRaySensor(self, angle)
             ray.enable()
+            ray.visible = self.enabled
             self.rays.append(ray)
 
-    def collect_sensor_values(self):
-        if self.enabled:
-            return [r.sensing_dist for r in self.rays]
-        else:
-            return [r.cast_ray() for r in self.rays]
+    def configure(self, nbr_rays = None, half_angle = None, max_distance = None, ray_height = None):
+        """
+        Changes the sensor layout, parameters left to None are kept
+        """
+        if nbr_rays is not None and nbr_rays < 1:
+            raise ValueError("A ray sensor needs at least one ray, got %d" % nbr_rays)
+        if max_distance is not None and max_distance <= 0:
+            raise ValueError("Ray distance must be positive, got %f" % max_distance)
+
+        if half_angle is not None:
+            self.half_angle = half_angle
+        if max_distance is not None:
+            self.max_distance = max_distance
+        if ray_height is not None:
+            self.ray_height = ray_height
+        self.create_rays(nbr_rays if nbr_rays is not None else len(self.rays))
+
+        self.cached_distances = None
+        self.cached_tick = None
+        self.displayed_tick = None
+
+    def cast_rays(self):
+        """
+        Casts every ray of the sensor, in one batched query against the track walls when available, and returns the
+        distances as an (R,) float32 array
+        """
+        track = self.car.track
+        if track is None or track.wall_index is None or not self.car.use_wall_index:
+            return np.array([r.cast_ray() for r in self.rays], dtype = np.float32)
+
+        origin = np.array(tuple(self.car.world_position)) + (0, self.ray_height, 0)
+        directions = fan_directions(self.car.rotation_y, len(self.rays), self.half_angle)[0]
+        return track.wall_index.cast_rays(np.tile(origin, (len(self.rays), 1)), directions, self.max_distance).astype(np.float32)
+
+    def update(self):
+        #   Only runs while the rays are visible: draw the memoized distances, casting only if nobody did recently
+        if self.cached_tick != self.car.sim_tick and time.time() - self.cast_time >= RAY_DISPLAY_PERIOD:
+            self.collect_sensor_values()
+
+        if self.cached_distances is not None and self.displayed_tick != self.cached_tick:
+            for ray, distance in zip(self.rays, self.cached_distances.tolist()):
+                ray.set_sensing_dist(distance)
+            self.displayed_tick = self.cached_tick
+
+    def collect_sensor_values(self, recompute = False):
+        """
+        Returns the ray distances at the current car tick, cast on the first request of the tick and memoized for the
+        next ones. recompute forces a new cast.
+        """
+        if recompute or self.cached_tick != self.car.sim_tick:
+            self.cached_distances = self.cast_rays()
+            self.cached_tick = self.car.sim_tick
+            self.cast_time = time.time()
+
+        return self.cached_distances.copy()
+
+    def restore_sensor_values(self, distances):
+        """
+        Sets the memoized distances of the current car tick, e.g. when loading a saved state
+        """
+        if len(distances) == len(self.rays):
+            self.cached_distances = np.array(distances, dtype = np.float32)
+            self.cached_tick = self.car.sim_tick
 
     def set_enabled_rays(self, enable):
         if enable:
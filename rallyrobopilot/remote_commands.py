@@ -6,25 +6,114 @@ Remote control protocol
 #   Car controls
 'push|release forward|left|right|back;'
 
+#   Ray sensor
+'set ray visible|hidden;'
+'set ray count n;' n is the number of rays of the sensor
+'set ray angle a;' a is the half angle of the ray fan in degrees, rays are spread over [-a, a] around the car heading
+'set ray distance d;' d is the maximum sensing distance, returned when a ray hits nothing
+'set ray height h;' h is the height of the rays origin above the car center
+
+#   Camera sensor
+'set camera size w h;' w/h are the integer width and height of the sensing images
+'set camera fov f;' f is the horizontal field of view in degrees
+'set camera position x,y,z;' mount point relative to the car
+'set camera rotation x,y,z;' mount orientation relative to the car, in degrees
+'set camera sensor|window;' snapshot images come from the sensing camera (default) or from the game window
+
+#   Sensing rates
+'set sensing controls|pose|rays|image|depth|labels r;' r is the rate in Hz at which the field is sent, 0 to never send it
+'set sensing controls|pose|rays|image|depth|labels default;' the field is sent with every snapshot (10 Hz, or every step reply in lockstep mode)
+    depth and labels are not sent unless asked for
+
+#   Image encoding, per connection
+'set image encoding raw|jpeg|png|delta;' raw pixels (default), lossy JPEG, lossless PNG or zlib compressed XOR against the previous image
+'set image quality q;' q is the JPEG quality, integer within [1, 100]
+
+#   Image preprocessing, per connection, applied in this order before encoding
+'set image crop x y w h;' keeps the w x h integer pixels region whose top left corner is (x, y)
+'set image crop full;' keeps the whole image (default)
+'set image downscale k;' averages blocks of k x k pixels, k integer (1 by default)
+'set image color rgb|gray;' sends RGB (default) or single channel grayscale images
+'set image format uint8|float16;' sends uint8 pixels (default) or float16 pixels within [0, 1]
+
 #   set reset parameters
 'set position x,y,z;' x/y/z are english style floats (with dot for decimal separator)
-'set speed x,y,z;' x/y/z are english style floats (with dot for decimal separator)
+'set speed v;' v is the signed speed given to the car on reset
+'set speed x,y,z;' x/y/z are english style floats (with dot for decimal separator), only the norm is used
 'set rotation a;' a is an angle in degreees
 'reset;'
 
+#   Lockstep simulation
+'set mode lockstep|realtime;' in lockstep mode the simulation only advances on step requests
+'step k;' advances the simulation by k >= 1 fixed ticks (1 if omitted) and replies with one snapshot, only in lockstep mode
+
+#   Simulation state
+'save state name;' stores the complete car and sensor state under name ('default' if omitted)
+'load state name;' restores the state stored under name
+
+#   Binary command frames
+'set protocol binary|text;' accepts binary command frames in the command stream from now on, or stops accepting them.
+    Snapshots then carry the sequence number of the last applied frame.
+A frame is COMMAND_FRAME packed, starting with the COMMAND_FRAME_MAGIC byte that no text command contains:
+    flags       controls mask (FRAME_FORWARD | FRAME_BACK | FRAME_LEFT | FRAME_RIGHT), FRAME_RESET to reset the car
+    ticks       number of fixed ticks to step, as 'step ticks;' (0 to not step)
+    sequence    echoed by the snapshots
+    x, y, z, rotation, speed    reset pose, used with FRAME_RESET
+Text commands keep working between frames.
+
+#   Shared memory transport, for clients on the simulator host
+'set transport shared name n s;' snapshots are written into the shared memory ring name of n slots of s bytes (see
+    shared_ring, at most MAX_SHARED_MEMORY_SIZE bytes), the socket only carries their slot and sequence. Snapshots larger than a slot still go through the
+    socket.
+'set transport socket;' snapshots go through the socket again (default)
+
+#   Clients
+'set role control|observe;' takes the control authority if no other client holds it, or gives it up
+    A new client gets the control authority if no other client holds it. Other clients observe: they only receive
+    snapshots and their 'set sensing|image|protocol|transport|role' commands, which only affect their own connection.
+
 #   Data message
 'r' <-- car reset
 'd' <-- data frame coming
 """
+import struct
+from collections import deque
+
+#   Magic, flags, ticks, sequence, reset position, rotation and speed
+COMMAND_FRAME = struct.Struct(">BBHIfffff")
+COMMAND_FRAME_MAGIC = 0xB7
+
+#   Frame flags, the controls follow the (forward, back, left, right) ordering
+FRAME_FORWARD = 1
+FRAME_BACK = 2
+FRAME_LEFT = 4
+FRAME_RIGHT = 8
+FRAME_RESET = 16
+
+
+def pack_command_frame(sequence, controls = (0, 0, 0, 0), reset_pose = None, ticks = 0):
+    """
+    Returns the binary command frame holding the (forward, back, left, right) controls. reset_pose is None or a
+    ((x, y, z), rotation, speed) tuple to reset the car to.
+    """
+    flags = sum(flag for flag, control in zip((FRAME_FORWARD, FRAME_BACK, FRAME_LEFT, FRAME_RIGHT), controls) if control)
+    position, rotation, speed = (0, 0, 0), 0, 0
+    if reset_pose is not None:
+        flags |= FRAME_RESET
+        position, rotation, speed = reset_pose
+    return COMMAND_FRAME.pack(COMMAND_FRAME_MAGIC, flags, ticks, sequence & 0xFFFFFFFF, *position, rotation, speed)
+
 
 def equals(p1):
     def inner_is(p2):
         return p1 == p2, p1
+    inner_is.values = (p1,)
     return inner_is
 
 def contains(*values):
     def inner_contains(value):
         return value in values, value
+    inner_contains.values = values
     return inner_contains
 
 def float_tuple(x):
@@ -36,6 +125,19 @@ def float_tuple(x):
     except Exception as err:
         return False, (0,0,0)
 
+def is_int(x):
+    try:
+        return True, int(x)
+    except Exception as err:
+        return False, 0
+
+def is_positive_int(x):
+    valid, value = is_int(x)
+    return valid and value > 0, value
+
+def is_word(x):
+    return len(x) > 0, x
+
 def is_float(x):
     try:
         return True, float(x)
@@ -49,7 +151,8 @@ class RemoteControlCommand:
 
     def parse(self, command_words):
         parsed_command = []
-        if len(self.params) > len(command_words):
+        #   Trailing words are not ignored, 'step abc;' must not match 'step;'
+        if len(self.params) != len(command_words):
             return None
 
         for pid, param in enumerate(self.params):
@@ -71,47 +174,115 @@ remote_control_commands = [
     #   Reset parameters command
     RemoteControlCommand(equals(b'set'), contains(b"position", b"speed"), float_tuple),
     RemoteControlCommand(equals(b'set'), equals(b"rotation"), is_float),
-    RemoteControlCommand(equals(b'set'), equals(b"ray"), contains(b'visible', b'hidden'))
+    RemoteControlCommand(equals(b'set'), equals(b"speed"), is_float),
+    RemoteControlCommand(equals(b'set'), equals(b"ray"), contains(b'visible', b'hidden')),
+    RemoteControlCommand(equals(b'set'), equals(b"ray"), equals(b"count"), is_int),
+    RemoteControlCommand(equals(b'set'), equals(b"ray"), contains(b"angle", b"distance", b"height"), is_float),
+    #   Camera sensor
+    RemoteControlCommand(equals(b'set'), equals(b"camera"), equals(b"size"), is_int, is_int),
+    RemoteControlCommand(equals(b'set'), equals(b"camera"), equals(b"fov"), is_float),
+    RemoteControlCommand(equals(b'set'), equals(b"camera"), contains(b"position", b"rotation"), float_tuple),
+    RemoteControlCommand(equals(b'set'), equals(b"camera"), contains(b"sensor", b"window")),
+    #   Sensing rates
+    RemoteControlCommand(equals(b'set'), equals(b"sensing"), contains(b'controls', b'pose', b'rays', b'image', b'depth', b'labels'), is_float),
+    RemoteControlCommand(equals(b'set'), equals(b"sensing"), contains(b'controls', b'pose', b'rays', b'image', b'depth', b'labels'), equals(b'default')),
+    #   Image encoding
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"encoding"), contains(b'raw', b'jpeg', b'png', b'delta')),
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"quality"), is_int),
+    #   Image preprocessing
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"crop"), is_int, is_int, is_int, is_int),
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"crop"), equals(b"full")),
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"downscale"), is_int),
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"color"), contains(b'rgb', b'gray')),
+    RemoteControlCommand(equals(b'set'), equals(b"image"), equals(b"format"), contains(b'uint8', b'float16')),
+    #   Lockstep simulation
+    RemoteControlCommand(equals(b'set'), equals(b"mode"), contains(b'lockstep', b'realtime')),
+    RemoteControlCommand(equals(b'step'), is_positive_int),
+    RemoteControlCommand(equals(b'step')),
+    #   Binary command frames
+    RemoteControlCommand(equals(b'set'), equals(b"protocol"), contains(b'binary', b'text')),
+    #   Shared memory transport
+    RemoteControlCommand(equals(b'set'), equals(b"transport"), equals(b"shared"), is_word, is_int, is_int),
+    RemoteControlCommand(equals(b'set'), equals(b"transport"), equals(b"socket")),
+    #   Clients
+    RemoteControlCommand(equals(b'set'), equals(b"role"), contains(b'control', b'observe')),
+    #   Simulation state
+    RemoteControlCommand(contains(b'save', b'load'), equals(b"state"), is_word),
+    RemoteControlCommand(contains(b'save', b'load'), equals(b"state"))
 ]
 
+#   First word --> patterns starting with it, in the remote_control_commands order
+command_patterns = {}
+for command_pattern in remote_control_commands:
+    for first_word in command_pattern.params[0].values:
+        command_patterns.setdefault(first_word, []).append(command_pattern)
+
 class RemoteCommandParser:
+    """
+    Splits the received bytes into commands, queued until parsed. Each received byte is scanned once.
+    """
     def __init__(self):
-        self.pending_data = b''
-        self.command_words = []
+        #   Received bytes not tokenized yet: an incomplete command or frame
+        self.pending_data = bytearray()
+        #   Command words lists, and binary frames as tuples
+        self.commands = deque()
+
+        #   Binary command frames are only recognized once negotiated
+        self.binary_frames = False
 
     def add(self, data):
-        print(data)
-        self.pending_data += data
-        next_semicol = self.pending_data.find(b';')
-        while next_semicol > 0:
-            command_string = self.pending_data[:next_semicol]
-            next_space = command_string.find(b' ')
-            command_words = []
-            while next_space > 0:
-                command_words.append(command_string[:next_space])
-                command_string = command_string[next_space+1:]
-                next_space = command_string.find(b' ')
-            command_words.append(command_string)
-
-            self.command_words.append(command_words)
-
-            self.pending_data = self.pending_data[next_semicol+1:]
-            next_semicol = self.pending_data.find(b';')
+        pending = self.pending_data
+        pending += data
+
+        start = 0
+        while start < len(pending):
+            #   Binary frames are unpacked as a whole
+            if self.binary_frames and pending[start] == COMMAND_FRAME_MAGIC:
+                if len(pending) - start < COMMAND_FRAME.size:
+                    break
+                self.commands.append(COMMAND_FRAME.unpack_from(pending, start))
+                start += COMMAND_FRAME.size
+                continue
+
+            end = pending.find(b';', start)
+            if end < 0:
+                break
+            command_words = bytes(pending[start:end]).split()
+            start = end + 1
+            if len(command_words) == 0:
+                continue
+
+            self.commands.append(command_words)
+
+            #   Frames may follow the negotiation in the same chunk
+            if command_words[:2] == [b'set', b'protocol'] and len(command_words) == 3:
+                self.binary_frames = command_words[2] == b'binary'
+
+        #   Drop the tokenized bytes at once
+        del pending[:start]
+        return len(self.commands)
 
     def __len__(self):
-        return len(self.command_words)
+        return len(self.commands)
 
     def parse_next_command(self):
-        if len(self.command_words) == 0:
+        """
+        Returns the next command parsed by the first matching pattern, [b'frame', frame] for binary frames. Invalid
+        commands are dropped and raise an exception.
+        """
+        if len(self.commands) == 0:
             return None
 
-        for command_pattern in remote_control_commands:
-            command = command_pattern.parse(self.command_words[0])
+        command_words = self.commands.popleft()
+        if isinstance(command_words, tuple):
+            return [b'frame', command_words]
+
+        for command_pattern in command_patterns.get(command_words[0], ()):
+            command = command_pattern.parse(command_words)
             if command is not None:
-                self.command_words = self.command_words[1:]
                 return command
 
-        raise Exception("Invalid command in stack: " + str(self.command_words[:5]))
+        raise Exception("Invalid command: " + str(command_words))
 
 
 if __name__ == "__main__":
@@ -135,7 +306,7 @@ if __name__ == "__main__":
     try:
         while True:
             print("command =", acc.parse_next_command())
-            if len(acc.command_words) == 0:
+            if len(acc) == 0:
                 break
     except Exception as e:
         print(e)
@@ -2,22 +2,113 @@
 from ursina import *
 import socket
 import select
-import numpy as np
+import selectors
+import math
 
-from flask import Flask, request, jsonify
+from flask import request, jsonify
 
 
-from .sensing_message import SensingSnapshot, SensingSnapshotManager
-from .remote_commands import RemoteCommandParser
+from .sensing_message import (SensingSnapshot, SENSING_CONTROLS, SENSING_POSE, SENSING_RAYS, SENSING_IMAGE,
+                              SENSING_DEPTH, SENSING_LABELS, SENSING_SEQUENCE, SENSING_DEFAULT, SENSING_MODALITIES)
+from .snapshot_sender import SnapshotSender, SharedImage
+from .image_encoding import IMAGE_ENCODINGS
+from .remote_commands import RemoteCommandParser, FRAME_FORWARD, FRAME_BACK, FRAME_LEFT, FRAME_RIGHT, FRAME_RESET
+from .game_launcher import grab_screen_image, screen_reader
+from .car_dynamics import FIXED_TIMESTEP
 
 
 REMOTE_CONTROLLER_VERBOSE = False
 PERIOD_REMOTE_SENSING = 0.1
 
+#   Lockstep mode: time spent serving step requests per frame and wait for the next request before yielding the frame
+LOCKSTEP_FRAME_BUDGET = 0.1
+LOCKSTEP_POLL_TIMEOUT = 0.002
+
+#   'set ray <parameter> <value>' commands --> MultiRaySensor.configure arguments
+RAY_LAYOUT_PARAMETERS = {
+    b'count': "nbr_rays",
+    b'angle': "half_angle",
+    b'distance': "max_distance",
+    b'height': "ray_height",
+}
+
+#   Fields read back from the sensing camera frames
+CAMERA_FIELDS = SENSING_IMAGE | SENSING_DEPTH | SENSING_LABELS
+
+#   'set <setting> ...' commands that only change the connection of the client, allowed to observers
+CONNECTION_SETTINGS = (b'sensing', b'image', b'protocol', b'transport', b'role')
+
+#   Bytes read from a readable client per frame
+RECEIVE_SIZE = 2**16
+
 def printv(str):
     if REMOTE_CONTROLLER_VERBOSE:
         print(str)
 
+
+class SensingSchedule:
+    """
+    Sensing rate of each snapshot field, in Hz. Fields without rate follow the snapshots: sent every sensing period in
+    realtime mode and with every step reply in lockstep mode. A rate of 0 never sends the field, the default for the
+    fields out of SENSING_DEFAULT.
+    """
+    def __init__(self):
+        self.rates = {field: None if field & SENSING_DEFAULT else 0 for field in SENSING_MODALITIES.values()}
+        self.reset()
+
+    def reset(self):
+        self.last_sent = {field: -math.inf for field in SENSING_MODALITIES.values()}
+
+    def set_rate(self, field, rate):
+        if rate is not None and rate < 0:
+            raise ValueError("Sensing rate must be positive, got %f" % rate)
+        self.rates[field] = rate
+
+    def period(self, field, default_period):
+        return default_period if self.rates[field] is None else 1 / self.rates[field]
+
+    def due(self, now, default_period):
+        """
+        Returns the flags of the fields due at time now
+        """
+        fields = 0
+        for field, rate in self.rates.items():
+            if rate != 0 and now - self.last_sent[field] >= self.period(field, default_period):
+                fields |= field
+        return fields
+
+    def mark_sent(self, fields, now, default_period):
+        for field in self.last_sent:
+            if fields & field:
+                #   Fixed rate: frames rarely fall on the periods, restarting from now would lower the rates close to
+                #   the frame rate. Restart after stalls rather than sending bursts.
+                period = self.period(field, default_period)
+                if now - self.last_sent[field] < 2 * period:
+                    self.last_sent[field] += period
+                else:
+                    self.last_sent[field] = now
+
+class RemoteClient:
+    """
+    Connection of one remote client, with its own commands, sensing rates, image settings and protocol
+    """
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+
+        self.commands = RemoteCommandParser()
+        self.sensing_schedule = SensingSchedule()
+        #   Encodes and sends the snapshots of the client off the game loop
+        self.snapshot_sender = SnapshotSender(connection)
+        self.binary_protocol = False
+        #   Observers sending driving commands are only told once
+        self.ignored_command_reported = False
+
+    def close(self):
+        self.snapshot_sender.close()
+        self.connection.close()
+
+
 class RemoteController(Entity):
     def __init__(self, car = None, connection_port = 7654, flask_app=None):
         super().__init__()
@@ -27,9 +118,15 @@ class RemoteController(Entity):
         self.car = car
 
         self.listen_socket = None
-        self.connected_client = None
+        #   Listen socket and client connections, polled every frame
+        self.selector = selectors.DefaultSelector()
+
+        #   Connected clients in connection order. The control client drives the car, the others observe it.
+        self.clients = []
+        self.control_client = None
 
-        self.client_commands = RemoteCommandParser()
+        #   Commands posted to the HTTP route, applied with the control authority
+        self.http_commands = RemoteCommandParser()
 
         self.reset_location = (0,0,0)
         self.reset_speed = (0,0,0)
@@ -37,7 +134,20 @@ class RemoteController(Entity):
 
         #   Period for recording --> 0.1 secods = 10 times a second
         self.sensing_period = PERIOD_REMOTE_SENSING
-        self.last_sensing = -1
+
+        #   In lockstep mode the simulation advances on client step requests and snapshots are sent as replies, sensing
+        #   rates then follow the simulated time
+        self.lockstep = False
+        self.lockstep_time = 0
+
+        #   Car states stored by 'save state' commands
+        self.saved_states = {}
+
+        #   Sequence number of the last applied binary command frame, echoed to the clients that negotiated them
+        self.command_sequence = 0
+
+        #   Snapshot images come from the car sensing camera, or from the game window if set to b'window'
+        self.image_source = b'sensor'
 
         # Setup http route for updating.
         @flask_app.route('/command', methods=['POST'])
@@ -50,7 +160,7 @@ class RemoteController(Entity):
                 return jsonify({"error": "Invalid command data"}), 400
 
             try:
-                self.client_commands.add(command_data['command'].encode())
+                self.http_commands.add(command_data['command'].encode())
                 return jsonify({"status": "Command received"}), 200
             except Exception as e:
                 return jsonify({"error": str(e)}), 500
@@ -59,45 +169,187 @@ class RemoteController(Entity):
         def get_sensing_route():
             return jsonify(self.get_sensing_data()), 200
 
+        @flask_app.route('/clients')
+        def get_clients_route():
+            return jsonify(self.get_clients_data()), 200
+
     def update(self):
         self.update_network()
         self.process_remote_commands()
         self.process_sensing()
 
+        if self.lockstep:
+            self.serve_lockstep()
+
     def process_sensing(self):
-        if self.car is None or self.connected_client is None:
+        if self.car is None or len(self.clients) == 0 or self.lockstep:
+            return
+
+        now = time.time()
+        due_fields = {client: client.sensing_schedule.due(now, self.sensing_period) for client in self.clients}
+        self.send_snapshots(due_fields)
+        for client, fields in due_fields.items():
+            client.sensing_schedule.mark_sent(fields, now, self.sensing_period)
+
+        #   Ask for the sensing image one frame ahead, its pixels are read back while rendering the frame
+        if (any(client.sensing_schedule.due(now + time.dt, self.sensing_period) & CAMERA_FIELDS for client in self.clients)
+                and self.car.camera_sensor is not None):
+            self.car.camera_sensor.request_image()
+
+    def send_snapshots(self, due_fields, reply_client = None):
+        """
+        Senses the fields due to any client once, and sends each client the snapshot restricted to its own fields.
+        Clients without due fields get nothing, but reply_client.
+        """
+        recipients = [client for client, fields in due_fields.items() if fields != 0 or client is reply_client]
+        if len(recipients) == 0:
             return
 
-        if time.time() - self.last_sensing >= self.sensing_period:
-            snapshot = SensingSnapshot()
+        fields = 0
+        for client in recipients:
+            fields |= due_fields[client]
+        snapshot, image_reader = self.build_snapshot(fields)
+
+        #   Clients with the same image settings share the preprocessed and encoded image
+        shared_image = SharedImage(snapshot.image) if snapshot.image is not None else None
+        for client in recipients:
+            fields = due_fields[client] | (SENSING_SEQUENCE if client.binary_protocol else 0)
+            #   The image buffer is not rewritten by the next captures before the sender is done with it
+            release = None
+            if fields & SENSING_IMAGE and snapshot.image is not None:
+                release = image_reader.hold(snapshot.image)
+            client.snapshot_sender.send(snapshot.with_fields(fields), shared_image, release)
+
+    def build_snapshot(self, fields):
+        """
+        Builds a snapshot carrying the SENSING_* fields, the others are neither sensed nor sent. Returns it with the
+        RamImageReader of its image.
+        """
+        image_reader = None
+        snapshot = SensingSnapshot()
+        snapshot.command_sequence = self.command_sequence
+        snapshot.fields = fields
+        if fields & SENSING_CONTROLS:
             snapshot.current_controls = (held_keys['w'] or held_keys["up arrow"],
                                          held_keys['s'] or held_keys["down arrow"],
                                          held_keys['a'] or held_keys["left arrow"],
                                          held_keys['d'] or held_keys["right arrow"])
+        if fields & SENSING_POSE:
             snapshot.car_position = self.car.world_position
             snapshot.car_speed = self.car.speed
             snapshot.car_angle = self.car.rotation_y
+        if fields & SENSING_RAYS:
             snapshot.raycast_distances = self.car.multiray_sensor.collect_sensor_values()
 
-            #   Collect last rendered image
-            tex = base.win.getDisplayRegion(0).getScreenshot()
-            arr = tex.getRamImageAs("RGB")
-            data = np.frombuffer(arr, np.uint8)
-            image = data.reshape(tex.getYSize(), tex.getXSize(), 3)
-            image = image[::-1, :, :]#   Image arrives with inverted Y axis
-
-            snapshot.image = image
-
-            msg_mngr = SensingSnapshotManager()
-            data = msg_mngr.pack(snapshot)
-
-            self.connected_client.settimeout(0.01)
-            try:
-                self.connected_client.sendall(data)
-            except socket.error as e:
-                print(f"Socket error: {e}")
-
-            self.last_sensing = time.time()
+        #   Collect last rendered image
+        if fields & SENSING_IMAGE:
+            snapshot.image, snapshot.image_latency, image_reader = self.grab_image()
+        if fields & SENSING_DEPTH and self.car.camera_sensor is not None:
+            snapshot.depth = self.car.camera_sensor.grab_depth()
+        if fields & SENSING_LABELS and self.car.camera_sensor is not None:
+            snapshot.labels = self.car.camera_sensor.grab_labels()
+
+        return snapshot, image_reader
+
+    def grab_image(self):
+        """
+        Returns the image, its latency and the RamImageReader whose buffer holds it
+        """
+        if self.image_source == b'sensor' and self.car.camera_sensor is not None:
+            return self.car.camera_sensor.grab_image() + (self.car.camera_sensor.reader,)
+        return grab_screen_image(), 0, screen_reader
+
+    def apply_command_frame(self, frame):
+        _, flags, ticks, sequence, x, y, z, rotation, speed = frame
+        #   Checked before applying anything, the frame is rejected as a whole
+        if ticks > 0:
+            self.check_lockstep()
+
+        held_keys['w'] = bool(flags & FRAME_FORWARD)
+        held_keys['s'] = bool(flags & FRAME_BACK)
+        held_keys['a'] = bool(flags & FRAME_LEFT)
+        held_keys['d'] = bool(flags & FRAME_RIGHT)
+
+        if flags & FRAME_RESET:
+            self.car.reset_position = (x, y, z)
+            self.car.reset_orientation = (0, rotation, 0)
+            self.car.reset_speed = speed
+            self.car.reset_car()
+
+        #   Set before stepping, so that the step reply echoes this frame
+        self.command_sequence = sequence
+        if ticks > 0:
+            self.step_simulation(ticks)
+
+    def set_sensing_rate(self, client, field, rate):
+        client.sensing_schedule.set_rate(field, rate)
+        self.update_camera_passes()
+
+    def update_camera_passes(self):
+        #   Depth and label passes are only rendered when a client is subscribed to them
+        if self.car is not None and self.car.camera_sensor is not None:
+            self.car.camera_sensor.configure(
+                depth = any(client.sensing_schedule.rates[SENSING_DEPTH] != 0 for client in self.clients),
+                labels = any(client.sensing_schedule.rates[SENSING_LABELS] != 0 for client in self.clients))
+
+    def set_role(self, client, control):
+        if not control:
+            if self.control_client is client:
+                self.control_client = None
+        elif self.control_client is None:
+            self.control_client = client
+        elif self.control_client is not client:
+            print("Control authority held by " + str(self.control_client.address))
+
+    def set_lockstep(self, enabled):
+        self.lockstep = enabled
+        self.car.lockstep = enabled
+        self.car.dynamics_time = 0
+
+        #   Realtime and lockstep rates do not follow the same clock
+        self.lockstep_time = 0
+        for client in self.clients:
+            client.sensing_schedule.reset()
+
+    def check_lockstep(self):
+        #   Realtime ticks are driven by the frame time in Car.update, extra ticks would run in the middle of a frame
+        if not self.lockstep:
+            raise Exception("Stepping needs the lockstep mode ('set mode lockstep;')")
+
+    def step_simulation(self, nbr_ticks):
+        """
+        Advances the car by nbr_ticks fixed ticks with the current controls and replies with one snapshot
+        """
+        self.check_lockstep()
+        controls = self.car.read_controls()
+        for i in range(nbr_ticks):
+            self.car.tick(controls)
+        self.car.follow_camera()
+        self.lockstep_time += nbr_ticks * FIXED_TIMESTEP
+
+        due_fields = {client: client.sensing_schedule.due(self.lockstep_time, 0) for client in self.clients}
+
+        #   Render the new state so that the snapshot image matches the car pose, only when camera fields are sent
+        if any(fields & CAMERA_FIELDS for fields in due_fields.values()):
+            if self.car.camera_sensor is not None:
+                self.car.camera_sensor.request_image()
+            base.graphicsEngine.renderFrame()
+
+        #   Every step gets a reply to the control client, possibly without any field
+        self.send_snapshots(due_fields, reply_client = self.control_client)
+        for client, fields in due_fields.items():
+            client.sensing_schedule.mark_sent(fields, self.lockstep_time, 0)
+
+    def serve_lockstep(self):
+        #   Keep serving step requests within the frame budget, the simulation then runs at the client pace
+        frame_start = time.time()
+        while self.control_client is not None and time.time() - frame_start < LOCKSTEP_FRAME_BUDGET:
+            readable, _, _ = select.select([self.control_client.connection], [], [], LOCKSTEP_POLL_TIMEOUT)
+            if len(readable) == 0:
+                break
+
+            self.update_network()
+            self.process_remote_commands()
 
     def get_sensing_data(self):
         current_controls = (held_keys['w'] or held_keys["up arrow"],
@@ -117,31 +369,41 @@ class RemoteController(Entity):
                 'car_position z': car_position[2],
                 'car_speed': car_speed,
                 'car_angle': car_angle,
-                'raycast_distances 0': raycast_distances[0],
-                'raycast_distances 1': raycast_distances[1],
-                'raycast_distances 2': raycast_distances[2],
-                'raycast_distances 3': raycast_distances[3],
-                'raycast_distances 4': raycast_distances[4],
-                'raycast_distances 5': raycast_distances[5],
-                'raycast_distances 6': raycast_distances[6],
-                'raycast_distances 7': raycast_distances[7],
-                'raycast_distances 8': raycast_distances[8],
-                'raycast_distances 9': raycast_distances[9],
-                'raycast_distances 10': raycast_distances[10],
-                'raycast_distances 11': raycast_distances[11],
-                'raycast_distances 12': raycast_distances[12],
-                'raycast_distances 13': raycast_distances[13],
-                'raycast_distances 14': raycast_distances[14]
+                'raycast_distances': raycast_distances.tolist()
                 }
 
+    def get_clients_data(self):
+        return [dict(address = "%s:%d" % client.address[:2], control = client is self.control_client,
+                     **client.snapshot_sender.statistics())
+                for client in list(self.clients)]
+
     def process_remote_commands(self):
         if self.car is None:
             return
 
-        while len(self.client_commands) > 0:
+        for client in list(self.clients):
+            self.process_commands(client.commands, client, client is self.control_client)
+        self.process_commands(self.http_commands, self.control_client, True)
+
+    def process_commands(self, command_parser, client, control):
+        """
+        Applies the commands received from client. Only the control client, or the HTTP route, drives the car.
+        """
+        while len(command_parser) > 0:
             try:
-                commands = self.client_commands.parse_next_command()
-                print("Processing command", commands)
+                commands = command_parser.parse_next_command()
+                #   Not formatted unless verbose, binary frames can arrive at hundreds of hertz
+                if REMOTE_CONTROLLER_VERBOSE:
+                    printv("Processing command " + str(commands))
+                if commands[0] == b'set' and commands[1] in CONNECTION_SETTINGS:
+                    if client is None:
+                        raise Exception("'set %s' needs a client connection" % commands[1].decode())
+                elif not control:
+                    if not client.ignored_command_reported:
+                        print("Ignoring the commands of observer " + str(client.address) + " (only reported once)")
+                        client.ignored_command_reported = True
+                    continue
+
                 if commands[0] == b'push' or commands[0] == b'release':
                     if commands[1] == b'forward':
                         held_keys['w'] = commands[0] == b'push'
@@ -167,57 +429,136 @@ class RemoteController(Entity):
                     elif commands[1] == b'rotation':
                         self.car.reset_orientation = (0, commands[2], 0)
                     elif commands[1] == b'speed':
-                        # Todo
-                        pass
+                        if isinstance(commands[2], tuple):
+                            self.car.reset_speed = math.hypot(*commands[2])
+                        else:
+                            self.car.reset_speed = commands[2]
                     elif commands[1] == b'ray':
-                        self.car.multiray_sensor.set_enabled_rays(commands[2] == b'visible')
+                        if commands[2] in RAY_LAYOUT_PARAMETERS:
+                            self.car.multiray_sensor.configure(**{RAY_LAYOUT_PARAMETERS[commands[2]]: commands[3]})
+                        else:
+                            self.car.multiray_sensor.set_enabled_rays(commands[2] == b'visible')
+                    elif commands[1] == b'protocol':
+                        client.binary_protocol = commands[2] == b'binary'
+                    elif commands[1] == b'role':
+                        self.set_role(client, commands[2] == b'control')
+                    elif commands[1] == b'transport':
+                        if commands[2] == b'shared':
+                            client.snapshot_sender.set_shared_memory(commands[3].decode(), commands[4], commands[5])
+                        else:
+                            client.snapshot_sender.set_shared_memory(None)
+                    elif commands[1] == b'mode':
+                        self.set_lockstep(commands[2] == b'lockstep')
+                    elif commands[1] == b'camera':
+                        if commands[2] == b'size':
+                            self.car.camera_sensor.configure(size = (commands[3], commands[4]))
+                        elif commands[2] == b'fov':
+                            self.car.camera_sensor.configure(fov = commands[3])
+                        elif commands[2] == b'position':
+                            self.car.camera_sensor.configure(position = commands[3])
+                        elif commands[2] == b'rotation':
+                            self.car.camera_sensor.configure(rotation = commands[3])
+                        else:
+                            self.image_source = commands[2]
+                    elif commands[1] == b'sensing':
+                        rate = None if commands[3] == b'default' else commands[3]
+                        self.set_sensing_rate(client, SENSING_MODALITIES[commands[2]], rate)
+                    elif commands[1] == b'image':
+                        if commands[2] == b'encoding':
+                            client.snapshot_sender.set_image_encoding(encoding = IMAGE_ENCODINGS[commands[3]])
+                        elif commands[2] == b'quality':
+                            client.snapshot_sender.set_image_encoding(quality = commands[3])
+                        elif commands[2] == b'crop':
+                            client.snapshot_sender.set_image_preprocessing(crop = tuple(commands[3:]) if commands[3] != b'full' else ())
+                        elif commands[2] == b'downscale':
+                            client.snapshot_sender.set_image_preprocessing(downscale = commands[3])
+                        elif commands[2] == b'color':
+                            client.snapshot_sender.set_image_preprocessing(grayscale = commands[3] == b'gray')
+                        elif commands[2] == b'format':
+                            client.snapshot_sender.set_image_preprocessing(normalize = commands[3] == b'float16')
+
+                elif commands[0] == b'frame':
+                    self.apply_command_frame(commands[1])
 
                 elif commands[0] == b'reset':
                     self.car.reset_car()
 
+                elif commands[0] == b'step':
+                    self.step_simulation(commands[1] if len(commands) > 1 else 1)
+
+                elif commands[0] == b'save':
+                    self.saved_states[commands[2] if len(commands) > 2 else b'default'] = self.car.save_state()
+
+                elif commands[0] == b'load':
+                    state_name = commands[2] if len(commands) > 2 else b'default'
+                    if state_name in self.saved_states:
+                        self.car.load_state(self.saved_states[state_name])
+                    else:
+                        print("No saved state named", state_name)
+
             #   Error is thrown when commands do not fit the model --> disconnect client
             except Exception as e:
                 print("Invalid command --> disconnecting : " + str(e))
-                self.connected_client.close()
-                self.connected_client = None
+                if client is not None and client.commands is command_parser:
+                    self.disconnect_client(client)
+                    break
 
     def update_network(self):
-        if self.connected_client is not None:
-            data = []
-            try:
-                while True:
-                    recv_data = self.connected_client.recv(1024)
+        if self.listen_socket is None:
+            self.open_connection_socket()
+
+        #   Only handle what is already available, so that quiet clients do not stall the frame
+        for key, events in self.selector.select(timeout = 0):
+            if key.data is None:
+                self.accept_client()
+            else:
+                self.receive_commands(key.data)
+
+    def accept_client(self):
+        try:
+            connection, address = self.listen_socket.accept()
+        except Exception as e:
+            printv(e)
+            return
 
-                    #received nothing
-                    if len(recv_data) == 0:
-                        break
-                    self.client_commands.add(recv_data)
+        client = RemoteClient(connection, address)
+        self.clients.append(client)
+        self.selector.register(connection, selectors.EVENT_READ, client)
+        if self.control_client is None:
+            self.control_client = client
+        print("Client connecting from " + str(address) + (" with control" if self.control_client is client else " as observer"))
+
+    def receive_commands(self, client):
+        try:
+            recv_data = client.connection.recv(RECEIVE_SIZE)
+        except Exception as e:
+            printv(e)
+            recv_data = b''
+
+        #   Readable without data --> client closed the connection
+        if len(recv_data) == 0:
+            print("Client disconnected " + str(client.address))
+            self.disconnect_client(client)
+            return
+        client.commands.add(recv_data)
 
-            except Exception as e:
-                printv(e)
+    def disconnect_client(self, client):
+        if client not in self.clients:
+            return
 
-        #   No controller connected
-        else:
-            if self.listen_socket is None:
-                self.open_connection_socket()
-            try:
-                inc_client, address = self.listen_socket.accept()
-                print("Controller connecting from " + str(address))
-                self.connected_client = inc_client
-                # self.connected_client.setblocking(False)
-                self.connected_client.settimeout(0.01)
-
-                #   Close listen socket
-                self.listen_socket.close()
-                self.listen_socket = None
-            except Exception as e:
-                printv(e)
+        self.selector.unregister(client.connection)
+        client.close()
+        self.clients.remove(client)
+        if self.control_client is client:
+            self.control_client = None
 
+        #   Subscriptions are per connection
+        self.update_camera_passes()
 
     def open_connection_socket(self):
         print("Waiting for connections")
         self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.listen_socket.bind((self.ip_address, self.port))
-        # self.listen_socket.setblocking(False)
-        self.listen_socket.settimeout(0.01)
+        self.listen_socket.setblocking(False)
         self.listen_socket.listen()
+        self.selector.register(self.listen_socket, selectors.EVENT_READ, None)
@@ -2,15 +2,103 @@ import struct
 
 import numpy as np
 
-
-def iter_unpack(format, data):
-    nbr_bytes = struct.calcsize(format)
-    return struct.unpack(format, data[:nbr_bytes]), data[nbr_bytes:]
+from .image_encoding import IMAGE_RAW, IMAGE_DELTA, IMAGE_DELTA_KEYFRAME, PIXEL_TYPES, ImageDecoder
+from .shared_ring import SharedSnapshotRing, SHARED_SLOTS, SHARED_SLOT_SIZE
+
+
+#   Snapshot fields, flagged in the first byte of the snapshots when present
+SENSING_CONTROLS = 1
+SENSING_POSE = 2
+SENSING_RAYS = 4
+SENSING_IMAGE = 8
+SENSING_DEPTH = 16
+SENSING_LABELS = 32
+#   Sequence number of the last applied binary command frame, sent once binary frames are negotiated
+SENSING_SEQUENCE = 64
+#   Alone in messages notifying a snapshot written into the shared memory ring, see shared_ring
+SENSING_SHARED = 128
+#   Fields sent unless a client changes its subscriptions, depth and labels have to be asked for
+SENSING_DEFAULT = SENSING_CONTROLS | SENSING_POSE | SENSING_RAYS | SENSING_IMAGE
+
+#   'set sensing <modality> <rate>' commands --> snapshot fields
+SENSING_MODALITIES = {
+    b'controls': SENSING_CONTROLS,
+    b'pose': SENSING_POSE,
+    b'rays': SENSING_RAYS,
+    b'image': SENSING_IMAGE,
+    b'depth': SENSING_DEPTH,
+    b'labels': SENSING_LABELS,
+}
+
+SNAPSHOT_FIELDS = struct.Struct(">B")
+#   Command frame sequence number
+SNAPSHOT_SEQUENCE = struct.Struct(">I")
+#   Controls
+SNAPSHOT_CONTROLS = struct.Struct(">BBBB")
+#   Position, angle and speed
+SNAPSHOT_POSE = struct.Struct(">fffff")
+#   Number of rays, followed by the distances
+SNAPSHOT_RAYS = struct.Struct(">H")
+#   Image latency, size, number of channels, pixel type and encoding, followed by the encoded image
+SNAPSHOT_IMAGE = struct.Struct(">fiiBBB")
+#   Depth and label plane sizes. The planes follow the header, before the encoded image.
+SNAPSHOT_PLANE = struct.Struct(">ii")
+DEPTH_PLANE_TYPE = np.dtype("<u2")
+LABEL_PLANE_TYPE = np.dtype(np.uint8)
+#   Size of the framed messages
+MESSAGE_SIZE = struct.Struct(">i")
+#   Shared memory ring slot index and sequence number, following the SENSING_SHARED fields byte
+SHARED_SLOT = struct.Struct(">IQ")
+
+#   Initial size of the receive buffer, grown to fit the largest framed message
+RECEIVE_BUFFER_SIZE = 2**20
+#   Free space kept at the end of the receive buffer for each socket read
+RECEIVE_MIN_SIZE = 2**16
+
+
+def image_pixels(image):
+    """
+    Returns a flat byte view of the image pixels, only images that are not C contiguous are copied
+    """
+    if image is None:
+        return memoryview(b'')
+    return memoryview(np.ascontiguousarray(image)).cast("B")
+
+
+def plane_bytes(plane, dtype):
+    if plane is None:
+        return memoryview(b'')
+    return memoryview(np.ascontiguousarray(plane, dtype)).cast("B")
+
+
+def message_image_encoding(data):
+    """
+    Returns the image encoding of a packed snapshot without unpacking it, None when it has no image
+    """
+    fields = data[0]
+    if not fields & SENSING_IMAGE:
+        return None
+
+    offset = SNAPSHOT_FIELDS.size
+    if fields & SENSING_SEQUENCE:
+        offset += SNAPSHOT_SEQUENCE.size
+    if fields & SENSING_CONTROLS:
+        offset += SNAPSHOT_CONTROLS.size
+    if fields & SENSING_POSE:
+        offset += SNAPSHOT_POSE.size
+    if fields & SENSING_RAYS:
+        nbr_raycasts, = SNAPSHOT_RAYS.unpack_from(data, offset)
+        offset += SNAPSHOT_RAYS.size + 4 * nbr_raycasts
+    return SNAPSHOT_IMAGE.unpack_from(data, offset)[-1]
 
 """
     SensingSnapshot is a packing/unpacking class for diverse car simulation related information
 """
 class SensingSnapshot:
+    __slots__ = ("current_controls", "car_position", "car_speed", "car_angle", "raycast_distances", "image_latency",
+                 "image_encoding", "image_data", "depth", "labels", "command_sequence", "fields", "_image",
+                 "_encoded_image", "_shared_slot")
+
     def __init__(self):
         #   Forward - Backward - Left - Right
         self.current_controls = (0,0,0,0)
@@ -19,39 +107,220 @@ class SensingSnapshot:
         self.car_angle = 0
         self.raycast_distances = [0]
         self.image = None
-
-    def pack(self):
-        byte_data = b''
-        byte_data += struct.pack(">BBBB", *self.current_controls)
-        byte_data += struct.pack(">fffff", self.car_position[0], self.car_position[1], self.car_position[2], self.car_angle, self.car_speed)
-
-        nbr_raycasts = len(self.raycast_distances)
-        byte_data += struct.pack(">B" + "f" * nbr_raycasts, nbr_raycasts, *self.raycast_distances)
-
-        if self.image is not None:
-            byte_data += struct.pack(">ii", self.image.shape[0], self.image.shape[1])
-            byte_data +=  self.image.tobytes()
+        #   Seconds between the rendering of the image and the snapshot
+        self.image_latency = 0
+        #   Encoded image, sent instead of the raw pixels when set (see image_encoding)
+        self.image_encoding = IMAGE_RAW
+        self.image_data = None
+        #   (height, width) uint16 distances in camera_sensor.DEPTH_UNIT and uint8 camera_sensor.LABEL_* planes
+        self.depth = None
+        self.labels = None
+
+        #   Sequence number of the last command frame applied before the snapshot
+        self.command_sequence = None
+
+        #   SENSING_* flags of the fields carried by the snapshot, absent fields are unpacked as None
+        self.fields = SENSING_DEFAULT
+
+        #   (ring, slot, sequence) of the snapshots unpacked from a shared memory ring
+        self._shared_slot = None
+
+    def is_valid(self):
+        """
+        Whether the arrays of the snapshot still hold its data. The arrays of the snapshots received through shared memory
+        view a ring slot, rewritten by a later snapshot.
+        """
+        if self._shared_slot is None:
+            return True
+        ring, slot, sequence = self._shared_slot
+        return ring.is_valid(slot, sequence)
+
+    @property
+    def image(self):
+        #   Unpacked images are decoded on first access
+        if self._encoded_image is not None:
+            image_decoder, parameters = self._encoded_image
+            self._encoded_image = None
+            self._image = image_decoder.decode(*parameters)
+            self._image.flags.writeable = False
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._encoded_image = None
+
+    def __getstate__(self):
+        #   Recordings pickle the decoded image
+        state = {name: getattr(self, name) for name in self.__slots__ if not name.startswith("_")}
+        state["image"] = self.image
+        return state
+
+    def __setstate__(self, state):
+        #   Also loads the snapshots recorded before __slots__, pickled with their __dict__
+        self.__init__()
+        for name, value in state.items():
+            if name == "image" or name in self.__slots__:
+                setattr(self, name, value)
+
+    def with_fields(self, fields):
+        """
+        Returns a copy of the snapshot carrying the given fields, sharing its arrays
+        """
+        snapshot = SensingSnapshot.__new__(SensingSnapshot)
+        for name in self.__slots__:
+            setattr(snapshot, name, getattr(self, name))
+        snapshot.fields = fields
+        return snapshot
+
+    def header_size(self):
+        size = SNAPSHOT_FIELDS.size
+        if self.fields & SENSING_SEQUENCE:
+            size += SNAPSHOT_SEQUENCE.size
+        if self.fields & SENSING_CONTROLS:
+            size += SNAPSHOT_CONTROLS.size
+        if self.fields & SENSING_POSE:
+            size += SNAPSHOT_POSE.size
+        if self.fields & SENSING_RAYS:
+            size += SNAPSHOT_RAYS.size + 4 * len(self.raycast_distances)
+        if self.fields & SENSING_IMAGE:
+            size += SNAPSHOT_IMAGE.size
+        if self.fields & SENSING_DEPTH:
+            size += SNAPSHOT_PLANE.size
+        if self.fields & SENSING_LABELS:
+            size += SNAPSHOT_PLANE.size
+        return size
+
+    def pack_header(self, buffer, offset = 0):
+        """
+        Writes everything but the image pixels into buffer (bytearray) at offset, returns the offset following the header
+        """
+        SNAPSHOT_FIELDS.pack_into(buffer, offset, self.fields)
+        offset += SNAPSHOT_FIELDS.size
+
+        if self.fields & SENSING_SEQUENCE:
+            SNAPSHOT_SEQUENCE.pack_into(buffer, offset, self.command_sequence)
+            offset += SNAPSHOT_SEQUENCE.size
+
+        if self.fields & SENSING_CONTROLS:
+            SNAPSHOT_CONTROLS.pack_into(buffer, offset, *self.current_controls)
+            offset += SNAPSHOT_CONTROLS.size
+
+        if self.fields & SENSING_POSE:
+            SNAPSHOT_POSE.pack_into(buffer, offset, self.car_position[0], self.car_position[1], self.car_position[2],
+                                    self.car_angle, self.car_speed)
+            offset += SNAPSHOT_POSE.size
+
+        if self.fields & SENSING_RAYS:
+            nbr_raycasts = len(self.raycast_distances)
+            SNAPSHOT_RAYS.pack_into(buffer, offset, nbr_raycasts)
+            offset += SNAPSHOT_RAYS.size
+
+            #   Ray distances are written as one big endian float32 array, so dense sensors do not go through struct formats
+            np.frombuffer(buffer, ">f4", nbr_raycasts, offset)[:] = self.raycast_distances
+            offset += 4 * nbr_raycasts
+
+        if self.fields & SENSING_IMAGE:
+            h, w, c = self.image.shape if self.image is not None else (0, 0, 3)
+            pixel_type = PIXEL_TYPES.index(self.image.dtype) if self.image is not None else 0
+            SNAPSHOT_IMAGE.pack_into(buffer, offset, self.image_latency, h, w, c, pixel_type, self.image_encoding)
+            offset += SNAPSHOT_IMAGE.size
+
+        for field, plane in ((SENSING_DEPTH, self.depth), (SENSING_LABELS, self.labels)):
+            if self.fields & field:
+                SNAPSHOT_PLANE.pack_into(buffer, offset, *(plane.shape if plane is not None else (0, 0)))
+                offset += SNAPSHOT_PLANE.size
+
+        return offset
+
+    def payload_parts(self):
+        """
+        Returns the depth, labels and image byte buffers following the header, empty when absent
+        """
+        depth = plane_bytes(self.depth if self.fields & SENSING_DEPTH else None, DEPTH_PLANE_TYPE)
+        labels = plane_bytes(self.labels if self.fields & SENSING_LABELS else None, LABEL_PLANE_TYPE)
+        if not self.fields & SENSING_IMAGE:
+            image = memoryview(b'')
         else:
-            byte_data += struct.pack(">ii", 0, 0)
+            image = self.image_data if self.image_data is not None else image_pixels(self.image)
+        return depth, labels, image
 
-        return byte_data
-
-    def unpack(self, data):
-        self.current_controls, data = iter_unpack(">BBBB", data)
-        (x,y,z,a,s), data = iter_unpack(">fffff", data)
-        self.car_position = (x,y,z)
-        self.car_angle = a
-        self.car_speed = s
-
-        (nbr_raycasts,), data = iter_unpack(">B", data)
-        self.raycast_distances, data = iter_unpack(">" + "f" * nbr_raycasts, data)
-
-        (h,w), data = iter_unpack(">ii", data)
+    def pack(self):
+        header = bytearray(self.header_size())
+        self.pack_header(header)
+        return bytes(header) + b''.join(bytes(part) for part in self.payload_parts())
+
+    def unpack(self, data, image_decoder = None, decode_image = True):
+        """
+        Delta encoded images need the image_decoder that decoded the previous images of the connection. Without
+        decode_image, only delta images are decoded, to keep image_decoder up to date.
+
+        Nothing is copied: the planes and raw images are read-only views of data, which must not change while the
+        snapshot is in use. The other encodings are decoded on the first access to image.
+        """
+        data = memoryview(data).toreadonly()
+
+        self.fields, = SNAPSHOT_FIELDS.unpack_from(data, 0)
+        offset = SNAPSHOT_FIELDS.size
+
+        self.command_sequence = None
+        if self.fields & SENSING_SEQUENCE:
+            self.command_sequence, = SNAPSHOT_SEQUENCE.unpack_from(data, offset)
+            offset += SNAPSHOT_SEQUENCE.size
+
+        self.current_controls = None
+        if self.fields & SENSING_CONTROLS:
+            self.current_controls = SNAPSHOT_CONTROLS.unpack_from(data, offset)
+            offset += SNAPSHOT_CONTROLS.size
+
+        self.car_position = self.car_angle = self.car_speed = None
+        if self.fields & SENSING_POSE:
+            x, y, z, self.car_angle, self.car_speed = SNAPSHOT_POSE.unpack_from(data, offset)
+            self.car_position = (x,y,z)
+            offset += SNAPSHOT_POSE.size
+
+        self.raycast_distances = None
+        if self.fields & SENSING_RAYS:
+            nbr_raycasts, = SNAPSHOT_RAYS.unpack_from(data, offset)
+            offset += SNAPSHOT_RAYS.size
+            self.raycast_distances = np.frombuffer(data, ">f4", nbr_raycasts, offset).astype(np.float32)
+            offset += 4 * nbr_raycasts
+
+        h = w = 0
+        if self.fields & SENSING_IMAGE:
+            self.image_latency, h, w, c, pixel_type, self.image_encoding = SNAPSHOT_IMAGE.unpack_from(data, offset)
+            offset += SNAPSHOT_IMAGE.size
+
+        plane_shapes = []
+        for field in (SENSING_DEPTH, SENSING_LABELS):
+            shape = (0, 0)
+            if self.fields & field:
+                shape = SNAPSHOT_PLANE.unpack_from(data, offset)
+                offset += SNAPSHOT_PLANE.size
+            plane_shapes.append(shape)
+
+        #   Planes come first in the payload, the encoded image takes the rest
+        planes = []
+        for (plane_h, plane_w), dtype in zip(plane_shapes, (DEPTH_PLANE_TYPE, LABEL_PLANE_TYPE)):
+            plane = None
+            if plane_h * plane_w > 0:
+                plane = np.frombuffer(data, dtype, plane_h * plane_w, offset).reshape(plane_h, plane_w)
+                offset += plane.nbytes
+            planes.append(plane)
+        self.depth, self.labels = planes
 
-        if h*w > 0:
-            self.image = np.frombuffer(data, np.uint8).reshape(h,w,3)
-        else:
-            self.image = None
+        self.image = None
+        if h*w == 0:
+            return
+        if image_decoder is None:
+            image_decoder = ImageDecoder()
+        parameters = (self.image_encoding, h, w, data[offset:], c, PIXEL_TYPES[pixel_type])
+        if self.image_encoding in (IMAGE_DELTA, IMAGE_DELTA_KEYFRAME):
+            #   Delta images are decoded in order, the next one needs this one
+            self._image = image_decoder.decode(*parameters)
+            self._image.flags.writeable = False
+        elif decode_image:
+            self._encoded_image = (image_decoder, parameters)
 
 """
 #   Snapshot formatting and managing class
@@ -59,37 +328,213 @@ class SensingSnapshot:
 #       uses a callback to inform higher level code of reception of a complete SensingSnapshot
 """
 class SensingSnapshotManager:
-    def __init__(self, received_snapshot_callback = None):
-        self.pending_data = b''
+    def __init__(self, received_snapshot_callback = None, latest_only = False):
         self.received_snapshot_callback = received_snapshot_callback
 
-    def pack(self, snapshot):
-        data = snapshot.pack()
-        data = struct.pack(">i", len(data)) + data
-
-        return data
+        #   Only the newest of the snapshots received together reaches the callback, the older ones are dropped so that a
+        #   slow consumer always sees the current state. It is held in latest_message until deliver_latest.
+        self.latest_only = latest_only
+        self.latest_message = None
+        self.nbr_dropped_snapshots = 0
+
+        #   Received bytes are [read_offset, write_offset) of the preallocated receive buffer. Messages are reassembled in
+        #   place and the pending bytes only move back to the front when the end of the buffer is too short.
+        self.receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.read_offset = 0
+        self.write_offset = 0
+
+        #   Reused by the packed snapshots, grown to the largest header
+        self.header_buffer = bytearray(256)
+
+        #   Decoding state of the received images
+        self.image_decoder = ImageDecoder()
+
+        #   Ring of the snapshots received through shared memory, attached on the first of them as the simulator creates it
+        self.shared_ring = None
+        self.shared_ring_parameters = None
+        self.nbr_overwritten_snapshots = 0
+
+    def use_shared_memory(self, name, nbr_slots = SHARED_SLOTS, slot_size = SHARED_SLOT_SIZE):
+        if self.shared_ring is not None:
+            self.shared_ring.close()
+            self.shared_ring = None
+        self.shared_ring_parameters = (name, nbr_slots, slot_size)
+
+    def pack_shared(self, slot, sequence):
+        """
+        Returns the framed notification of a snapshot written into slot of the shared memory ring
+        """
+        return (MESSAGE_SIZE.pack(SNAPSHOT_FIELDS.size + SHARED_SLOT.size) + SNAPSHOT_FIELDS.pack(SENSING_SHARED) +
+                SHARED_SLOT.pack(slot, sequence))
+
+    def pack_parts(self, snapshot):
+        """
+        Returns the header and payload buffers of the framed snapshot, to be sent in order. The image and planes are not
+        copied and the header buffer is reused by the next call.
+        """
+        header_size = MESSAGE_SIZE.size + snapshot.header_size()
+        if len(self.header_buffer) < header_size:
+            self.header_buffer = bytearray(header_size)
+
+        snapshot.pack_header(self.header_buffer, MESSAGE_SIZE.size)
+        payload = snapshot.payload_parts()
+        MESSAGE_SIZE.pack_into(self.header_buffer, 0, header_size - MESSAGE_SIZE.size + sum(len(part) for part in payload))
+
+        return (memoryview(self.header_buffer)[:header_size],) + payload
 
+    def pack(self, snapshot):
+        return b''.join(bytes(part) for part in self.pack_parts(snapshot))
+
+
+    def reserve(self, nbr_bytes):
+        """
+        Returns a writable view of the free end of the receive buffer, at least nbr_bytes long
+        """
+        if len(self.receive_buffer) - self.write_offset < nbr_bytes:
+            pending = self.write_offset - self.read_offset
+            buffer = self.receive_buffer
+            if pending + nbr_bytes > len(buffer):
+                buffer = bytearray(max(2 * len(buffer), pending + nbr_bytes))
+            memoryview(buffer)[:pending] = memoryview(self.receive_buffer)[self.read_offset:self.write_offset]
+            self.receive_buffer = buffer
+            self.read_offset, self.write_offset = 0, pending
+
+        return memoryview(self.receive_buffer)[self.write_offset:]
+
+    def add_message_chunk(self, chunk, deliver_latest = True):
+        """
+        Appends the received chunk and unpacks every complete message, returns the number of received snapshots
+        """
+        self.reserve(len(chunk))[:len(chunk)] = chunk
+        self.write_offset += len(chunk)
+        return self.process_messages(deliver_latest)
+
+    def receive_into(self, sock, deliver_latest = True):
+        """
+        Reads the socket directly into the receive buffer and unpacks every complete message. Returns the number of bytes
+        read, 0 once the connection is closed.
+        """
+        nbr_bytes = sock.recv_into(self.reserve(RECEIVE_MIN_SIZE))
+        self.received(nbr_bytes, deliver_latest)
+        return nbr_bytes
+
+    def received(self, nbr_bytes, deliver_latest = True):
+        """
+        Unpacks every complete message once nbr_bytes were written into the view returned by reserve, returns the number
+        of received snapshots
+        """
+        self.write_offset += nbr_bytes
+        return self.process_messages(deliver_latest)
+
+    def process_messages(self, deliver_latest = True):
+        """
+        With latest_only, the newest snapshot is only passed to the callback by deliver_latest, so that a caller draining
+        several chunks can deliver it once they are all processed
+        """
+        nbr_messages = 0
+        while self.write_offset - self.read_offset >= MESSAGE_SIZE.size:
+            message_size, = MESSAGE_SIZE.unpack_from(self.receive_buffer, self.read_offset)
+            start = self.read_offset + MESSAGE_SIZE.size
+            if start + message_size > self.write_offset:
+                break
+            self.read_offset = start + message_size
+            nbr_messages += 1
+
+            #   Copied out as the unpacked arrays are views of the message data
+            data = bytes(memoryview(self.receive_buffer)[start:start + message_size])
+            if self.latest_only:
+                if self.latest_message is not None:
+                    self.drop_message(self.latest_message)
+                self.latest_message = data
+            else:
+                self.deliver(self.unpack_message(data))
+
+        if deliver_latest:
+            self.deliver_latest()
+
+        if self.read_offset == self.write_offset:
+            self.read_offset = self.write_offset = 0
+        elif self.write_offset - self.read_offset >= MESSAGE_SIZE.size:
+            #   Room for the rest of the incomplete message, which is then received in place
+            message_size, = MESSAGE_SIZE.unpack_from(self.receive_buffer, self.read_offset)
+            self.reserve(self.read_offset + MESSAGE_SIZE.size + message_size - self.write_offset)
+
+        return nbr_messages
+
+    def deliver(self, snapshot):
+        if snapshot is not None and self.received_snapshot_callback is not None:
+            self.received_snapshot_callback(snapshot)
+
+    def deliver_latest(self):
+        """
+        Passes the newest snapshot held by latest_only to the callback
+        """
+        if self.latest_message is not None:
+            data, self.latest_message = self.latest_message, None
+            self.deliver(self.unpack_message(data))
+
+    def drop_message(self, data):
+        self.nbr_dropped_snapshots += 1
+        #   Delta images are decoded against the previous image, so the dropped ones still go through the decoder. The
+        #   image encoding of shared memory snapshots is only known once their slot is read.
+        if data[0] & SENSING_SHARED or message_image_encoding(data) in (IMAGE_DELTA, IMAGE_DELTA_KEYFRAME):
+            self.unpack_message(data, decode_image = False)
+
+    def unpack_message(self, data, decode_image = True):
+        """
+        Returns the snapshot of a received message, None when its shared memory slot was rewritten before being read
+        """
+        snapshot = SensingSnapshot()
+        if not data[0] & SENSING_SHARED:
+            snapshot.unpack(data, self.image_decoder, decode_image)
+            return snapshot
+
+        slot, sequence = SHARED_SLOT.unpack_from(data, SNAPSHOT_FIELDS.size)
+        if self.shared_ring is None:
+            self.shared_ring = SharedSnapshotRing(*self.shared_ring_parameters)
+
+        message = self.shared_ring.read(slot, sequence)
+        if message is not None:
+            snapshot.unpack(message, self.image_decoder, decode_image)
+            snapshot._shared_slot = (self.shared_ring, slot, sequence)
+
+        #   Seqlock: the slot must not have been rewritten while the header was read
+        if message is None or not self.shared_ring.is_valid(slot, sequence):
+            self.nbr_overwritten_snapshots += 1
+            return None
+        return snapshot
+
+
+import os
+import socket
+import imageio
 
-    def add_message_chunk(self, chunk):
-        self.pending_data += chunk
+from .remote_commands import pack_command_frame
 
-        sizeheader = struct.calcsize(">i")
-        message_size = struct.unpack(">i", self.pending_data[:sizeheader])[0]
 
-        if message_size+sizeheader <= len(self.pending_data):
-            snapshot = SensingSnapshot()
+def send_buffers(sock, buffers):
+    """
+    Sends the buffers in order, in scatter-gather sendmsg calls when the platform has them
+    """
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
 
-            snapshot.unpack(self.pending_data[sizeheader:sizeheader+message_size])
-            if self.received_snapshot_callback is not None:
-                self.received_snapshot_callback(snapshot)
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer) > 0]
+    while len(buffers) > 0:
+        sent = sock.sendmsg(buffers)
 
-            self.pending_data = self.pending_data[sizeheader+message_size:]
+        #   Drop what was sent, a partial send resumes in the middle of a buffer
+        while len(buffers) > 0 and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if len(buffers) > 0:
+            buffers[0] = buffers[0][sent:]
 
 
-import socket
-import imageio
 class NetworkDataCmdInterface:
-    def __init__(self, callback, address = "127.0.0.1", port = 7654):
+    def __init__(self, callback, address = "127.0.0.1", port = 7654, latest_only = False):
         self.data = []
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -98,24 +543,59 @@ class NetworkDataCmdInterface:
         # self.socket.setblocking(False)
         self.socket.settimeout(0.05)
 
-        self.msg_mngr = SensingSnapshotManager(callback)
+        self.msg_mngr = SensingSnapshotManager(callback, latest_only)
+
+        #   Sequence number of the last sent binary command frame
+        self.frame_sequence = 0
 
     def send_cmd(self, cmd):
         self.socket.send(bytes(cmd, "utf-8"))
 
+    def enable_binary_commands(self):
+        """
+        Negotiates the binary command frames, the snapshots then echo the sequence of the last applied frame
+        """
+        self.send_cmd("set protocol binary;")
+
+    def send_frame(self, controls, reset_pose = None, ticks = 0):
+        """
+        Sends the (forward, back, left, right) controls in a binary command frame and returns its sequence number, see
+        remote_commands.pack_command_frame
+        """
+        self.frame_sequence += 1
+        self.socket.send(pack_command_frame(self.frame_sequence, controls, reset_pose, ticks))
+        return self.frame_sequence
+
+    def set_image_encoding(self, encoding, quality = None):
+        """
+        Asks for raw, jpeg, png or delta encoded images, see image_encoding
+        """
+        if quality is not None:
+            self.send_cmd("set image quality %d;" % quality)
+        self.send_cmd("set image encoding %s;" % encoding)
+
+    def enable_shared_memory(self, name = None, nbr_slots = SHARED_SLOTS, slot_size = SHARED_SLOT_SIZE):
+        """
+        Asks for the snapshots to be written into a shared memory ring, for controllers on the simulator host. Snapshots
+        larger than a slot still come through the socket.
+        """
+        if name is None:
+            name = "rrp_%d_%x" % (os.getpid(), id(self))
+        self.msg_mngr.use_shared_memory(name, nbr_slots, slot_size)
+        self.send_cmd("set transport shared %s %d %d;" % (name, nbr_slots, slot_size))
+
     def recv_msg(self):
         try:
             while True:
-                data = self.socket.recv(2**20)
-
-                if len(data) == 0:
+                if self.msg_mngr.receive_into(self.socket, deliver_latest = False) == 0:
                     break
 
-                self.msg_mngr.add_message_chunk(data)
-
         except Exception as e:
             pass
 
+        #   With latest_only, only the newest snapshot of the whole drain reaches the callback
+        self.msg_mngr.deliver_latest()
+
     def process_sensing_message(self, sensing_snapshot):
         #   Sample function to use as a callback
         print("sensing_snapshot.car.position =", sensing_snapshot.car_position)
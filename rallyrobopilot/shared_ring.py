@@ -0,0 +1,112 @@
+"""
+    Shared memory ring of snapshot slots, for clients running on the simulator host ('set transport shared ...;')
+
+    The simulator writes each snapshot message into the next slot of the ring and only sends the slot index and sequence
+    number through the socket. Clients unpack the snapshots straight from the slots, their arrays are views of the
+    shared memory. A slot is overwritten after nbr_slots newer snapshots.
+"""
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+#   Sequence number, odd while the slot is being written, and size of the message that follows. 16 bytes, so that the
+#   messages start aligned.
+SLOT_HEADER = struct.Struct("<QQ")
+
+#   Default ring, fits raw 640x480 images with their depth and label planes
+SHARED_SLOTS = 4
+SHARED_SLOT_SIZE = 2**22
+
+#   Clients choose the ring size, the simulator does not allocate more shared memory than this per client
+MAX_SHARED_MEMORY_SIZE = 2**28
+
+
+def check_ring_size(nbr_slots, slot_size):
+    if nbr_slots < 1 or slot_size <= SLOT_HEADER.size:
+        raise ValueError("Invalid ring of %d slots of %d bytes" % (nbr_slots, slot_size))
+    if nbr_slots * slot_size > MAX_SHARED_MEMORY_SIZE:
+        raise ValueError("Ring of %d slots of %d bytes larger than %d bytes" % (nbr_slots, slot_size,
+                                                                               MAX_SHARED_MEMORY_SIZE))
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name, track = False)
+    except TypeError:
+        #   Before Python 3.13, the resource tracker of a client would unlink the simulator memory when it exits
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+class SharedSnapshotRing:
+    def __init__(self, name, nbr_slots = SHARED_SLOTS, slot_size = SHARED_SLOT_SIZE, create = False):
+        """
+        The simulator creates the ring, clients attach to it by name with the same number and size of slots
+        """
+        check_ring_size(nbr_slots, slot_size)
+        self.nbr_slots = nbr_slots
+        self.slot_size = slot_size
+        self.owner = create
+
+        if create:
+            self.memory = shared_memory.SharedMemory(name, create = True, size = nbr_slots * slot_size)
+            self.memory.buf[:nbr_slots * slot_size] = bytes(nbr_slots * slot_size)
+        else:
+            self.memory = attach_shared_memory(name)
+            if self.memory.size < nbr_slots * slot_size:
+                raise ValueError("Shared memory %s is smaller than %d slots of %d bytes" % (name, nbr_slots, slot_size))
+        self.buffer = self.memory.buf
+        self.next_slot = 0
+
+    def sequence(self, slot):
+        return SLOT_HEADER.unpack_from(self.buffer, slot * self.slot_size)[0]
+
+    def write(self, parts):
+        """
+        Writes the message made of the parts buffers into the next slot, returns its slot index and sequence number. None
+        when the message does not fit a slot.
+        """
+        size = sum(len(part) for part in parts)
+        if size > self.slot_size - SLOT_HEADER.size:
+            return None
+
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.nbr_slots
+        offset = slot * self.slot_size
+
+        #   Seqlock: readers seeing an odd or changed sequence know the slot is being or was rewritten
+        sequence = self.sequence(slot) | 1
+        SLOT_HEADER.pack_into(self.buffer, offset, sequence, size)
+        position = offset + SLOT_HEADER.size
+        for part in parts:
+            self.buffer[position:position + len(part)] = memoryview(part).cast("B")
+            position += len(part)
+        SLOT_HEADER.pack_into(self.buffer, offset, sequence + 1, size)
+
+        return slot, sequence + 1
+
+    def read(self, slot, sequence):
+        """
+        Returns a view of the message written in slot with sequence, None if it was overwritten since
+        """
+        current, size = SLOT_HEADER.unpack_from(self.buffer, slot * self.slot_size)
+        if current != sequence:
+            return None
+        offset = slot * self.slot_size + SLOT_HEADER.size
+        return self.buffer[offset:offset + size]
+
+    def is_valid(self, slot, sequence):
+        """
+        Whether the message written in slot with sequence is still there, views of it are only valid until then
+        """
+        return self.sequence(slot) == sequence
+
+    def close(self):
+        self.buffer = None
+        try:
+            self.memory.close()
+        except BufferError:
+            #   Snapshots still view the memory, it is released with them
+            pass
+        if self.owner:
+            self.memory.unlink()
@@ -0,0 +1,146 @@
+"""
+    Programmatic single car simulations, driven tick by tick without a remote controller.
+
+    GameSimulation runs the full game started by prepare_game_app, HeadlessSimulation only runs the render-free physics
+    core. Both expose the same reset/step interface returning observation dictionaries, see VectorRallyEnv.
+"""
+import numpy as np
+
+from .car_dynamics import CarState, DEFAULT_PARAMETERS, FIXED_TIMESTEP, step
+from .track_geometry import (load_track_metadata, compile_wall_index, compile_height_map, fan_directions,
+                             DEFAULT_NBR_RAYS, DEFAULT_HALF_ANGLE, MAX_RAYCAST_DIST, RAY_HEIGHT)
+
+#   The car is considered lost out of these heights, as in Car.check_respawn
+MIN_CAR_HEIGHT = -100
+MAX_CAR_HEIGHT = 300
+
+
+def make_observation(position, angle, speed, raycast_distances, image = None):
+    observation = {
+        "position": np.asarray(position, dtype = np.float32),
+        "angle": np.float32(angle),
+        "speed": np.float32(speed),
+        "raycast_distances": np.asarray(raycast_distances, dtype = np.float32),
+    }
+    if image is not None:
+        observation["image"] = image
+
+    return observation
+
+
+class HeadlessSimulation:
+    def __init__(self, track_name = "VisualTrack", nbr_rays = DEFAULT_NBR_RAYS, half_angle = DEFAULT_HALF_ANGLE,
+                 max_distance = MAX_RAYCAST_DIST, ray_height = RAY_HEIGHT):
+        metadata = load_track_metadata(track_name)
+        self.reset_position = tuple(metadata["car_default_reset_position"])
+        self.reset_orientation = tuple(metadata["car_default_reset_orientation"])
+        self.wall_index = compile_wall_index(track_name, metadata)
+        self.height_map = compile_height_map(track_name, metadata)
+
+        self.nbr_rays = nbr_rays
+        self.half_angle = half_angle
+        self.max_distance = max_distance
+        self.ray_height = ray_height
+        self.reset()
+
+    def reset(self):
+        self.state = CarState(self.reset_position, self.reset_orientation[1])
+
+        #   Project car directly on ground when resetting
+        ground = self.height_map.sample(self.state.x, self.state.z) if self.height_map is not None else None
+        if ground is not None:
+            self.state.y = ground[0] + DEFAULT_PARAMETERS.ground_clearance
+        return self.observe()
+
+    def step(self, controls, nbr_ticks = 1):
+        """
+        Advances the car by nbr_ticks fixed ticks and returns the observation, the signed distance driven and whether
+        the car got lost
+        """
+        travelled = 0
+        for i in range(nbr_ticks):
+            step(self.state, controls, FIXED_TIMESTEP, cast_obstacles = self.wall_index.cast,
+                 sample_ground = self.height_map.sample if self.height_map is not None else None)
+            travelled += self.state.speed * FIXED_TIMESTEP
+
+        done = not (MIN_CAR_HEIGHT < self.state.y < MAX_CAR_HEIGHT)
+        return self.observe(), travelled, done
+
+    def save_state(self):
+        return self.state.pack()
+
+    def load_state(self, data):
+        if len(data) != CarState.STRUCT.size:
+            raise ValueError("Invalid car state of %d bytes, %d expected" % (len(data), CarState.STRUCT.size))
+        self.state.unpack(data)
+        return self.observe()
+
+    def cast_rays(self):
+        origins = np.tile((self.state.x, self.state.y + self.ray_height, self.state.z), (self.nbr_rays, 1))
+        directions = fan_directions(self.state.rotation_y, self.nbr_rays, self.half_angle)[0]
+        return self.wall_index.cast_rays(origins, directions, self.max_distance)
+
+    def observe(self):
+        return make_observation(self.state.position, self.state.rotation_y, self.state.speed, self.cast_rays())
+
+
+class GameSimulation:
+    def __init__(self, track_name = "VisualTrack", image = False, offscreen = True, nbr_rays = DEFAULT_NBR_RAYS,
+                 half_angle = DEFAULT_HALF_ANGLE, max_distance = MAX_RAYCAST_DIST, ray_height = RAY_HEIGHT,
+                 image_size = None, fov = None):
+        """
+        image_size and fov default to those of CameraSensor
+        """
+        #   Ursina is only imported by the game backend, the headless one runs without a display
+        from .game_launcher import prepare_game_app
+
+        self.app, self.car = prepare_game_app(track_name, offscreen = offscreen)
+        self.car.lockstep = True
+        #   Lost cars end the episode, Car.update would otherwise respawn them before step checks their height
+        self.car.respawn_when_lost = False
+        self.car.multiray_sensor.configure(nbr_rays, half_angle, max_distance, ray_height)
+        self.car.camera_sensor.configure(size = image_size, fov = fov)
+        self.image = image
+
+    def reset(self):
+        self.car.reset_car()
+        self.car.follow_camera()
+        self.render()
+        return self.observe()
+
+    def step(self, controls, nbr_ticks = 1):
+        travelled = 0
+        for i in range(nbr_ticks):
+            self.car.tick(controls)
+            travelled += self.car.speed * FIXED_TIMESTEP
+        self.car.follow_camera()
+
+        self.render()
+
+        done = not (MIN_CAR_HEIGHT < self.car.y < MAX_CAR_HEIGHT)
+        return self.observe(), travelled, done
+
+    def save_state(self):
+        return self.car.save_state()
+
+    def load_state(self, data):
+        self.car.load_state(data)
+        self.render()
+        return self.observe()
+
+    def render(self):
+        #   Run entity updates and render the frame, reading the sensing image back at the end of the frame
+        if self.image:
+            self.car.camera_sensor.request_image()
+        self.app.taskMgr.step()
+
+    def observe(self):
+        return make_observation(self.car.world_position, self.car.rotation_y, self.car.speed,
+                                self.car.multiray_sensor.collect_sensor_values(),
+                                self.car.camera_sensor.grab_image()[0].copy() if self.image else None)
+
+
+SIMULATION_BACKENDS = {
+    "headless": HeadlessSimulation,
+    "game": GameSimulation,
+}
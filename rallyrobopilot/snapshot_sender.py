@@ -0,0 +1,224 @@
+import socket
+import threading
+from collections import deque
+
+from .image_encoding import ImageEncoder, IMAGE_DELTA, check_quality
+from .image_preprocessing import ImagePreprocessor
+from .sensing_message import SensingSnapshotManager, SENSING_IMAGE, MESSAGE_SIZE, send_buffers
+from .shared_ring import SharedSnapshotRing, SHARED_SLOTS, SHARED_SLOT_SIZE, check_ring_size
+
+#   Sends are off the game loop, so a slow client only delays its own worker. A client that does not read for this
+#   long is disconnected.
+SEND_TIMEOUT = 1.
+
+#   Bytes of the snapshots waiting for or being sent to a client, counted before encoding. Beyond, the client is behind
+#   and its pending snapshots are replaced by the newest one.
+SEND_BUDGET = 2**20
+
+
+class SharedImage:
+    """
+    Image of a snapshot sent to several clients. Clients with the same image settings share its preprocessing and
+    encoding, done by the first sender to ask for them.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.lock = threading.Lock()
+        #   Image settings --> [lock, (preprocessed image, encoding, data) or preprocessing error]
+        self.versions = {}
+
+    def get(self, image_preprocessor, image_encoder):
+        """
+        Returns the preprocessed image, its encoding and encoded data. Raises ValueError when the preprocessing does not
+        fit the image.
+        """
+        if image_encoder.encoding == IMAGE_DELTA:
+            #   Delta images depend on the images previously sent to the client
+            image = image_preprocessor.process(self.image)
+            return (image,) + image_encoder.encode(image)
+
+        key = (image_preprocessor.crop, image_preprocessor.downscale, image_preprocessor.grayscale,
+               image_preprocessor.normalize, image_encoder.encoding, image_encoder.quality)
+        with self.lock:
+            version = self.versions.setdefault(key, [threading.Lock(), None])
+
+        with version[0]:
+            if version[1] is None:
+                try:
+                    image = image_preprocessor.process(self.image)
+                    version[1] = (image,) + image_encoder.encode(image)
+                except ValueError as e:
+                    version[1] = e
+
+        if isinstance(version[1], ValueError):
+            raise version[1]
+        return version[1]
+
+
+class SnapshotSender:
+    """
+    Preprocesses and encodes the snapshot images of one client connection and sends the snapshots from a worker thread.
+
+    Snapshots and image settings changes go through the same queue, so they are applied in order. The game loop never
+    waits for the worker: when a client falls behind by more than the send budget, its pending snapshots are dropped
+    for the newest one. Snapshots are only ever sent whole, a snapshot being sent is never dropped.
+    """
+    def __init__(self, connection, send_budget = SEND_BUDGET):
+        self.connection = connection
+        self.connection.settimeout(SEND_TIMEOUT)
+        self.connection_lost = False
+        self.send_budget = send_budget
+
+        self.image_preprocessor = ImagePreprocessor()
+        self.image_encoder = ImageEncoder()
+        self.snapshot_encoder = SensingSnapshotManager()
+        #   Ring the snapshots are written into for clients on the same host, owned by the worker
+        self.shared_ring = None
+
+        #   (nbr_bytes, callable, *args) jobs, nbr_bytes is the unencoded size of the snapshots and None for settings. A
+        #   None callable stops the worker.
+        self.jobs = deque()
+        self.jobs_changed = threading.Condition()
+
+        #   Counters, updated under jobs_changed
+        self.nbr_sent_snapshots = 0
+        self.nbr_dropped_snapshots = 0
+        self.sent_bytes = 0
+        self.queued_bytes = 0
+
+        self.thread = threading.Thread(target = self.run, name = "snapshot_sender", daemon = True)
+        self.thread.start()
+
+    def put(self, job):
+        with self.jobs_changed:
+            self.jobs.append(job)
+            self.jobs_changed.notify()
+
+    def drop_pending_snapshots(self):
+        settings = deque(job for job in self.jobs if job[0] is None)
+        for nbr_bytes, send_snapshot, snapshot, shared_image, release in (job for job in self.jobs if job[0] is not None):
+            self.nbr_dropped_snapshots += 1
+            self.queued_bytes -= nbr_bytes
+            if release is not None:
+                release()
+        self.jobs = settings
+
+    def send(self, snapshot, shared_image = None, release = None):
+        """
+        shared_image is the SharedImage of snapshot.image when the snapshot is also sent to other clients. release is
+        called once the snapshot is sent or dropped, its arrays are not used anymore then.
+        """
+        nbr_bytes = snapshot.header_size() + sum(len(part) for part in snapshot.payload_parts())
+        with self.jobs_changed:
+            if self.queued_bytes + nbr_bytes > self.send_budget:
+                self.drop_pending_snapshots()
+            self.queued_bytes += nbr_bytes
+            self.jobs.append((nbr_bytes, self.send_snapshot, snapshot, shared_image, release))
+            self.jobs_changed.notify()
+
+    def set_image_encoding(self, encoding = None, quality = None):
+        """
+        Validates the encoding parameters right away, they apply to the snapshots sent after this call
+        """
+        if quality is not None:
+            check_quality(quality)
+        self.put((None, self.image_encoder.set_encoding, encoding, quality))
+
+    def set_image_preprocessing(self, **parameters):
+        """
+        Takes the ImagePreprocessor.configure parameters, validated right away
+        """
+        ImagePreprocessor().configure(**parameters)
+        self.put((None, lambda: self.image_preprocessor.configure(**parameters)))
+
+    def set_shared_memory(self, name, nbr_slots = SHARED_SLOTS, slot_size = SHARED_SLOT_SIZE):
+        """
+        Writes the snapshots sent after this call into a new shared memory ring, or sends them through the socket again
+        when name is None
+        """
+        if name is not None:
+            check_ring_size(nbr_slots, slot_size)
+        self.put((None, self.open_shared_ring, name, nbr_slots, slot_size))
+
+    def open_shared_ring(self, name, nbr_slots, slot_size):
+        if self.shared_ring is not None:
+            self.shared_ring.close()
+            self.shared_ring = None
+        if name is not None:
+            self.shared_ring = SharedSnapshotRing(name, nbr_slots, slot_size, create = True)
+
+    def statistics(self):
+        with self.jobs_changed:
+            return {"sent_snapshots": self.nbr_sent_snapshots, "dropped_snapshots": self.nbr_dropped_snapshots,
+                    "sent_bytes": self.sent_bytes, "queued_bytes": self.queued_bytes}
+
+    def close(self):
+        #   Pending snapshots are not sent anymore
+        with self.jobs_changed:
+            self.drop_pending_snapshots()
+            self.jobs.append((None, None))
+            self.jobs_changed.notify()
+
+    def run(self):
+        while True:
+            with self.jobs_changed:
+                while len(self.jobs) == 0:
+                    self.jobs_changed.wait()
+                job = self.jobs.popleft()
+            if job[1] is None:
+                break
+
+            try:
+                job[1](*job[2:])
+            except Exception as e:
+                print(f"Snapshot sender error: {e}")
+
+            if job[0] is not None:
+                with self.jobs_changed:
+                    self.queued_bytes -= job[0]
+
+        self.open_shared_ring(None, 0, 0)
+
+    def send_snapshot(self, snapshot, shared_image = None, release = None):
+        try:
+            self.encode_and_send(snapshot, shared_image)
+        finally:
+            if release is not None:
+                release()
+
+    def encode_and_send(self, snapshot, shared_image):
+        if self.connection_lost:
+            with self.jobs_changed:
+                self.nbr_dropped_snapshots += 1
+            return
+
+        if snapshot.fields & SENSING_IMAGE and snapshot.image is not None:
+            if shared_image is None:
+                shared_image = SharedImage(snapshot.image)
+            try:
+                snapshot.image, snapshot.image_encoding, snapshot.image_data = shared_image.get(self.image_preprocessor,
+                                                                                                self.image_encoder)
+            except ValueError as e:
+                #   Preprocessing does not fit the image size, the snapshot is sent without image
+                print(f"Image preprocessing error: {e}")
+                snapshot.image = None
+
+        try:
+            parts = self.snapshot_encoder.pack_parts(snapshot)
+            if self.shared_ring is not None:
+                #   The message goes into the ring without its size, the socket only carries where it is
+                written = self.shared_ring.write((parts[0][MESSAGE_SIZE.size:],) + parts[1:])
+                if written is not None:
+                    parts = (self.snapshot_encoder.pack_shared(*written),)
+            send_buffers(self.connection, parts)
+            with self.jobs_changed:
+                self.nbr_sent_snapshots += 1
+                self.sent_bytes += sum(len(part) for part in parts)
+        except socket.error as e:
+            #   A partially sent snapshot breaks the stream, the game loop sees the shutdown as a disconnection
+            print(f"Socket error: {e}")
+            self.connection_lost = True
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
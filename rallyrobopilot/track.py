@@ -1,27 +1,9 @@
 from ursina import *
 import json
 from direct.stdpy import thread
-from pathlib import Path
 import json
 
-
-def load_track_metadata(track_name):
-    """
-    Loads metadata for a given track.
-
-    Args:
-        track_name (str): The name of the track (which corresponds to the subfolder name in assets).
-
-    Returns:
-        dict: The metadata for the track.
-    """
-    # Construct the full package path for the track's metadata
-    root_dir = Path(__file__).resolve().parent.parent
-    asset_path = root_dir / f"assets/{track_name}/track_metadata.json"
-    with open(asset_path, "r") as f:
-        metadata = json.load(f)
-
-    return metadata
+from .track_geometry import compile_wall_index, compile_height_map, load_track_metadata
 
 
 class Track(Entity):
@@ -67,6 +49,20 @@ class Track(Entity):
                             position = origin_position, rotation_y = origin_rotation[1], 
                             scale = self.origin_scale[1], visible = False))
 
+        #   2D wall segments for fast collision checks, the mesh colliders above remain the fallback
+        try:
+            self.wall_index = compile_wall_index(track_name, self.data)
+        except Exception as e:
+            print("Could not compile wall index, using mesh colliders:", e)
+            self.wall_index = None
+
+        #   Ground height grid, None when the track metadata lists no ground meshes
+        try:
+            self.height_map = compile_height_map(track_name, self.data)
+        except Exception as e:
+            print("Could not compile height map:", e)
+            self.height_map = None
+
         self.disable()
         
         self.played = False
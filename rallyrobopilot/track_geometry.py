@@ -0,0 +1,568 @@
+"""
+    Render-free track geometry.
+
+    Track meshes are compiled once into compact 2D structures that answer the physics and sensing queries with plain
+    array lookups, instead of traversing Ursina mesh colliders every frame. Compiled data is cached on disk next to the
+    track assets.
+"""
+from math import floor, sqrt, radians, sin, cos, inf
+from pathlib import Path
+import json
+
+import numpy as np
+
+ASSETS_DIR = Path(__file__).resolve().parent.parent / "assets"
+
+#   Faces whose normal has a smaller vertical component are walls (same threshold as the car steep slope check)
+WALL_MAX_NORMAL_Y = 0.7
+
+#   Side of the uniform grid cells indexing the wall segments
+WALL_CELL_SIZE = 4.
+
+#   Side of the cells of the flattened grid used by the batched queries, finer cells mean fewer (ray, wall) pairs
+RAY_CELL_SIZE = 2.
+
+#   Rays intersected at once by the batched queries, bounds the size of the (ray, wall) pairs arrays
+RAY_CHUNK_SIZE = 4096
+
+#   Distances at which the batched queries check for hits before marching the rays further: most rays hit a nearby
+#   wall and stop after the first bands
+RAY_BANDS = (4., 8., 16., 32., 64.)
+
+#   Below this number of rays the overhead of the NumPy calls of each band outweighs marching, rays are intersected
+#   over their whole length at once
+RAY_MARCH_MIN_RAYS = 128
+
+#   Spacing of the ground height map samples
+HEIGHT_CELL_SIZE = 1.
+
+#   Default ray sensor layout, can be changed per session with the 'set ray' commands
+DEFAULT_NBR_RAYS = 15
+DEFAULT_HALF_ANGLE = 90
+MAX_RAYCAST_DIST = 100
+
+#   Height of the rays origin above the car center
+RAY_HEIGHT = 1
+
+
+def load_track_metadata(track_name):
+    """
+    Loads metadata for a given track.
+
+    Args:
+        track_name (str): The name of the track (which corresponds to the subfolder name in assets).
+
+    Returns:
+        dict: The metadata for the track.
+    """
+    with open(ASSETS_DIR / track_name / "track_metadata.json", "r") as f:
+        metadata = json.load(f)
+
+    return metadata
+
+
+def resolve_model_path(track_name, model):
+    """
+    Finds a model file the way Ursina does: relative to the repository, to the track folder or anywhere in assets
+    """
+    for candidate in [ASSETS_DIR.parent / model, ASSETS_DIR / track_name / model]:
+        if candidate.is_file():
+            return candidate
+
+    matches = sorted(ASSETS_DIR.glob("**/" + Path(model).name))
+    if len(matches) == 0:
+        raise FileNotFoundError("Model %s of track %s not found" % (model, track_name))
+    return matches[0]
+
+
+def load_obj_triangles(path, objects = None):
+    """
+    Loads the faces of an OBJ file as a (T, 3, 3) array of triangles, in Ursina coordinates (x axis flipped).
+    Only the faces of the named objects are kept when objects is given.
+    """
+    vertices = []
+    triangles = []
+    keep_faces = objects is None
+    with open(path, "r", encoding = "utf-8") as f:
+        for line in f:
+            if line.startswith("v "):
+                x, y, z = line.split()[1:4]
+                vertices.append((-float(x), float(y), float(z)))
+            elif line.startswith("o "):
+                keep_faces = objects is None or line[2:].strip() in objects
+            elif line.startswith("f ") and keep_faces:
+                indices = [int(token.split("/")[0]) for token in line.split()[1:]]
+                indices = [i - 1 if i > 0 else len(vertices) + i for i in indices]
+                #   Fan triangulation of polygons
+                for i in range(1, len(indices) - 1):
+                    triangles.append((indices[0], indices[i], indices[i + 1]))
+
+    vertices = np.array(vertices, dtype = np.float64).reshape(-1, 3)
+    return vertices[np.array(triangles, dtype = np.int64).reshape(-1, 3)]
+
+
+def transform_vertices(vertices, position = (0, 0, 0), rotation_y = 0, scale = (1, 1, 1)):
+    """
+    Applies an Ursina entity transform (scale, then rotation around y, then translation) to (..., 3) vertices
+    """
+    vertices = vertices * np.asarray(scale, dtype = np.float64)
+    angle = radians(rotation_y)
+    x = vertices[..., 0] * cos(angle) + vertices[..., 2] * sin(angle)
+    z = -vertices[..., 0] * sin(angle) + vertices[..., 2] * cos(angle)
+    return np.stack([x, vertices[..., 1], z], axis = -1) + np.asarray(position, dtype = np.float64)
+
+
+def load_track_meshes(track_name, metadata, meshes):
+    """
+    Returns the (T, 3, 3) world space triangles of track meshes ({"model": ..., "objects": [...]} entries of the
+    metadata), placed like Track places its obstacles and details
+    """
+    triangles = []
+    for mesh in meshes:
+        triangles.append(transform_vertices(load_obj_triangles(resolve_model_path(track_name, mesh["model"]), mesh.get("objects")),
+                                            metadata["origin_position"], metadata["origin_rotation"][1],
+                                            [metadata["origin_scale"][1]] * 3))
+    return np.concatenate(triangles) if len(triangles) > 0 else np.zeros((0, 3, 3))
+
+
+def is_cache_valid(cache_path, sources):
+    return cache_path.is_file() and all(cache_path.stat().st_mtime >= s.stat().st_mtime for s in sources)
+
+
+def cell_key(i, j):
+    """
+    Packs grid cell indices in a single sortable integer
+    """
+    return i * (1 << 32) + j
+
+
+def ragged_ranges(counts):
+    """
+    Returns the concatenation of arange(count) for every count
+    """
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+
+
+class WallIndex:
+    """
+    Obstacle walls as 2D segments in the XZ plane, bucketed in a uniform grid
+    """
+    def __init__(self, starts, ends, heights, cell_size = WALL_CELL_SIZE):
+        #   (S, 2) segment extremities in the XZ plane and (S, 2) min/max heights
+        self.starts = np.asarray(starts, dtype = np.float64).reshape(-1, 2)
+        self.ends = np.asarray(ends, dtype = np.float64).reshape(-1, 2)
+        self.heights = np.asarray(heights, dtype = np.float64).reshape(-1, 2)
+        self.cell_size = cell_size
+
+        #   Python copies for the scalar queries, which are faster than NumPy on a handful of segments
+        self.segments = [tuple(s) + tuple(e) + tuple(h) for s, e, h in zip(self.starts.tolist(), self.ends.tolist(), self.heights.tolist())]
+
+        self.cells = {}
+        for segment_id, (x0, z0, x1, z1, _, _) in enumerate(self.segments):
+            for cell in self.cells_along(x0, z0, x1, z1):
+                self.cells.setdefault(cell, []).append(segment_id)
+
+        #   Flattened grid of the batched queries. Segments are also registered in the cells surrounding their own, so
+        #   that sampling a ray once per cell length is enough to find every wall it crosses
+        dilated = {}
+        for segment_id, (x0, z0, x1, z1, _, _) in enumerate(self.segments):
+            for i, j in self.cells_along(x0, z0, x1, z1, RAY_CELL_SIZE):
+                for di in (-1, 0, 1):
+                    for dj in (-1, 0, 1):
+                        dilated.setdefault((i + di, j + dj), set()).add(segment_id)
+
+        cells = sorted(dilated)
+        self.cell_keys = np.array([cell_key(i, j) for i, j in cells], dtype = np.int64)
+        self.cell_offsets = np.cumsum([0] + [len(dilated[cell]) for cell in cells])
+        self.cell_segments = np.array([segment_id for cell in cells for segment_id in sorted(dilated[cell])], dtype = np.int64)
+
+        #   (S, 6) start, edge and height range of the segments, gathered in one go by the batched queries
+        self.wall_table = np.column_stack([self.starts, self.ends - self.starts, self.heights])
+
+    def __len__(self):
+        return len(self.segments)
+
+    @staticmethod
+    def from_triangles(triangles, cell_size = WALL_CELL_SIZE):
+        """
+        Extracts the wall segments of (T, 3, 3) world space triangles
+        """
+        triangles = np.asarray(triangles, dtype = np.float64).reshape(-1, 3, 3)
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        norms = np.linalg.norm(normals, axis = 1)
+        valid = norms > 1e-9
+        walls = triangles[valid][np.abs(normals[valid, 1] / norms[valid]) < WALL_MAX_NORMAL_Y]
+
+        #   A vertical triangle projects on a segment: keep its two most distant vertices in the XZ plane
+        flat = walls[:, :, [0, 2]]
+        pairs = [(0, 1), (1, 2), (2, 0)]
+        lengths = np.stack([np.linalg.norm(flat[:, a] - flat[:, b], axis = 1) for a, b in pairs], axis = 1)
+        longest = np.argmax(lengths, axis = 1)
+        first = np.array([a for a, b in pairs])[longest]
+        second = np.array([b for a, b in pairs])[longest]
+        rows = np.arange(len(walls))
+
+        kept = lengths[rows, longest] > 1e-6
+        starts = flat[rows, first][kept]
+        ends = flat[rows, second][kept]
+        heights = np.stack([walls[:, :, 1].min(axis = 1), walls[:, :, 1].max(axis = 1)], axis = 1)[kept]
+
+        return WallIndex(starts, ends, heights, cell_size)
+
+    def save(self, path):
+        np.savez(path, starts = self.starts, ends = self.ends, heights = self.heights, cell_size = self.cell_size)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return WallIndex(data["starts"], data["ends"], data["heights"], float(data["cell_size"]))
+
+    def cells_along(self, x0, z0, x1, z1, size = None):
+        """
+        Yields the grid cells crossed by the segment (x0, z0) -> (x1, z1), in the index grid unless another cell size is
+        given
+        """
+        size = size if size is not None else self.cell_size
+        i, j = floor(x0 / size), floor(z0 / size)
+        last_i, last_j = floor(x1 / size), floor(z1 / size)
+        dx, dz = x1 - x0, z1 - z0
+
+        step_i = 1 if dx > 0 else -1
+        step_j = 1 if dz > 0 else -1
+        t_delta_x = abs(size / dx) if dx != 0 else inf
+        t_delta_z = abs(size / dz) if dz != 0 else inf
+        t_max_x = ((i + (dx > 0)) * size - x0) / dx if dx != 0 else inf
+        t_max_z = ((j + (dz > 0)) * size - z0) / dz if dz != 0 else inf
+
+        yield (i, j)
+        for n in range(abs(last_i - i) + abs(last_j - j)):
+            if t_max_x < t_max_z:
+                t_max_x += t_delta_x
+                i += step_i
+            else:
+                t_max_z += t_delta_z
+                j += step_j
+            yield (i, j)
+
+    def cast(self, origin, direction, distance):
+        """
+        Casts a ray in the XZ plane against the walls spanning the origin height.
+        Same contract as the car_dynamics.step cast_obstacles callback: returns (hit_distance, world_normal) or None.
+        """
+        x, y, z = origin
+        dx, dz = direction[0], direction[2]
+        norm = sqrt(dx * dx + dz * dz)
+        if norm == 0:
+            return None
+        dx, dz = dx / norm, dz / norm
+        length = abs(distance)
+
+        candidates = set()
+        for cell in self.cells_along(x, z, x + dx * length, z + dz * length):
+            candidates.update(self.cells.get(cell, ()))
+
+        best_distance = inf
+        best_normal = None
+        for segment_id in candidates:
+            x0, z0, x1, z1, y_min, y_max = self.segments[segment_id]
+            if y < y_min or y > y_max:
+                continue
+
+            ex, ez = x1 - x0, z1 - z0
+            denom = dx * ez - dz * ex
+            if abs(denom) < 1e-12:
+                continue
+            wx, wz = x0 - x, z0 - z
+            t = (wx * ez - wz * ex) / denom
+            u = (wx * dz - wz * dx) / denom
+            if 0 <= t <= length and 0 <= u <= 1 and t < best_distance:
+                #   Normal of the wall facing the ray origin
+                nx, nz = -ez, ex
+                if nx * dx + nz * dz > 0:
+                    nx, nz = -nx, -nz
+                n = sqrt(nx * nx + nz * nz)
+                best_distance = t
+                best_normal = (nx / n, 0, nz / n)
+
+        if best_normal is None:
+            return None
+        return best_distance, best_normal
+
+
+    def intersect(self, origins, directions, lengths):
+        """
+        Batched ray queries in the XZ plane.
+
+        Args:
+            origins (np.ndarray): (N, 3) ray origins, only walls spanning the origin height are considered.
+            directions (np.ndarray): (N, 3) ray directions, the y component is ignored.
+            lengths (np.ndarray): (N,) ray lengths.
+
+        Returns:
+            (N,) distances to the nearest wall (inf if none within the ray length) and (N,) indices of these walls (-1).
+        """
+        origins = np.asarray(origins, dtype = np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype = np.float64).reshape(-1, 3)[:, [0, 2]]
+        lengths = np.abs(np.broadcast_to(np.asarray(lengths, dtype = np.float64), len(origins)))
+        directions = directions / np.maximum(np.linalg.norm(directions, axis = 1, keepdims = True), 1e-12)
+
+        distances = np.full(len(origins), inf)
+        hit_walls = np.full(len(origins), -1)
+        if len(self.segments) == 0:
+            return distances, hit_walls
+
+        for chunk_start in range(0, len(origins), RAY_CHUNK_SIZE):
+            pending = np.arange(chunk_start, min(chunk_start + RAY_CHUNK_SIZE, len(origins)))
+
+            #   March the rays band by band, a ray hitting a wall in a band is done as earlier bands were empty
+            band_start = 0.
+            for band_end in (RAY_BANDS if len(pending) >= RAY_MARCH_MIN_RAYS else ()) + (inf,):
+                pending = self.intersect_band(pending, origins, directions, lengths, band_start, band_end,
+                                              distances, hit_walls)
+                band_start = band_end
+                if len(pending) == 0:
+                    break
+
+        return distances, hit_walls
+
+    def intersect_band(self, rays, origins, directions, lengths, band_start, band_end, distances, hit_walls):
+        """
+        Intersects the [band_start, band_end] part of the rays, fills distances and hit_walls with the hits and returns
+        the rays to march further
+        """
+        band_lengths = np.minimum(lengths[rays], band_end)
+
+        #   (R, 6) origin, direction and band length of the rays
+        ray_table = np.column_stack([origins[rays], directions[rays], band_lengths])
+
+        #   Sample the rays once per cell length, the dilated grid gives the walls crossed around each sample
+        nbr_samples = np.ceil((band_lengths - band_start) / RAY_CELL_SIZE).astype(np.int64) + 1
+        sample_rays = np.repeat(np.arange(len(rays)), nbr_samples)
+        sample_t = np.minimum(band_start + ragged_ranges(nbr_samples) * RAY_CELL_SIZE, band_lengths[sample_rays])
+        r = ray_table[sample_rays]
+        keys = cell_key(np.floor((r[:, 0] + r[:, 3] * sample_t) / RAY_CELL_SIZE).astype(np.int64),
+                        np.floor((r[:, 2] + r[:, 4] * sample_t) / RAY_CELL_SIZE).astype(np.int64))
+
+        found = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        indexed = self.cell_keys[found] == keys
+        found, sample_rays = found[indexed], sample_rays[indexed]
+        counts = self.cell_offsets[found + 1] - self.cell_offsets[found]
+        pair_rays = np.repeat(sample_rays, counts)
+        walls = self.cell_segments[np.repeat(self.cell_offsets[found], counts) + ragged_ranges(counts)]
+
+        #   Segment intersection of every (ray, wall) pair, duplicated pairs give the same distance
+        r = ray_table[pair_rays]
+        w = self.wall_table[walls]
+        denom = r[:, 3] * w[:, 3] - r[:, 4] * w[:, 2]
+        wx = w[:, 0] - r[:, 0]
+        wz = w[:, 1] - r[:, 2]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            t = (wx * w[:, 3] - wz * w[:, 2]) / denom
+            u = (wx * r[:, 4] - wz * r[:, 3]) / denom
+
+        valid = ((np.abs(denom) >= 1e-12) & (t >= band_start) & (t <= r[:, 5]) & (u >= 0) & (u <= 1) &
+                 (r[:, 1] >= w[:, 4]) & (r[:, 1] <= w[:, 5]))
+        pair_rays, walls, t = pair_rays[valid], walls[valid], t[valid]
+
+        #   Nearest wall of each ray: first pair of each ray once sorted by distance
+        order = np.lexsort((t, pair_rays))
+        pair_rays, walls, t = pair_rays[order], walls[order], t[order]
+        first = np.ones(len(pair_rays), dtype = bool)
+        first[1:] = pair_rays[1:] != pair_rays[:-1]
+
+        hit = np.zeros(len(rays), dtype = bool)
+        hit[pair_rays[first]] = True
+        distances[rays[pair_rays[first]]] = t[first]
+        hit_walls[rays[pair_rays[first]]] = walls[first]
+
+        return rays[~hit & (lengths[rays] > band_end)]
+
+    def cast_rays(self, origins, directions, max_distance):
+        """
+        Returns the (N,) distances to the nearest walls along the rays, max_distance when nothing is hit
+        """
+        distances, _ = self.intersect(origins, directions, max_distance)
+        return np.minimum(distances, max_distance)
+
+    def cast_many(self, origins, directions, distances):
+        """
+        Batched counterpart of cast, following the BatchCarSimulator.step cast_obstacles contract: returns the (N,) hit
+        distances (inf when nothing is hit) and the (N, 3) wall normals facing the rays
+        """
+        hit_distances, hit_walls = self.intersect(origins, directions, distances)
+        hit = hit_walls >= 0
+
+        edges = self.ends[hit_walls] - self.starts[hit_walls]
+        normals = np.zeros((len(hit_walls), 3))
+        normals[:, 0] = -edges[:, 1]
+        normals[:, 2] = edges[:, 0]
+        facing = np.sign(np.einsum("ij,ij->i", normals, np.asarray(directions, dtype = np.float64).reshape(-1, 3)))
+        normals *= np.where(facing > 0, -1., 1.)[:, None]
+        normals /= np.maximum(np.linalg.norm(normals, axis = 1, keepdims = True), 1e-12)
+        normals[~hit] = 0
+
+        return hit_distances, normals
+
+
+def fan_angles(nbr_rays, half_angle):
+    """
+    Returns the (R,) angles of R rays evenly spread over [-half_angle, half_angle] (degrees), a single ray looks forward
+    """
+    return np.linspace(-half_angle, half_angle, nbr_rays) if nbr_rays > 1 else np.zeros(nbr_rays)
+
+
+def fan_directions(rotation_y, nbr_rays, half_angle):
+    """
+    Returns the (N, R, 3) directions of R rays spread over [-half_angle, half_angle] around N headings (degrees)
+    """
+    angles = np.radians(np.asarray(rotation_y, dtype = np.float64).reshape(-1, 1) + fan_angles(nbr_rays, half_angle)[None, :])
+    directions = np.zeros(angles.shape + (3,))
+    directions[..., 0] = np.sin(angles)
+    directions[..., 2] = np.cos(angles)
+    return directions
+
+
+def compile_wall_index(track_name, metadata, use_cache = True):
+    """
+    Builds the wall index of a track, or loads it from the cache when it is newer than the obstacle models
+    """
+    cache_path = ASSETS_DIR / track_name / "wall_index.npz"
+    sources = [resolve_model_path(track_name, obstacle["model"]) for obstacle in metadata["obstacles"]]
+    sources.append(ASSETS_DIR / track_name / "track_metadata.json")
+
+    if use_cache and is_cache_valid(cache_path, sources):
+        return WallIndex.load(cache_path)
+
+    index = WallIndex.from_triangles(load_track_meshes(track_name, metadata, metadata["obstacles"]))
+    if use_cache:
+        try:
+            index.save(cache_path)
+        except OSError as e:
+            print("Could not cache wall index:", e)
+    return index
+
+
+class HeightMap:
+    """
+    Ground height and normal sampled on a regular XZ grid, NaN where there is no ground
+    """
+    def __init__(self, origin, heights, normals, cell_size = HEIGHT_CELL_SIZE):
+        #   World XZ position of sample [0, 0], (W, D) heights along x and z and (W, D, 3) unit normals
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.heights = np.asarray(heights, dtype = np.float32)
+        self.normals = np.asarray(normals, dtype = np.float32)
+        self.cell_size = cell_size
+
+    @staticmethod
+    def from_triangles(triangles, cell_size = HEIGHT_CELL_SIZE):
+        """
+        Rasterizes the highest walkable surface of (T, 3, 3) world space triangles
+        """
+        triangles = np.asarray(triangles, dtype = np.float64).reshape(-1, 3, 3)
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        norms = np.linalg.norm(normals, axis = 1)
+        valid = norms > 1e-9
+        normals = normals[valid] / norms[valid, None]
+        triangles = triangles[valid]
+
+        #   Keep the faces flat enough to drive on, normals pointing up
+        normals *= np.sign(normals[:, 1:2])
+        walkable = normals[:, 1] > WALL_MAX_NORMAL_Y
+        triangles, normals = triangles[walkable], normals[walkable]
+
+        if len(triangles) == 0:
+            return HeightMap((0, 0), np.full((1, 1), np.nan), np.zeros((1, 1, 3)), cell_size)
+
+        origin = np.floor(triangles[:, :, [0, 2]].reshape(-1, 2).min(axis = 0) / cell_size) * cell_size
+        extent = np.ceil((triangles[:, :, [0, 2]].reshape(-1, 2).max(axis = 0) - origin) / cell_size).astype(int) + 1
+        heights = np.full(extent, -np.inf)
+        grid_normals = np.zeros((extent[0], extent[1], 3))
+
+        for triangle, normal in zip(triangles, normals):
+            flat = (triangle[:, [0, 2]] - origin) / cell_size
+            i0, j0 = np.ceil(flat.min(axis = 0)).astype(int)
+            i1, j1 = np.floor(flat.max(axis = 0)).astype(int)
+            if i1 < i0 or j1 < j0:
+                continue
+
+            #   Barycentric coordinates of the samples covered by the triangle bounding box
+            ii, jj = np.meshgrid(np.arange(i0, i1 + 1), np.arange(j0, j1 + 1), indexing = "ij")
+            (ax, az), (bx, bz), (cx, cz) = flat
+            denom = (bz - cz) * (ax - cx) + (cx - bx) * (az - cz)
+            if abs(denom) < 1e-12:
+                continue
+            w0 = ((bz - cz) * (ii - cx) + (cx - bx) * (jj - cz)) / denom
+            w1 = ((cz - az) * (ii - cx) + (ax - cx) * (jj - cz)) / denom
+            w2 = 1 - w0 - w1
+            inside = (w0 >= -1e-9) & (w1 >= -1e-9) & (w2 >= -1e-9)
+
+            sample_heights = w0 * triangle[0, 1] + w1 * triangle[1, 1] + w2 * triangle[2, 1]
+            higher = inside & (sample_heights > heights[ii, jj])
+            heights[ii[higher], jj[higher]] = sample_heights[higher]
+            grid_normals[ii[higher], jj[higher]] = normal
+
+        heights[np.isinf(heights)] = np.nan
+        return HeightMap(origin, heights, grid_normals, cell_size)
+
+    def save(self, path):
+        np.savez_compressed(path, origin = self.origin, heights = self.heights, normals = self.normals, cell_size = self.cell_size)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return HeightMap(data["origin"], data["heights"], data["normals"], float(data["cell_size"]))
+
+    def sample(self, x, z):
+        """
+        Returns the bilinearly interpolated (height, normal) of the ground below (x, z), or None out of the ground
+        """
+        u = (x - self.origin[0]) / self.cell_size
+        v = (z - self.origin[1]) / self.cell_size
+        i, j = floor(u), floor(v)
+        if i < 0 or j < 0 or i + 1 >= self.heights.shape[0] or j + 1 >= self.heights.shape[1]:
+            return None
+        fu, fv = u - i, v - j
+
+        #   Samples missing on the edge of the ground are left out of the interpolation
+        height = 0.
+        normal_x = normal_y = normal_z = 0.
+        total_weight = 0.
+        for di, dj, weight in ((0, 0, (1 - fu) * (1 - fv)), (1, 0, fu * (1 - fv)), (0, 1, (1 - fu) * fv), (1, 1, fu * fv)):
+            sample_height = self.heights.item(i + di, j + dj)
+            if sample_height != sample_height or weight == 0:
+                continue
+            height += weight * sample_height
+            normal_x += weight * self.normals.item(i + di, j + dj, 0)
+            normal_y += weight * self.normals.item(i + di, j + dj, 1)
+            normal_z += weight * self.normals.item(i + di, j + dj, 2)
+            total_weight += weight
+
+        if total_weight == 0:
+            return None
+        norm = sqrt(normal_x * normal_x + normal_y * normal_y + normal_z * normal_z)
+        return height / total_weight, (normal_x / norm, normal_y / norm, normal_z / norm)
+
+
+def compile_height_map(track_name, metadata, use_cache = True):
+    """
+    Builds the ground height map of a track from the meshes listed under "ground" in its metadata, or loads it from
+    the cache when it is newer than these meshes. Returns None for tracks without ground meshes.
+    """
+    if "ground" not in metadata:
+        return None
+
+    cache_path = ASSETS_DIR / track_name / "height_map.npz"
+    sources = [resolve_model_path(track_name, mesh["model"]) for mesh in metadata["ground"]]
+    sources.append(ASSETS_DIR / track_name / "track_metadata.json")
+
+    if use_cache and is_cache_valid(cache_path, sources):
+        return HeightMap.load(cache_path)
+
+    height_map = HeightMap.from_triangles(load_track_meshes(track_name, metadata, metadata["ground"]))
+    if use_cache:
+        try:
+            height_map.save(cache_path)
+        except OSError as e:
+            print("Could not cache height map:", e)
+    return height_map
@@ -0,0 +1,137 @@
+"""
+    Gym-style vectorized environment.
+
+    VectorRallyEnv runs several simulations, each in its own worker process, and advances them in lockstep.
+    Observations of all simulations are returned batched in NumPy arrays:
+        position            (M, 3) float32
+        angle               (M,)   float32
+        speed               (M,)   float32
+        raycast_distances   (M, R) float32
+        image               (M, H, W, 3) uint8, only with the game backend and image = True
+"""
+import multiprocessing
+import os
+
+import numpy as np
+
+from .simulation import SIMULATION_BACKENDS
+
+
+def stack_observations(observations):
+    return {key: np.stack([observation[key] for observation in observations]) for key in observations[0]}
+
+
+def simulation_worker(connection, backend, simulation_kwargs):
+    simulation = SIMULATION_BACKENDS[backend](**simulation_kwargs)
+
+    while True:
+        command, data = connection.recv()
+
+        if command == "step":
+            controls, nbr_ticks = data
+            observation, reward, done = simulation.step(controls, nbr_ticks)
+
+            #   Lost cars are reset right away, the reset observation is returned in place of the final one
+            if done:
+                observation = simulation.reset()
+            connection.send((observation, reward, done))
+
+        elif command == "reset":
+            connection.send(simulation.reset())
+
+        elif command == "save_state":
+            connection.send(simulation.save_state())
+
+        elif command == "load_state":
+            connection.send(simulation.load_state(data))
+
+        elif command == "close":
+            connection.close()
+            break
+
+
+class VectorRallyEnv:
+    def __init__(self, nbr_envs = None, backend = "headless", ticks_per_step = 6, **simulation_kwargs):
+        """
+        Args:
+            nbr_envs (int): Number of simulations, one per CPU core by default.
+            backend (str): "game" to start the full game through prepare_game_app (offscreen by default), "headless"
+                to only run the render-free physics core.
+            ticks_per_step (int): Fixed physics ticks run by each call to step.
+            simulation_kwargs: Forwarded to the simulation constructor (e.g. track_name, image).
+        """
+        self.nbr_envs = nbr_envs if nbr_envs is not None else os.cpu_count()
+        self.ticks_per_step = ticks_per_step
+
+        #   Panda3D does not survive a fork, workers start from a fresh interpreter
+        context = multiprocessing.get_context("spawn")
+
+        self.connections = []
+        self.processes = []
+        for i in range(self.nbr_envs):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target = simulation_worker, args = (child_connection, backend, simulation_kwargs), daemon = True)
+            process.start()
+            child_connection.close()
+
+            self.connections.append(parent_connection)
+            self.processes.append(process)
+
+    def __len__(self):
+        return self.nbr_envs
+
+    def reset(self):
+        for connection in self.connections:
+            connection.send(("reset", None))
+        return stack_observations([connection.recv() for connection in self.connections])
+
+    def step(self, actions):
+        """
+        Args:
+            actions (np.ndarray): (M, 4) array of (forward, back, left, right) controls.
+
+        Returns:
+            observations (dict), rewards (M,) signed distance driven during the step, dones (M,) whether the car got
+            lost and was reset, infos (list of dict).
+        """
+        actions = np.asarray(actions, dtype = bool)
+        for connection, controls in zip(self.connections, actions.tolist()):
+            connection.send(("step", (controls, self.ticks_per_step)))
+
+        observations, rewards, dones = zip(*[connection.recv() for connection in self.connections])
+        return (stack_observations(observations), np.array(rewards, dtype = np.float32), np.array(dones),
+                [{} for i in range(self.nbr_envs)])
+
+    def save_states(self):
+        """
+        Returns the binary state of each simulation, to be restored later with load_states
+        """
+        for connection in self.connections:
+            connection.send(("save_state", None))
+        return [connection.recv() for connection in self.connections]
+
+    def load_states(self, states):
+        """
+        Rewinds every simulation to a state returned by save_states and returns the matching observations
+        """
+        for connection, state in zip(self.connections, states):
+            connection.send(("load_state", state))
+        return stack_observations([connection.recv() for connection in self.connections])
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(("close", None))
+                connection.close()
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout = 5)
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,47 @@
+import time
+
+import numpy as np
+
+from rallyrobopilot.car_dynamics import CarState, step
+from rallyrobopilot.batch_dynamics import BatchCarSimulator
+
+"""
+Benchmarks BatchCarSimulator.step against the scalar car_dynamics.step for a growing number of cars.
+Reports the number of simulation steps (all cars advanced once) and car steps per second.
+"""
+
+NBR_STEPS = 200
+
+
+def random_controls(nbr_cars, nbr_steps, seed = 0):
+    rng = np.random.default_rng(seed)
+    return rng.random((nbr_steps, nbr_cars, 4)) < 0.5
+
+
+def benchmark_batch(nbr_cars):
+    simulator = BatchCarSimulator(nbr_cars)
+    controls = random_controls(nbr_cars, NBR_STEPS)
+
+    start = time.perf_counter()
+    for i in range(NBR_STEPS):
+        simulator.step(controls[i])
+    return time.perf_counter() - start
+
+
+def benchmark_scalar(nbr_cars):
+    states = [CarState() for i in range(nbr_cars)]
+    controls = random_controls(nbr_cars, NBR_STEPS).tolist()
+
+    start = time.perf_counter()
+    for i in range(NBR_STEPS):
+        for state, car_controls in zip(states, controls[i]):
+            step(state, car_controls)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    print("%8s | %14s | %16s | %16s" % ("cars", "steps/s", "car steps/s", "scalar car st/s"))
+    for nbr_cars in [1, 10, 100, 1000, 10000, 100000]:
+        duration = benchmark_batch(nbr_cars)
+        scalar = ("%16.0f" % (NBR_STEPS * nbr_cars / benchmark_scalar(nbr_cars))) if nbr_cars <= 1000 else "%16s" % "-"
+        print("%8d | %14.0f | %16.0f | %s" % (nbr_cars, NBR_STEPS / duration, NBR_STEPS * nbr_cars / duration, scalar))
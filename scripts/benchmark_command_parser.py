@@ -0,0 +1,64 @@
+import time
+
+from rallyrobopilot.remote_commands import RemoteCommandParser, pack_command_frame
+
+"""
+Benchmarks the remote command parser on bursts of commands, as a client sending faster than the game loop polls.
+Reports the commands per second of tokenizing (add) and parsing (parse_next_command) each burst.
+
+Bursts are received either as a single chunk or split into socket sized chunks cutting commands and frames:
+    python benchmark_command_parser.py
+"""
+
+BURST_SIZE = 10000
+CHUNK_SIZES = [None, 1024]
+NBR_RUNS = 5
+
+TEXT_COMMANDS = [
+    b'push forward;',
+    b'release left;',
+    b'set position 1.34,12,43.5;',
+    b'set rotation 234;',
+    b'set camera size 128 96;',
+    b'set image crop 0 0 64 48;',
+    b'step 4;',
+    b'reset;',
+]
+
+
+def text_burst(nbr_commands):
+    return b''.join(TEXT_COMMANDS[i % len(TEXT_COMMANDS)] for i in range(nbr_commands))
+
+
+def frame_burst(nbr_commands):
+    return b'set protocol binary;' + b''.join(pack_command_frame(i, (1, 0, i % 2, 0), ticks = 1) for i in range(nbr_commands - 1))
+
+
+def benchmark_burst(burst, nbr_commands, chunk_size):
+    chunks = [burst] if chunk_size is None else [burst[i:i + chunk_size] for i in range(0, len(burst), chunk_size)]
+
+    add_time, parse_time = float("inf"), float("inf")
+    for run in range(NBR_RUNS):
+        parser = RemoteCommandParser()
+
+        start = time.perf_counter()
+        for chunk in chunks:
+            parser.add(chunk)
+        add_time = min(add_time, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        while len(parser) > 0:
+            parser.parse_next_command()
+        parse_time = min(parse_time, time.perf_counter() - start)
+
+    return nbr_commands / add_time, nbr_commands / parse_time, nbr_commands / (add_time + parse_time)
+
+
+if __name__ == "__main__":
+    print("%d commands per burst, best of %d runs" % (BURST_SIZE, NBR_RUNS))
+    print("%8s | %8s | %12s | %12s | %12s" % ("commands", "chunks", "add cmd/s", "parse cmd/s", "total cmd/s"))
+    for name, burst in [("text", text_burst(BURST_SIZE)), ("frames", frame_burst(BURST_SIZE))]:
+        for chunk_size in CHUNK_SIZES:
+            add_rate, parse_rate, total_rate = benchmark_burst(burst, BURST_SIZE, chunk_size)
+            chunks = "whole" if chunk_size is None else "%d B" % chunk_size
+            print("%8s | %8s | %12.0f | %12.0f | %12.0f" % (name, chunks, add_rate, parse_rate, total_rate))
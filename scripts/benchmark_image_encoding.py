@@ -0,0 +1,86 @@
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from rallyrobopilot.car_dynamics import FIXED_TIMESTEP
+from rallyrobopilot.image_encoding import ImageEncoder, ImageDecoder, IMAGE_RAW, IMAGE_JPEG, IMAGE_PNG, IMAGE_DELTA
+
+"""
+Benchmarks the snapshot image encodings on sensing camera images rendered while driving on the bundled tracks.
+Reports the bytes per frame and the encode and decode milliseconds per frame of each encoding.
+
+Frames are one realtime sensing period apart, which matters for the delta encoding. Each track runs in its own process
+as the game app can only be started once:
+    python benchmark_image_encoding.py              all bundled tracks
+    python benchmark_image_encoding.py SimpleTrack  a single track
+"""
+
+TRACKS = ["SimpleTrack", "NotSoSimpleTrack", "SlightlyHarder", "VisualTrack"]
+IMAGE_SIZES = [(128, 96), (640, 480)]
+NBR_FRAMES = 50
+SENSING_PERIOD = 0.1
+
+#   Name, encoding and JPEG quality
+ENCODINGS = [
+    ("raw", IMAGE_RAW, 90),
+    ("jpeg q90", IMAGE_JPEG, 90),
+    ("jpeg q50", IMAGE_JPEG, 50),
+    ("png", IMAGE_PNG, 90),
+    ("delta", IMAGE_DELTA, 90),
+]
+
+
+def render_frames(simulation, size, nbr_frames, seed = 0):
+    rng = np.random.default_rng(seed)
+    simulation.car.camera_sensor.configure(size = size)
+    simulation.reset()
+
+    ticks = max(1, round(SENSING_PERIOD / FIXED_TIMESTEP))
+    frames = []
+    for i in range(nbr_frames):
+        controls = (1, 0, rng.random() < 0.3, rng.random() < 0.3)
+        observation, _, _ = simulation.step(controls, ticks)
+        frames.append(observation["image"])
+    return frames
+
+
+def benchmark_encoding(frames, encoding, quality):
+    encoder = ImageEncoder(encoding, quality)
+    decoder = ImageDecoder()
+    h, w = frames[0].shape[:2]
+
+    start = time.perf_counter()
+    encoded = [encoder.encode(frame) for frame in frames]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for frame_encoding, data in encoded:
+        decoder.decode(frame_encoding, h, w, data)
+    decode_time = time.perf_counter() - start
+
+    nbr_bytes = sum(len(data) for frame_encoding, data in encoded) / len(frames)
+    return nbr_bytes, 1000 * encode_time / len(frames), 1000 * decode_time / len(frames)
+
+
+def benchmark_track(track_name):
+    from rallyrobopilot.simulation import GameSimulation
+    simulation = GameSimulation(track_name, image = True, offscreen = True)
+
+    for size in IMAGE_SIZES:
+        frames = render_frames(simulation, size, NBR_FRAMES)
+        print("%s %dx%d, %d frames" % (track_name, size[0], size[1], len(frames)))
+        print("%10s | %12s | %9s | %9s" % ("encoding", "bytes/frame", "encode ms", "decode ms"))
+        for name, encoding, quality in ENCODINGS:
+            nbr_bytes, encode_ms, decode_ms = benchmark_encoding(frames, encoding, quality)
+            print("%10s | %12.0f | %9.3f | %9.3f" % (name, nbr_bytes, encode_ms, decode_ms))
+        print()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark_track(sys.argv[1])
+    else:
+        for track_name in TRACKS:
+            subprocess.run([sys.executable, __file__, track_name], check = True)
@@ -0,0 +1,93 @@
+import sys
+import time
+
+import numpy as np
+
+from rallyrobopilot.track_geometry import (load_track_metadata, compile_wall_index, compile_height_map, fan_directions,
+                                          MAX_RAYCAST_DIST, RAY_HEIGHT)
+from rallyrobopilot.car_dynamics import DEFAULT_PARAMETERS
+
+"""
+Benchmarks the ray sensing paths in rays per second, for a growing number of cars placed at random on the track ground
+and carrying a 15 rays sensor (--rays n for denser, lidar-like sensors):
+    - batched: one WallIndex.cast_rays call for all the rays
+    - per ray: one WallIndex.cast call per ray
+    - ursina (run with --ursina): one Ursina raycast per ray against the track mesh colliders, the former path
+"""
+
+TRACK_NAME = "SimpleTrack"
+NBR_RAYS = 15
+HALF_ANGLE = 90
+
+
+def random_rays(wall_index, height_map, nbr_cars, nbr_rays, seed = 0):
+    rng = np.random.default_rng(seed)
+    low, high = wall_index.starts.min(axis = 0), wall_index.starts.max(axis = 0)
+    positions = []
+    while len(positions) < nbr_cars:
+        x, z = rng.uniform(low[0], high[0]), rng.uniform(low[1], high[1])
+        ground = height_map.sample(x, z)
+        if ground is not None:
+            positions.append((x, ground[0] + DEFAULT_PARAMETERS.ground_clearance + RAY_HEIGHT, z))
+
+    origins = np.repeat(np.array(positions), nbr_rays, axis = 0)
+    directions = fan_directions(rng.uniform(0, 360, nbr_cars), nbr_rays, HALF_ANGLE).reshape(-1, 3)
+    return origins, directions
+
+
+def benchmark_batched(wall_index, origins, directions, repeats = 20):
+    start = time.perf_counter()
+    for i in range(repeats):
+        wall_index.cast_rays(origins, directions, MAX_RAYCAST_DIST)
+    return len(origins) * repeats / (time.perf_counter() - start)
+
+
+def benchmark_per_ray(wall_index, origins, directions):
+    origins, directions = origins.tolist(), directions.tolist()
+    start = time.perf_counter()
+    for origin, direction in zip(origins, directions):
+        wall_index.cast(origin, direction, MAX_RAYCAST_DIST)
+    return len(origins) / (time.perf_counter() - start)
+
+
+def setup_ursina():
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("", "window-type offscreen")
+
+    from ursina import Ursina, application
+    from rallyrobopilot.track import Track
+
+    app = Ursina()
+    application.asset_folder = application.asset_folder.parent
+    track = Track(TRACK_NAME)
+    track.activate()
+    return app
+
+
+def benchmark_ursina(origins, directions):
+    from ursina import raycast, Vec3
+
+    start = time.perf_counter()
+    for origin, direction in zip(origins.tolist(), directions.tolist()):
+        raycast(origin = Vec3(*origin), direction = Vec3(*direction), distance = MAX_RAYCAST_DIST)
+    return len(origins) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    with_ursina = "--ursina" in sys.argv
+    nbr_rays = int(sys.argv[sys.argv.index("--rays") + 1]) if "--rays" in sys.argv else NBR_RAYS
+    if with_ursina:
+        app = setup_ursina()
+
+    metadata = load_track_metadata(TRACK_NAME)
+    wall_index = compile_wall_index(TRACK_NAME, metadata)
+    height_map = compile_height_map(TRACK_NAME, metadata)
+    print("%s: %d wall segments, %d rays per car" % (TRACK_NAME, len(wall_index), nbr_rays))
+
+    print("%8s | %14s | %14s | %14s" % ("cars", "batched rays/s", "per ray rays/s", "ursina rays/s"))
+    for nbr_cars in [1, 10, 100, 1000]:
+        origins, directions = random_rays(wall_index, height_map, nbr_cars, nbr_rays)
+        batched = benchmark_batched(wall_index, origins, directions)
+        per_ray = benchmark_per_ray(wall_index, origins, directions)
+        ursina = ("%14.0f" % benchmark_ursina(origins, directions)) if with_ursina and nbr_cars <= 100 else "%14s" % "-"
+        print("%8d | %14.0f | %14.0f | %s" % (nbr_cars, batched, per_ray, ursina))
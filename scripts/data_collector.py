@@ -78,6 +78,7 @@ class DataCollectionUI(QtWidgets.QMainWindow):
 
         self.network_interface.send_cmd("set position "+ str(self.recorded_data[-1].car_position)[1:-1].replace(" ","")+";")
         self.network_interface.send_cmd("set rotation "+ str(self.recorded_data[-1].car_angle)+";")
+        self.network_interface.send_cmd("set speed "+ str(self.recorded_data[-1].car_speed)+";")
         self.network_interface.send_cmd("reset;")
 
         self.toggleRecord()
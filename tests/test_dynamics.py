@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+from rallyrobopilot.batch_dynamics import BatchCarSimulator
+from rallyrobopilot.car_dynamics import CarState, DEFAULT_PARAMETERS, FIXED_TIMESTEP, step
+from rallyrobopilot.track_geometry import load_track_metadata, compile_wall_index
+
+NBR_CARS = 16
+NBR_STEPS = 300
+
+#   Wall along the x axis, in front of the cars starting at the origin with rotation_y = 0
+WALL_Z = 10
+
+
+def cast_wall(origin, direction, distance):
+    if direction[2] <= 0:
+        return None
+    hit_distance = (WALL_Z - origin[2]) / direction[2]
+    if hit_distance < 0 or hit_distance > distance:
+        return None
+    return hit_distance, (0, 0, -1)
+
+
+def cast_wall_many(origins, directions, distances):
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        hit_distances = (WALL_Z - origins[:, 2]) / directions[:, 2]
+    missed = (directions[:, 2] <= 0) | (hit_distances < 0) | (hit_distances > distances)
+    normals = np.zeros((len(origins), 3))
+    normals[:, 2] = -1
+    return np.where(missed, np.inf, hit_distances), normals
+
+
+def drive(state, controls, duration, cast_obstacles = None):
+    for i in range(round(duration / FIXED_TIMESTEP)):
+        step(state, controls, cast_obstacles = cast_obstacles)
+    return state
+
+
+def test_throttle_accelerates_up_to_top_speed():
+    state = drive(CarState(), (1, 0, 0, 0), 5)
+    assert state.speed == DEFAULT_PARAMETERS.topspeed
+    assert state.x == pytest.approx(0)
+    assert state.z > 100
+
+
+def test_friction_and_brakes_slow_the_car_down():
+    coasting = drive(CarState(speed = 30), (0, 0, 0, 0), 1)
+    braking = drive(CarState(speed = 30), (0, 1, 0, 0), 1)
+    assert 1 < coasting.speed < 30
+    #   Brakes down to standstill, then reverse
+    assert braking.speed < 0
+
+
+@pytest.mark.parametrize("controls, sign", [((1, 0, 0, 1), 1), ((1, 0, 1, 0), -1)])
+def test_steering_turns_towards_the_pressed_side(controls, sign):
+    state = drive(CarState(), controls, 0.5)
+    assert state.rotation_y * sign > 0
+    assert state.x * sign > 0
+
+
+def test_same_controls_give_same_states():
+    controls = [(i % 3 == 0, i % 7 == 0, i % 5 == 0, i % 4 == 0) for i in range(300)]
+    states = [CarState((1, 0, 2), 30), CarState((1, 0, 2), 30)]
+    for car_controls in controls:
+        for state in states:
+            step(state, car_controls)
+    assert states[0].position == states[1].position
+    assert states[0].rotation_y == states[1].rotation_y
+
+
+@pytest.mark.parametrize("normal, hitting_wall", [((0, 1, 0), False), ((0.8, 0.6, 0), True)])
+def test_steep_ground_is_reported_as_wall(normal, hitting_wall):
+    state = CarState((0, DEFAULT_PARAMETERS.ground_clearance, 0))
+    step(state, (1, 0, 0, 0), sample_ground = lambda x, z: (0, normal))
+    assert state.hitting_wall == hitting_wall
+
+
+def test_obstacles_stop_the_car():
+    state = drive(CarState(), (1, 0, 0, 0), 5, cast_wall)
+    assert state.z < WALL_Z
+    assert abs(state.speed) < DEFAULT_PARAMETERS.topspeed
+
+
+def random_controls(seed = 0):
+    rng = np.random.default_rng(seed)
+    return rng.random((NBR_STEPS, NBR_CARS, 4)) < 0.5
+
+
+def run_both(states, controls, cast_obstacles = None, cast_many = None):
+    simulator = BatchCarSimulator(len(states))
+    for index, state in enumerate(states):
+        simulator.set_state(index, state)
+
+    for i in range(len(controls)):
+        simulator.step(controls[i], cast_obstacles = cast_many)
+        for state, car_controls in zip(states, controls[i].tolist()):
+            step(state, car_controls, cast_obstacles = cast_obstacles)
+    return simulator
+
+
+def assert_same_states(simulator, states):
+    for index, state in enumerate(states):
+        batch_state = simulator.get_state(index)
+        np.testing.assert_allclose(batch_state.position, state.position, rtol = 1e-9, atol = 1e-6)
+        assert batch_state.rotation_y == pytest.approx(state.rotation_y, abs = 1e-6)
+        assert batch_state.speed == pytest.approx(state.speed, abs = 1e-6)
+
+
+def test_batch_matches_scalar_dynamics():
+    rng = np.random.default_rng(1)
+    states = [CarState((x, 0, z), angle) for x, z, angle in rng.uniform(-50, 50, (NBR_CARS, 3))]
+    simulator = run_both(states, random_controls())
+    assert_same_states(simulator, states)
+
+
+def test_batch_matches_scalar_dynamics_against_obstacles():
+    states = [CarState((i, 0, 0), 90 * i / NBR_CARS - 45) for i in range(NBR_CARS)]
+    controls = random_controls(3)
+    controls[:, :, 0] = True
+    controls[:, :, 1] = False
+
+    simulator = run_both(states, controls, cast_wall, cast_wall_many)
+    assert all(state.z < WALL_Z for state in states)
+    assert_same_states(simulator, states)
+
+
+def test_batch_matches_scalar_dynamics_against_walls():
+    metadata = load_track_metadata("SimpleTrack")
+    wall_index = compile_wall_index("SimpleTrack", metadata)
+    position = metadata["car_default_reset_position"]
+    angle = metadata["car_default_reset_orientation"][1]
+    states = [CarState(position, angle + 360 * i / NBR_CARS) for i in range(NBR_CARS)]
+
+    #   Full throttle, so that the cars reach the walls
+    controls = random_controls(2)
+    controls[:, :, 0] = True
+    controls[:, :, 1] = False
+
+    nbr_hits = [0]
+    def cast_many(origins, directions, distances):
+        hit_distances, normals = wall_index.cast_many(origins, directions, distances)
+        nbr_hits[0] += np.count_nonzero(hit_distances < distances)
+        return hit_distances, normals
+
+    simulator = run_both(states, controls, wall_index.cast, cast_many)
+    assert nbr_hits[0] > 0
+    assert_same_states(simulator, states)
@@ -0,0 +1,59 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+#   Importing one of these modules fails on machines without a display
+BLOCK_URSINA = """
+import sys
+for module in ("ursina", "panda3d", "direct", "flask"):
+    sys.modules[module] = None
+"""
+
+
+def run_without_ursina(code):
+    return subprocess.run([sys.executable, "-c", BLOCK_URSINA + code], cwd = ROOT_DIR, capture_output = True, text = True)
+
+
+def test_headless_simulation_imports_without_ursina():
+    result = run_without_ursina("""
+from rallyrobopilot.simulation import HeadlessSimulation
+from rallyrobopilot import HeadlessSimulation, VectorRallyEnv, NetworkDataCmdInterface, AsyncSimulatorClient
+from rallyrobopilot.car_dynamics import step
+from rallyrobopilot.batch_dynamics import BatchCarSimulator
+""")
+    assert result.returncode == 0, result.stderr
+
+
+def test_star_import_without_ursina():
+    result = run_without_ursina("""
+from rallyrobopilot import *
+assert "NetworkDataCmdInterface" in globals() and "Car" not in globals()
+""")
+    assert result.returncode == 0, result.stderr
+
+
+def test_headless_simulation_runs_without_ursina():
+    result = run_without_ursina("""
+from rallyrobopilot.simulation import HeadlessSimulation
+simulation = HeadlessSimulation("SimpleTrack")
+observation, travelled, done = simulation.step((1, 0, 0, 0), 10)
+assert observation["raycast_distances"].shape == (15,)
+assert travelled > 0 and not done
+""")
+    assert result.returncode == 0, result.stderr
+
+
+def test_ursina_names_are_imported_on_use():
+    result = run_without_ursina("""
+import rallyrobopilot
+assert "Car" in dir(rallyrobopilot)
+try:
+    rallyrobopilot.Car
+except ImportError:
+    pass
+else:
+    raise AssertionError("Car imported without ursina")
+""")
+    assert result.returncode == 0, result.stderr
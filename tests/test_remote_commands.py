@@ -0,0 +1,84 @@
+import pytest
+
+from rallyrobopilot.remote_commands import (RemoteCommandParser, pack_command_frame, COMMAND_FRAME_MAGIC, FRAME_FORWARD,
+                                            FRAME_LEFT, FRAME_RIGHT, FRAME_RESET)
+
+
+def parse_all(data):
+    parser = RemoteCommandParser()
+    parser.add(data)
+    return [parser.parse_next_command() for i in range(len(parser))]
+
+
+def test_commands_are_parsed():
+    assert parse_all(b"push forward;set position 1,2.5,-3;step;step 4;save state;load state start;") == [
+        [b'push', b'forward'],
+        [b'set', b'position', (1., 2.5, -3.)],
+        [b'step'],
+        [b'step', 4],
+        [b'save', b'state'],
+        [b'load', b'state', b'start'],
+    ]
+
+
+@pytest.mark.parametrize("command", [b"step abc;", b"step 1 2;", b"reset now;", b"push forward fast;",
+                                     b"set mode lockstep please;"])
+def test_trailing_words_are_rejected(command):
+    parser = RemoteCommandParser()
+    parser.add(command + b"reset;")
+    with pytest.raises(Exception):
+        parser.parse_next_command()
+    #   The invalid command is dropped, the next one is still parsed
+    assert parser.parse_next_command() == [b'reset']
+
+
+@pytest.mark.parametrize("command", [b"step 0;", b"step -3;"])
+def test_step_needs_at_least_one_tick(command):
+    parser = RemoteCommandParser()
+    parser.add(command + b"step 2;")
+    with pytest.raises(Exception):
+        parser.parse_next_command()
+    assert parser.parse_next_command() == [b'step', 2]
+
+
+def test_binary_frames_are_parsed_after_negotiation():
+    frame = pack_command_frame(42, (1, 0, 1, 0), reset_pose = ((1., 2., 3.), -90., 5.), ticks = 3)
+    commands = parse_all(b"set protocol binary;" + frame + b"reset;" + pack_command_frame(43))
+
+    assert commands[0] == [b'set', b'protocol', b'binary']
+    assert commands[1][0] == b'frame'
+    magic, flags, ticks, sequence, x, y, z, rotation, speed = commands[1][1]
+    assert magic == COMMAND_FRAME_MAGIC
+    assert flags == FRAME_FORWARD | FRAME_LEFT | FRAME_RESET
+    assert (ticks, sequence, x, y, z, rotation, speed) == (3, 42, 1., 2., 3., -90., 5.)
+    assert commands[2] == [b'reset']
+    assert commands[3][1][1:4] == (0, 0, 43)
+
+
+def test_binary_frames_split_across_chunks():
+    frames = [pack_command_frame(sequence, (sequence % 2, 0, 0, 1)) for sequence in range(10)]
+    data = b"set protocol binary;" + b"step;".join(frames)
+
+    parser = RemoteCommandParser()
+    for i in range(len(data)):
+        parser.add(data[i:i + 1])
+    commands = [parser.parse_next_command() for i in range(len(parser))]
+
+    parsed_frames = [command[1] for command in commands if command[0] == b'frame']
+    assert [frame[3] for frame in parsed_frames] == list(range(10))
+    assert [frame[1] for frame in parsed_frames] == [FRAME_RIGHT | (FRAME_FORWARD if i % 2 else 0) for i in range(10)]
+    assert commands.count([b'step']) == 9
+    assert len(parser.pending_data) == 0
+
+
+def test_binary_frames_are_not_parsed_before_negotiation():
+    parser = RemoteCommandParser()
+    parser.add(pack_command_frame(1) + b";")
+    with pytest.raises(Exception):
+        parser.parse_next_command()
+
+
+def test_text_protocol_stops_binary_frames():
+    parser = RemoteCommandParser()
+    parser.add(b"set protocol binary;set protocol text;")
+    assert not parser.binary_frames
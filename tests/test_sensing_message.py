@@ -0,0 +1,258 @@
+import itertools
+import pickle
+import socket
+
+import numpy as np
+import pytest
+
+from rallyrobopilot.image_encoding import (ImageEncoder, IMAGE_RAW, IMAGE_JPEG, IMAGE_PNG, IMAGE_DELTA,
+                                           IMAGE_DELTA_KEYFRAME, FLOAT_PIXEL_TYPE)
+from rallyrobopilot.sensing_message import (SensingSnapshot, SensingSnapshotManager, NetworkDataCmdInterface,
+                                            message_image_encoding, MESSAGE_SIZE, SENSING_CONTROLS, SENSING_POSE,
+                                            SENSING_RAYS, SENSING_IMAGE, SENSING_DEPTH, SENSING_LABELS,
+                                            SENSING_SEQUENCE)
+
+SENSING_FIELDS = (SENSING_CONTROLS, SENSING_POSE, SENSING_RAYS, SENSING_IMAGE, SENSING_DEPTH, SENSING_LABELS,
+                  SENSING_SEQUENCE)
+
+
+def make_full_snapshot(fields, image = None):
+    snapshot = SensingSnapshot()
+    snapshot.fields = fields
+    snapshot.command_sequence = 123456
+    snapshot.current_controls = (1, 0, 1, 0)
+    snapshot.car_position = (1.5, -2.25, 3.)
+    snapshot.car_angle = 90.5
+    snapshot.car_speed = 12.125
+    snapshot.raycast_distances = np.linspace(0, 100, 31, dtype = np.float32)
+    rng = np.random.default_rng(fields)
+    snapshot.image = image if image is not None else rng.integers(0, 256, (24, 32, 3), dtype = np.uint8)
+    snapshot.image_latency = 0.25
+    snapshot.depth = rng.integers(0, 65536, (24, 32), dtype = np.uint16)
+    snapshot.labels = rng.integers(0, 5, (24, 32), dtype = np.uint8)
+    return snapshot
+
+
+def unpack_one(data):
+    received = []
+    SensingSnapshotManager(received.append).add_message_chunk(data)
+    assert len(received) == 1
+    return received[0]
+
+
+@pytest.mark.parametrize("fields", [sum(combination) for nbr_fields in range(len(SENSING_FIELDS) + 1)
+                                    for combination in itertools.combinations(SENSING_FIELDS, nbr_fields)])
+def test_pack_unpack_round_trip_of_every_field(fields):
+    snapshot = make_full_snapshot(fields)
+    received = unpack_one(SensingSnapshotManager().pack(snapshot))
+
+    assert received.fields == fields
+    assert received.command_sequence == (123456 if fields & SENSING_SEQUENCE else None)
+    assert received.current_controls == ((1, 0, 1, 0) if fields & SENSING_CONTROLS else None)
+    if fields & SENSING_POSE:
+        assert (received.car_position, received.car_angle, received.car_speed) == ((1.5, -2.25, 3.), 90.5, 12.125)
+    else:
+        assert received.car_position is received.car_angle is received.car_speed is None
+    if fields & SENSING_RAYS:
+        assert np.array_equal(received.raycast_distances, snapshot.raycast_distances)
+    else:
+        assert received.raycast_distances is None
+    if fields & SENSING_IMAGE:
+        assert np.array_equal(received.image, snapshot.image)
+        assert received.image_latency == 0.25
+        assert not received.image.flags.writeable
+    else:
+        assert received.image is None
+    for field, name in ((SENSING_DEPTH, "depth"), (SENSING_LABELS, "labels")):
+        if fields & field:
+            assert np.array_equal(getattr(received, name), getattr(snapshot, name))
+        else:
+            assert getattr(received, name) is None
+
+
+def test_pack_parts_do_not_copy_the_image():
+    snapshot = make_full_snapshot(sum(SENSING_FIELDS))
+    parts = SensingSnapshotManager().pack_parts(snapshot)
+
+    assert b''.join(bytes(part) for part in parts) == SensingSnapshotManager().pack(snapshot)
+    assert any(np.shares_memory(np.frombuffer(part, np.uint8), snapshot.image) for part in parts[1:] if len(part) > 0)
+
+
+@pytest.mark.parametrize("encoding", [IMAGE_RAW, IMAGE_JPEG, IMAGE_PNG, IMAGE_DELTA])
+@pytest.mark.parametrize("channels", [1, 3])
+def test_pack_unpack_round_trip_of_every_image_encoding(encoding, channels):
+    encoder = ImageEncoder(encoding, quality = 95)
+    #   Smooth images, so that JPEG stays close to them
+    y, x = np.mgrid[0:48, 0:64]
+    snapshots = []
+    for i in range(3):
+        image = ((x * 3 + y * 2 + i * 10) % 256).astype(np.uint8)[:, :, None].repeat(channels, axis = 2)
+        snapshot = make_full_snapshot(SENSING_IMAGE | SENSING_POSE, image)
+        snapshot.image_encoding, snapshot.image_data = encoder.encode(image)
+        snapshots.append(snapshot)
+
+    received = []
+    manager = SensingSnapshotManager(received.append)
+    for snapshot in snapshots:
+        manager.add_message_chunk(SensingSnapshotManager().pack(snapshot))
+
+    assert [snapshot.image_encoding for snapshot in received] == [snapshot.image_encoding for snapshot in snapshots]
+    for sent, snapshot in zip(snapshots, received):
+        assert snapshot.image.shape == (48, 64, channels)
+        if encoding == IMAGE_JPEG:
+            assert np.abs(snapshot.image.astype(int) - sent.image).mean() < 2
+        else:
+            assert np.array_equal(snapshot.image, sent.image)
+    if encoding == IMAGE_DELTA:
+        assert [snapshot.image_encoding for snapshot in received] == [IMAGE_DELTA_KEYFRAME, IMAGE_DELTA, IMAGE_DELTA]
+
+
+def test_pack_unpack_round_trip_of_float16_images():
+    image = np.random.default_rng(0).random((24, 32, 3)).astype(FLOAT_PIXEL_TYPE)
+    received = unpack_one(SensingSnapshotManager().pack(make_full_snapshot(SENSING_IMAGE, image)))
+    assert received.image.dtype == FLOAT_PIXEL_TYPE
+    assert np.array_equal(received.image, image)
+
+
+def test_unpacked_snapshots_pickle_with_their_image():
+    encoder = ImageEncoder(IMAGE_PNG)
+    snapshot = make_full_snapshot(SENSING_IMAGE | SENSING_RAYS)
+    snapshot.image_encoding, snapshot.image_data = encoder.encode(snapshot.image)
+    received = pickle.loads(pickle.dumps(unpack_one(SensingSnapshotManager().pack(snapshot))))
+    assert np.array_equal(received.image, snapshot.image)
+    assert np.array_equal(received.raycast_distances, snapshot.raycast_distances)
+
+
+@pytest.mark.parametrize("fields", [SENSING_RAYS, SENSING_IMAGE, SENSING_SEQUENCE | SENSING_CONTROLS | SENSING_POSE |
+                                    SENSING_RAYS | SENSING_IMAGE | SENSING_DEPTH])
+def test_message_image_encoding(fields):
+    snapshot = make_full_snapshot(fields)
+    snapshot.image_encoding, snapshot.image_data = ImageEncoder(IMAGE_PNG).encode(snapshot.image)
+    data = SensingSnapshotManager().pack(snapshot)[MESSAGE_SIZE.size:]
+    assert message_image_encoding(data) == (IMAGE_PNG if fields & SENSING_IMAGE else None)
+
+
+def make_snapshot(index, image_size = (96, 128)):
+    snapshot = SensingSnapshot()
+    snapshot.car_position = (index, 0, 0)
+    snapshot.raycast_distances = np.arange(15, dtype = np.float32)
+    snapshot.image = np.full(image_size + (3,), index % 256, dtype = np.uint8)
+    return snapshot
+
+
+def pack_snapshots(snapshots):
+    manager = SensingSnapshotManager()
+    return b''.join(manager.pack(snapshot) for snapshot in snapshots)
+
+
+def received_positions(data, chunk_sizes):
+    received = []
+    manager = SensingSnapshotManager(received.append)
+    offset = 0
+    for chunk_size in itertools.cycle(chunk_sizes):
+        if offset >= len(data):
+            break
+        manager.add_message_chunk(data[offset:offset + chunk_size])
+        offset += chunk_size
+    assert manager.read_offset == manager.write_offset == 0
+    return [snapshot.car_position[0] for snapshot in received]
+
+
+@pytest.mark.parametrize("chunk_sizes", [[1], [2], [3], [5, 1, 2], [4096], [10**7]])
+def test_framing_of_any_chunking(chunk_sizes):
+    #   Split size headers, several messages per chunk and messages spanning chunks
+    data = pack_snapshots(make_snapshot(i, (8, 8)) for i in range(20))
+    assert received_positions(data, chunk_sizes) == list(range(20))
+
+
+def test_framing_of_messages_larger_than_the_receive_buffer():
+    data = pack_snapshots(make_snapshot(i, (720, 1280)) for i in range(3))
+    assert received_positions(data, [2**16 + 7]) == [0, 1, 2]
+
+
+def test_partial_header_waits_for_the_rest():
+    data = pack_snapshots([make_snapshot(7)])
+    received = []
+    manager = SensingSnapshotManager(received.append)
+    assert manager.add_message_chunk(data[:2]) == 0
+    assert manager.add_message_chunk(data[2:-1]) == 0
+    assert received == []
+    assert manager.add_message_chunk(data[-1:]) == 1
+    assert received[0].car_position == (7, 0, 0)
+
+
+def test_latest_only_delivers_the_newest_snapshot_of_a_chunk():
+    received = []
+    manager = SensingSnapshotManager(received.append, latest_only = True)
+    manager.add_message_chunk(pack_snapshots(make_snapshot(i) for i in range(10)))
+    assert len(received) == 1
+    assert received[0].car_position == (9, 0, 0)
+    assert manager.nbr_dropped_snapshots == 9
+
+
+class QueuedSocket:
+    """
+    Socket whose receive queue already holds data, read in chunks of at most chunk_size bytes
+    """
+    def __init__(self, data, chunk_size = 2**16):
+        self.data = memoryview(data)
+        self.chunk_size = chunk_size
+
+    def recv_into(self, buffer):
+        if len(self.data) == 0:
+            raise socket.timeout()
+        nbr_bytes = min(len(buffer), len(self.data), self.chunk_size)
+        buffer[:nbr_bytes] = self.data[:nbr_bytes]
+        self.data = self.data[nbr_bytes:]
+        return nbr_bytes
+
+
+def test_latest_only_keeps_newest_of_a_multi_chunk_drain():
+    data = pack_snapshots(make_snapshot(i, (480, 640)) for i in range(50))
+
+    received = []
+    manager = SensingSnapshotManager(received.append, latest_only = True)
+    for offset in range(0, len(data), 2**16):
+        manager.add_message_chunk(data[offset:offset + 2**16], deliver_latest = False)
+    assert received == []
+
+    manager.deliver_latest()
+    assert len(received) == 1
+    assert received[0].car_position == (49, 0, 0)
+    assert received[0].image[0, 0, 0] == 49
+    assert manager.nbr_dropped_snapshots == 49
+
+
+def test_recv_msg_latest_only_delivers_one_snapshot_per_drain():
+    server = socket.create_server(("127.0.0.1", 0))
+    interface = NetworkDataCmdInterface(None, port = server.getsockname()[1], latest_only = True)
+    interface.socket.close()
+    server.close()
+
+    for image_size in ((1, 1), (96, 128), (480, 640)):
+        received = []
+        interface.msg_mngr.received_snapshot_callback = received.append
+        interface.socket = QueuedSocket(pack_snapshots(make_snapshot(i, image_size) for i in range(50)))
+        interface.recv_msg()
+        assert len(received) == 1, image_size
+        assert received[0].car_position == (49, 0, 0)
+
+
+def test_latest_only_keeps_delta_images_decodable():
+    encoder = ImageEncoder(IMAGE_DELTA)
+    snapshots = []
+    for i in range(20):
+        snapshot = make_snapshot(i)
+        snapshot.image = np.random.default_rng(i).integers(0, 256, (96, 128, 3), dtype = np.uint8)
+        snapshot.image_encoding, snapshot.image_data = encoder.encode(snapshot.image)
+        snapshots.append(snapshot)
+    data = pack_snapshots(snapshots)
+
+    received = []
+    manager = SensingSnapshotManager(received.append, latest_only = True)
+    for offset in range(0, len(data), 4096):
+        manager.add_message_chunk(data[offset:offset + 4096], deliver_latest = False)
+    manager.deliver_latest()
+
+    assert len(received) == 1
+    assert np.array_equal(received[0].image, snapshots[-1].image)
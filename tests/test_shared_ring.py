@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from rallyrobopilot.shared_ring import SharedSnapshotRing, MAX_SHARED_MEMORY_SIZE, SLOT_HEADER
+
+
+@pytest.fixture
+def ring():
+    ring = SharedSnapshotRing("rrp_test_%d" % os.getpid(), 2, 1024, create = True)
+    yield ring
+    ring.close()
+
+
+def test_written_messages_are_read_until_overwritten(ring):
+    first = ring.write((b'ab', bytearray(b'cd')))
+    second = ring.write((b'ef',))
+    assert bytes(ring.read(*first)) == b'abcd'
+    assert bytes(ring.read(*second)) == b'ef'
+
+    third = ring.write((b'gh',))
+    assert third[0] == first[0]
+    assert ring.read(*first) is None and not ring.is_valid(*first)
+    assert bytes(ring.read(*third)) == b'gh'
+
+
+def test_messages_larger_than_a_slot_are_not_written(ring):
+    assert ring.write((bytes(1024 - SLOT_HEADER.size + 1),)) is None
+
+
+@pytest.mark.parametrize("nbr_slots, slot_size", [(0, 1024), (4, SLOT_HEADER.size), (2, MAX_SHARED_MEMORY_SIZE)])
+def test_invalid_ring_sizes_are_rejected(nbr_slots, slot_size):
+    with pytest.raises(ValueError):
+        SharedSnapshotRing("rrp_test_invalid_%d" % os.getpid(), nbr_slots, slot_size, create = True)
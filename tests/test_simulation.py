@@ -0,0 +1,100 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from rallyrobopilot.simulation import SIMULATION_BACKENDS, HeadlessSimulation, MIN_CAR_HEIGHT
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+#   On the SimpleTrack ground, heading to its edge without any wall in between
+OFF_TRACK_POSITION = (-130.5, 1, 15.5)
+OFF_TRACK_ANGLE = 90
+
+
+def run_in_game_process(function, *args):
+    """
+    Runs a function of this module in a new process, the game backend starts a single Ursina app per process
+    """
+    pytest.importorskip("ursina")
+    code = "import sys; sys.path.insert(0, 'tests'); import test_simulation; test_simulation.%s(*%r)" % (function, args)
+    result = subprocess.run([sys.executable, "-c", code], cwd = ROOT_DIR, capture_output = True, text = True)
+    assert result.returncode == 0, result.stderr
+
+
+def place_car(simulation, position, angle):
+    holder = simulation if isinstance(simulation, HeadlessSimulation) else simulation.car
+    holder.reset_position = position
+    holder.reset_orientation = (0, angle, 0)
+    return simulation.reset()
+
+
+def drive_off_track(backend):
+    simulation = SIMULATION_BACKENDS[backend]("SimpleTrack")
+    observation = place_car(simulation, OFF_TRACK_POSITION, OFF_TRACK_ANGLE)
+    assert observation["position"][1] > MIN_CAR_HEIGHT
+
+    for i in range(60):
+        observation, travelled, done = simulation.step((1, 0, 0, 0), 10)
+        if done:
+            break
+    assert done
+    assert observation["position"][1] <= MIN_CAR_HEIGHT
+
+
+def check_state_restore(backend):
+    simulation = SIMULATION_BACKENDS[backend]("SimpleTrack")
+    simulation.reset()
+    simulation.step((1, 0, 0, 0), 30)
+    state = simulation.save_state()
+
+    controls = [(1, 0, i % 3 == 0, i % 5 == 0) for i in range(20)]
+    first = [simulation.step(car_controls, 5)[0] for car_controls in controls]
+    simulation.load_state(state)
+    second = [simulation.step(car_controls, 5)[0] for car_controls in controls]
+    for first_observation, second_observation in zip(first, second):
+        for name in first_observation:
+            np.testing.assert_array_equal(first_observation[name], second_observation[name])
+
+    for data in (state[:-1], state + bytes(4), b''):
+        with pytest.raises(ValueError):
+            simulation.load_state(data)
+
+
+def check_spawn_labels(track_name):
+    from rallyrobopilot.camera_sensor import LABEL_CAR, LABEL_TRACK
+
+    simulation = SIMULATION_BACKENDS["game"](track_name, image = True)
+    sensor = simulation.car.camera_sensor
+    #   Looking straight down on the car
+    sensor.configure(position = (0, 20, 0), rotation = (90, 0, 0), labels = True)
+    simulation.reset()
+
+    labels = sensor.grab_labels()
+    height, width = labels.shape
+    under_car = labels[3 * height // 8:5 * height // 8, 3 * width // 8:5 * width // 8]
+    under_car = under_car[under_car != LABEL_CAR]
+    assert np.bincount(under_car).argmax() == LABEL_TRACK
+
+
+def test_car_driven_off_the_track_ends_the_headless_episode():
+    drive_off_track("headless")
+
+
+def test_car_driven_off_the_track_ends_the_game_episode():
+    run_in_game_process("drive_off_track", "game")
+
+
+def test_saved_state_replays_the_headless_episode():
+    check_state_restore("headless")
+
+
+def test_saved_state_replays_the_game_episode():
+    run_in_game_process("check_state_restore", "game")
+
+
+@pytest.mark.parametrize("track_name", ["SimpleTrack", "VisualTrack"])
+def test_ground_under_the_car_at_spawn_is_labelled_track(track_name):
+    run_in_game_process("check_spawn_labels", track_name)